@@ -0,0 +1,232 @@
+'''
+This file has tools for running a node with asyncio instead of one thread per job
+That includes socket streams, periodic tasks, bus subscriptions, and shutdown
+'''
+
+# Import necessary libraries
+import asyncio
+import signal
+from queue import Empty
+from concurrent.futures import ThreadPoolExecutor
+
+import CommunicationUtils
+
+class NodeRuntime():
+    '''
+    Runs all of the tasks of a node on one asyncio event loop
+
+    Stopping the runtime cancels every task, which replaces polling an execute dict.
+    Blocking calls (like I2C reads and writes) should go through runBlocking or runHardware,
+    so they do not hold up the event loop.
+    '''
+    def __init__(self):
+        self.taskFactories = []
+        self.tasks = []
+        self.loop = None
+
+        # All of the hardware is on one I2C bus, so hardware calls are run one at a time in order
+        #  * The IMU sampler thread is outside of this, it shares the bus through HardwareUtils.i2cLock
+        self.hardwareExecutor = ThreadPoolExecutor(max_workers=1)
+
+    def addTask(self, coroFunc, *args):
+        '''
+        Adds a task that is started when the runtime runs
+
+        Arguments:
+            coroFunc: The coroutine function to run
+            args: Arguments for coroFunc
+        '''
+        self.taskFactories.append((coroFunc, args))
+
+    def run(self):
+        '''
+        Runs all of the tasks until one of them fails or the runtime is stopped
+        '''
+        try:
+            asyncio.run(self.main())
+        finally:
+            self.hardwareExecutor.shutdown(wait=True)
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+
+        # Stop cleanly on ctrl+c or a kill signal
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                # Signals can only be handled on the main thread of some platforms
+                pass
+
+        self.tasks = [asyncio.ensure_future(coroFunc(*args)) for coroFunc, args in self.taskFactories]
+        if not self.tasks:
+            return
+
+        done, pending = await asyncio.wait(self.tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        # Raise any error that stopped the runtime
+        for task in done:
+            if not task.cancelled() and task.exception():
+                raise task.exception()
+
+    def stop(self):
+        '''
+        Cancels every task, this can be called from any thread
+        '''
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._cancelTasks)
+
+    def _cancelTasks(self):
+        for task in self.tasks:
+            task.cancel()
+
+    async def runBlocking(self, func, *args):
+        '''
+        Runs a blocking function in the default thread pool and waits for its result
+        '''
+        return await self.loop.run_in_executor(None, func, *args)
+
+    async def runHardware(self, func, *args):
+        '''
+        Runs a blocking hardware call in the hardware thread and waits for its result
+        '''
+        return await self.loop.run_in_executor(self.hardwareExecutor, func, *args)
+
+async def runPeriodic(period, func, *args):
+    '''
+    Calls a function at a fixed rate until cancelled
+
+    The next call is scheduled from when the last one was supposed to start, not when it finished,
+    so the rate does not drift. If a call runs over its period, the missed calls are skipped.
+
+    Arguments:
+        period: The time between calls in seconds
+        func: The function to call (it can be a normal function or a coroutine function)
+        args: Arguments for func
+    '''
+    loop = asyncio.get_running_loop()
+    nextRun = loop.time()
+    while True:
+        result = func(*args)
+        if asyncio.iscoroutine(result):
+            await result
+
+        nextRun += period
+        delay = nextRun - loop.time()
+        if delay < 0:
+            nextRun = loop.time()
+            delay = 0
+        await asyncio.sleep(delay)
+
+### SOCKET STREAMS ###
+
+async def recvMsg(reader, timeout=2):
+    '''
+    Recieves a single message from a stream (see CommunicationUtils.MessageFramer)
+
+    Waiting for a new message to start will block forever, but once the first byte of a message has arrived,
+    the rest of it must arrive within the timeout
+
+    Arguments:
+        reader: The asyncio StreamReader of the connection
+        timeout: (optional) the maximum amount of time to wait for the rest of a message once it has started
+
+    Returns:
+        The received message
+    '''
+    loop = asyncio.get_running_loop()
+    try:
+        firstByte = await reader.readexactly(1)
+        deadline = loop.time() + timeout
+
+        header = CommunicationUtils.FRAME_HEADER.unpack(firstByte + await asyncio.wait_for(
+            reader.readexactly(CommunicationUtils.FRAME_HEADER.size-1), deadline-loop.time()))
+        payload = await asyncio.wait_for(reader.readexactly(header[0]), deadline-loop.time())
+    except asyncio.TimeoutError:
+        raise CommunicationUtils.MessageTimeoutError("recvMsg Timeout of {} was reached".format(timeout))
+    except asyncio.IncompleteReadError:
+        raise ConnectionResetError("The connection was closed by the other side")
+
+    return CommunicationUtils.decodeFrame(header, payload)
+
+async def sendMsgs(writer, pckts, useCodecs=(CommunicationUtils.CODEC_JSON,)):
+    '''
+    Sends messages through a stream, and waits until they can be sent
+
+    Arguments:
+        writer: The asyncio StreamWriter of the connection
+        pckts: packets to be sent, in order
+        useCodecs: (optional) ids of the codecs that may be used, usually the result of negotiateCodecs
+    '''
+    writer.write(b"".join([CommunicationUtils.encodeMsg(pckt, useCodecs) for pckt in pckts]))
+    await writer.drain()
+
+async def sendCodecs(writer):
+    '''
+    Tells the other side of a connection which codecs this node can decode (see CommunicationUtils.sendCodecs)
+    '''
+    await sendMsgs(writer, [CommunicationUtils.packet("config", CommunicationUtils.supportedCodecs(), metadata="codecs")])
+
+async def negotiateCodecs(reader, timeout=5):
+    '''
+    Waits for the other side of a connection to send the codecs it can decode (see CommunicationUtils.negotiateCodecs)
+
+    Returns:
+        The ids of the codecs that both sides support, in order of preference
+    '''
+    try:
+        recv = await asyncio.wait_for(recvMsg(reader, timeout), timeout)
+    except (asyncio.TimeoutError, CommunicationUtils.MessageTimeoutError):
+        recv = None
+
+    return CommunicationUtils.pickCodecs(recv)
+
+### MESSAGE BUS ###
+
+class AsyncSubscription(CommunicationUtils.Subscription):
+    '''
+    A message bus subscription that can be awaited from the event loop
+    Packets can still be published from any thread
+
+    It must be created from inside the event loop:
+        bus.subscribe(topics, subscriptionType=AsyncUtils.AsyncSubscription)
+    '''
+    def __init__(self, bus, topics, maxsize, policy, blockTimeout):
+        if policy == CommunicationUtils.BLOCK:
+            raise ValueError("Async subscriptions can not block publishers")
+
+        super().__init__(bus, topics, maxsize, policy, blockTimeout)
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(self.queue.maxsize)
+
+    def put(self, pckt):
+        try:
+            self.loop.call_soon_threadsafe(self._put, pckt)
+        except RuntimeError:
+            # The event loop has already been closed
+            self.dropped += 1
+            return False
+        self.delivered += 1
+        return True
+
+    def _put(self, pckt):
+        while True:
+            try:
+                self.queue.put_nowait(pckt)
+                break
+            except asyncio.QueueFull:
+                # Throw out the oldest packet to make room
+                self.queue.get_nowait()
+                self.dropped += 1
+
+    async def get(self):
+        return await self.queue.get()
+
+    def get_nowait(self):
+        try:
+            return self.queue.get_nowait()
+        except asyncio.QueueEmpty:
+            raise Empty
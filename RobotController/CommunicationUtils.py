@@ -6,11 +6,23 @@ This file utility code for all communication. That includes sockets, threads, pa
 import simplejson as json
 import time
 import socket
+import select
+import struct
+import threading
 import base64
 import cv2
 import time
 import numpy as np
 from copy import copy
+from operator import attrgetter
+from queue import Queue, Empty, Full
+from collections import OrderedDict
+
+# msgpack is optional, if it is not installed, packets will be sent as JSON
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
 
 # Hardcoded ports for communication
 CAM_PORT = 6666
@@ -31,7 +43,35 @@ WATER_IP = '169.254.209.182'
 SIMPLE_EARTH_IP = "localhost"
 
 # Communication parameters
-LENGTH_MARKER = b'|'
+RECV_CHUNK_SIZE = 65536
+
+# Every message starts with a fixed size header: [payload_length][frame_version][tag_id][codec_id]
+# The payload length is a 4 byte unsigned int (big endian), the rest are single bytes
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("!IBBB")
+
+# Tags that are sent over sockets are replaced by an id in the header
+# Tag id 0 is reserved for tags that are not in this list, their name is only stored in the payload
+TAGS = ["config", "sensor", "cam", "motorData", "gripData", "log", "stateChange", "settingChange"]
+TAG_IDS = {tag: tagId for tagId, tag in enumerate(TAGS, start=1)}
+UNKNOWN_TAG_ID = 0
+
+# Ids of the built in payload codecs
+CODEC_JSON = 0
+CODEC_MSGPACK = 1
+CODEC_STRUCT = 2
+
+# Codecs in the order they should be used when both sides support them
+# JSON is always last, because it can encode every packet
+CODEC_PREFERENCE = [CODEC_STRUCT, CODEC_MSGPACK, CODEC_JSON]
+
+# Drop policies for message bus subscriptions (what happens when a subscriber's queue is full)
+#  * latest-only: The subscriber only ever holds the newest packet
+#  * drop-oldest: The oldest packet is thrown out to make room for the new one
+#  * block: The publisher waits for room (up to a timeout) and then drops the new packet
+LATEST_ONLY = "latest-only"
+DROP_OLDEST = "drop-oldest"
+BLOCK = "block"
 
 # TODO: Make all documentation consisitent with single or double quotes
 
@@ -45,93 +85,513 @@ def packet(tag="",data="",timestamp=False,metadata="",highPriority=False, copy_d
 		timestamp: The time the packet was created. If none is provided it will be set to the current time
 		metadata: Any extra data about the packet
 		highPriority: Whether this packet should have high priority. Currently, this does nothing, but there should eventually be some line skipping functionality
+		copy_data: (optional) Whether to make a copy of data. Sensor frames are never copied, because they can not be changed
 	
 	Returns:
 		The generated packet
 	'''
 	dataPacket = {
 		"tag": tag,
-		"data": copy(data) if copy_data else data,
+		"data": copy(data) if copy_data and not isinstance(data, SensorFrame) else data,
 		"timestamp": float(timestamp if timestamp else time.time()),
 		"metadata": metadata,
 		"highPriority": highPriority
 	}
 	return dataPacket
 
-def sendMsg(sckt, pckt):
+### SENSOR FRAMES ###
+
+SENSOR_FIELDS = [
+	("imu", "calibration", "sys"),
+	("imu", "calibration", "gyro"),
+	("imu", "calibration", "accel"),
+	("imu", "calibration", "mag"),
+	("imu", "gyro", "x"),
+	("imu", "gyro", "y"),
+	("imu", "gyro", "z"),
+	("imu", "vel", "x"),
+	("imu", "vel", "y"),
+	("imu", "vel", "z"),
+	("temp",)
+]
+SENSOR_STRUCT = struct.Struct("!"+"f"*len(SENSOR_FIELDS))
+
+# The attribute name of each field in a SensorFrame
+SENSOR_SLOTS = ("calibrationSys", "calibrationGyro", "calibrationAccel", "calibrationMag",
+				"gyroX", "gyroY", "gyroZ",
+				"velX", "velY", "velZ",
+				"temp")
+
+def sensorValues(data):
+	'''
+	Flattens a sensor dict into a list of values in the order of SENSOR_FIELDS
+
+	Returns:
+		The flattened values, or None if the dict does not have exactly the expected fields
+	'''
+	if not isinstance(data, dict) or data.keys() != {"imu", "temp"}:
+		return None
+	imu = data["imu"]
+	if not isinstance(imu, dict) or imu.keys() != {"calibration", "gyro", "vel"}:
+		return None
+	if (imu["calibration"].keys() != {"sys", "gyro", "accel", "mag"} or
+		imu["gyro"].keys() != {"x", "y", "z"} or
+		imu["vel"].keys() != {"x", "y", "z"}):
+		return None
+
+	values = []
+	for field in SENSOR_FIELDS:
+		value = data
+		for key in field:
+			value = value[key]
+		values.append(value)
+	return values
+
+def sensorDict(values):
+	'''
+	Expands a list of values in the order of SENSOR_FIELDS back into a sensor dict
+	'''
+	data = {}
+	for field, value in zip(SENSOR_FIELDS, values):
+		level = data
+		for key in field[:-1]:
+			level = level.setdefault(key, {})
+		level[field[-1]] = value
+	return data
+
+class SensorFrame():
+	'''
+	One sample of the sensors, stored as flat values instead of nested dicts
+
+	Frames are never changed after they are made, so they can be shared between threads and packets without being copied
+	Use toDict to get the nested dict shape that the websites use
+	'''
+	__slots__ = SENSOR_SLOTS
+
+	def __init__(self, *values, **fields):
+		'''
+		Arguments:
+			values: (optional) The values in the order of SENSOR_FIELDS
+			fields: (optional) Values by attribute name (see SENSOR_SLOTS), anything that is not given is 0
+		'''
+		if len(values) > len(SENSOR_SLOTS):
+			raise ValueError("A sensor frame has {} values, got {}".format(len(SENSOR_SLOTS), len(values)))
+		for name, value in zip(SENSOR_SLOTS, values):
+			object.__setattr__(self, name, value)
+		for name in SENSOR_SLOTS[len(values):]:
+			object.__setattr__(self, name, fields.pop(name, 0))
+		if fields:
+			raise TypeError("Unknown sensor fields {}".format(list(fields)))
+
+	def __setattr__(self, name, value):
+		raise AttributeError("Sensor frames can not be changed")
+
+	def __eq__(self, other):
+		return isinstance(other, SensorFrame) and self.values() == other.values()
+
+	def __repr__(self):
+		return "SensorFrame({})".format(", ".join("{}={}".format(name, getattr(self, name)) for name in SENSOR_SLOTS))
+
+	def values(self):
+		'''
+		Returns a tuple of the values in the order of SENSOR_FIELDS
+		'''
+		return _sensorGetter(self)
+
+	def pack(self):
+		'''
+		Converts the frame into bytes (see SENSOR_STRUCT)
+		'''
+		return SENSOR_STRUCT.pack(*_sensorGetter(self))
+
+	@classmethod
+	def unpack(cls, data, offset=0):
+		'''
+		Converts bytes made by pack back into a frame
+		'''
+		return cls(*SENSOR_STRUCT.unpack_from(data, offset))
+
+	def toDict(self):
+		'''
+		Returns the frame as a nested sensor dict
+		'''
+		return sensorDict(_sensorGetter(self))
+
+	@classmethod
+	def fromDict(cls, data):
+		'''
+		Converts a nested sensor dict into a frame
+
+		Returns:
+			The frame, or None if the dict does not have exactly the expected fields
+		'''
+		values = sensorValues(data)
+		return cls(*values) if values is not None else None
+
+_sensorGetter = attrgetter(*SENSOR_SLOTS)
+
+### PAYLOAD CODECS ###
+
+# Each codec has a name, an encode function, and a decode function
+#  * encode(pckt) returns the payload bytes, or None if the codec can not encode that packet
+#  * decode(payload, tag) returns the packet
+codecs = {}
+
+def registerCodec(codecId, name, encode, decode):
+	'''
+	Adds a payload codec that can be used to send packets
+
+	Arguments:
+		codecId: The id of the codec that is stored in each frame header (0-255)
+		name: The name of the codec, used when the nodes negotiate which codecs to use
+		encode: Function that converts a packet into bytes (or None if it can not encode the packet)
+		decode: Function that converts bytes and a tag back into a packet
+	'''
+	codecs[codecId] = {
+		"name": name,
+		"encode": encode,
+		"decode": decode
+	}
+
+def supportedCodecs():
+	'''
+	Returns the names of all of the codecs this node can decode
+	'''
+	return [codecs[codecId]["name"] for codecId in codecs]
+
+def encodeDefault(obj):
+	# Lets JSON and msgpack encode the types they do not know about
+	if isinstance(obj, SensorFrame):
+		return obj.toDict()
+	raise TypeError("Object of type {} can not be encoded".format(type(obj).__name__))
+
+def decodedPacket(pckt):
+	# Sensor data is turned back into a frame, no matter which codec it was sent with
+	if pckt.get("tag") == "sensor":
+		frame = SensorFrame.fromDict(pckt["data"])
+		if frame is not None:
+			pckt["data"] = frame
+	return pckt
+
+def encodeJSON(pckt):
+	return json.dumps(pckt, default=encodeDefault).encode()
+
+def decodeJSON(payload, tag):
+	return decodedPacket(json.loads(payload.decode()))
+
+def encodeMsgpack(pckt):
+	return msgpack.packb(pckt, use_bin_type=True, default=encodeDefault)
+
+def decodeMsgpack(payload, tag):
+	return decodedPacket(msgpack.unpackb(payload, raw=False))
+
+# The struct codec is a fast path for the packets that are sent many times a second
+# Only the values are sent, the structure of the packet is known by both sides
+#  * Every struct payload starts with: [timestamp][highPriority][metadata_length][metadata]
+#  * motorData is followed by: [number_of_values][values...]
+#  * sensor is followed by the values in SENSOR_FIELDS (see SensorFrame.pack)
+#  * cam is followed by the JPEG bytes
+STRUCT_HEAD = struct.Struct("!d?B")
+STRUCT_COUNT = struct.Struct("!B")
+
+def encodeStruct(pckt):
+	if pckt["tag"] not in ("motorData", "sensor", "cam"):
+		return None
+	if not isinstance(pckt["metadata"], str):
+		return None
+	metadata = pckt["metadata"].encode()
+	if len(metadata) > 255:
+		return None
+
+	try:
+		if pckt["tag"] == "motorData":
+			values = pckt["data"]
+			if not isinstance(values, (list, tuple)) or len(values) > 255:
+				return None
+			body = STRUCT_COUNT.pack(len(values)) + struct.pack("!"+"f"*len(values), *values)
+		elif pckt["tag"] == "sensor":
+			data = pckt["data"]
+			if not isinstance(data, SensorFrame):
+				data = SensorFrame.fromDict(data)
+				if data is None:
+					return None
+			body = data.pack()
+		else:
+			body = pckt["data"]
+			if not isinstance(body, (bytes, bytearray)):
+				# imagezmq can hand over a zmq frame instead of bytes, anything with a buffer works
+				body = memoryview(body).tobytes()
+	except (struct.error, TypeError):
+		# One of the values is not a number, or the image is not a buffer
+		return None
+
+	return STRUCT_HEAD.pack(pckt["timestamp"], bool(pckt["highPriority"]), len(metadata)) + metadata + body
+
+def decodeStruct(payload, tag):
+	timestamp, highPriority, metadataLength = STRUCT_HEAD.unpack_from(payload)
+	offset = STRUCT_HEAD.size
+	metadata = payload[offset:offset+metadataLength].decode()
+	offset += metadataLength
+
+	if tag == "motorData":
+		count = STRUCT_COUNT.unpack_from(payload, offset)[0]
+		data = list(struct.unpack_from("!"+"f"*count, payload, offset+STRUCT_COUNT.size))
+	elif tag == "sensor":
+		data = SensorFrame.unpack(payload, offset)
+	elif tag == "cam":
+		data = bytes(payload[offset:])
+	else:
+		raise FrameError("The struct codec can not decode {} packets".format(tag))
+
+	return packet(tag=tag, data=data, timestamp=timestamp, metadata=metadata, highPriority=highPriority, copy_data=False)
+
+registerCodec(CODEC_JSON, "json", encodeJSON, decodeJSON)
+registerCodec(CODEC_STRUCT, "struct", encodeStruct, decodeStruct)
+if msgpack:
+	registerCodec(CODEC_MSGPACK, "msgpack", encodeMsgpack, decodeMsgpack)
+
+### FRAMING ###
+
+class FrameError(Exception):
+	'''
+	Raised when a recieved frame can not be decoded
+	'''
+	pass
+
+def encodeMsg(pckt, useCodecs=(CODEC_JSON,)):
+	'''
+	Converts a packet into a binary frame
+
+	Arguments:
+		pckt: packet to be encoded
+		useCodecs: (optional) ids of the codecs that may be used, in order of preference
+			If none of them can encode the packet, JSON is used
+
+	Returns:
+		The encoded frame
+	'''
+	for codecId in useCodecs:
+		payload = codecs[codecId]["encode"](pckt)
+		if payload is not None:
+			break
+	else:
+		codecId = CODEC_JSON
+		payload = encodeJSON(pckt)
+
+	tagId = TAG_IDS.get(pckt["tag"], UNKNOWN_TAG_ID)
+	return FRAME_HEADER.pack(len(payload), FRAME_VERSION, tagId, codecId) + payload
+
+def decodeFrame(header, payload):
+	'''
+	Converts a binary frame back into a packet
+
+	Arguments:
+		header: The unpacked frame header (payload_length, frame_version, tag_id, codec_id)
+		payload: The payload bytes of the frame
+
+	Returns:
+		The decoded packet
+	'''
+	msgLength, version, tagId, codecId = header
+	if version != FRAME_VERSION:
+		raise FrameError("Frame version {} is not supported (expected {})".format(version, FRAME_VERSION))
+	if codecId not in codecs:
+		raise FrameError("Codec {} is not supported".format(codecId))
+
+	tag = TAGS[tagId-1] if 0 < tagId <= len(TAGS) else None
+	return codecs[codecId]["decode"](payload, tag)
+
+def sendMsg(sckt, pckt, useCodecs=(CODEC_JSON,)):
 	""" 
-	Send a JSON message through a socket
+	Send a message through a socket
 
 	Arguments:
 		sckt: socket to send data through
 		pckt: packet to be sent
+		useCodecs: (optional) ids of the codecs that may be used, usually the result of negotiateCodecs
 
 	Returns:
 		The sent message
 	"""
-	# Convert the json packet object into a string
-	data = json.dumps(pckt)
-	# Calculate its length
-	msgLen = len(data)
-	# Combine the length and the packet to make the message
-	msg = str(msgLen)+LENGTH_MARKER.decode()+data
-	# Send and return the message
-	sckt.sendall(msg.encode())
+	msg = encodeMsg(pckt, useCodecs)
+	sckt.sendall(msg)
 	return msg
 
-def recvMsg(conn,timeout=2):
-	""" 
-	Recieve a JSON message from a socket
-	Messages should be formatted as [messge_length]|[message_contents]
+def sendMsgs(sckt, pckts, useCodecs=(CODEC_JSON,)):
+	'''
+	Sends several messages through a socket with a single sendall
+
+	Arguments:
+		sckt: socket to send data through
+		pckts: packets to be sent, in order
+		useCodecs: (optional) ids of the codecs that may be used, usually the result of negotiateCodecs
+
+	Returns:
+		The sent messages
+	'''
+	msgs = b"".join([encodeMsg(pckt, useCodecs) for pckt in pckts])
+	sckt.sendall(msgs)
+	return msgs
+
+def coalescePackets(pckts, coalesceTags):
+	'''
+	Removes packets that have been superseded by a newer packet with the same tag and metadata
+	Only packets with one of coalesceTags are removed. The packets that are kept stay in order
+
+	Arguments:
+		pckts: packets to coalesce, oldest first
+		coalesceTags: tags of packets where only the newest one matters (like motorData)
+
+	Returns:
+		The coalesced packets
+	'''
+	# Find the newest packet for each tag and metadata
+	newest = {}
+	for i, pckt in enumerate(pckts):
+		if pckt["tag"] in coalesceTags:
+			newest[(pckt["tag"], str(pckt["metadata"]))] = i
+
+	return [pckt for i, pckt in enumerate(pckts)
+			if pckt["tag"] not in coalesceTags or newest[(pckt["tag"], str(pckt["metadata"]))] == i]
+
+def sendCodecs(sckt):
+	'''
+	Tells the other side of a connection which codecs this node can decode
+	This should be sent by the recieving side of a connection as soon as it connects
+
+	Arguments:
+		sckt: socket to send the codecs through
+	'''
+	sendMsg(sckt, packet("config", supportedCodecs(), metadata="codecs"))
+
+def negotiateCodecs(framer, timeout=5):
+	'''
+	Waits for the other side of a connection to send the codecs it can decode, and picks the ones to send with
+	This should be called by the sending side of a connection as soon as it connects
+
+	Arguments:
+		framer: the MessageFramer of the connection
+		timeout: (optional) the maximum amount of time to wait for the other side
+
+	Returns:
+		The ids of the codecs that both sides support, in order of preference
+	'''
+	framer.conn.settimeout(timeout)
+	try:
+		recv = framer.recvMsg(timeout)
+	except (socket.timeout, MessageTimeoutError):
+		recv = None
+	finally:
+		framer.conn.settimeout(None)
+
+	return pickCodecs(recv)
+
+def pickCodecs(recv):
+	'''
+	Picks the codecs to send with from the codecs message the other side of a connection sent
+
+	Arguments:
+		recv: The message recieved from the other side (or None if nothing was recieved)
+
+	Returns:
+		The ids of the codecs that both sides support, in order of preference
+	'''
+	if not recv or recv["tag"] != "config" or recv["metadata"] != "codecs":
+		# The other side did not say what it supports, so only JSON is safe
+		return [CODEC_JSON]
+
+	return [codecId for codecId in CODEC_PREFERENCE if codecId in codecs and codecs[codecId]["name"] in recv["data"]]
+
+class MessageTimeoutError(Exception):
+	'''
+	Raised when a message starts arriving but is not fully received before the timeout
+	'''
+	pass
+
+class MessageFramer():
+	'''
+	Recieves messages from a socket
+	Messages should be formatted as [frame_header][payload] (see FRAME_HEADER)
 
 	The usual method of serial or socket communication, is with predefined start and end characters.
 	After a start character is recieved, one character at a time is read until an end character is reached.
 	When large messages are being sent, this can become very slow.
-	
+
 	Because of that, we take a different approach.
-	Each message sent is prefaced with the length of the message and a separator character.
-	One character at a time is read until the separator character is reached.
-	Then, the characters before the separator character are read, getting the length of the message.
-	After we have the length of the message, we can read and return exactly that many characters.
+	Each message sent is prefaced with a fixed size header that has the length of the message.
+	The framer reads large chunks from the socket into its own buffer, and splits complete messages out of that buffer.
+	Any bytes left over after a message (the start of the next one) stay in the buffer for the next read.
+	There should only be one framer per connection, otherwise the buffered bytes would be lost.
+	'''
+	def __init__(self, conn, chunkSize=RECV_CHUNK_SIZE):
+		'''
+		Arguments:
+			conn: the socket to receive data through
+			chunkSize: (optional) the maximum number of bytes to read from the socket at once
+		'''
+		self.conn = conn
+		self.chunkSize = chunkSize
+		self.buffer = bytearray()
 
-	Arguments:
-		conn: the socket to receive data through
-		timeout: (optional) the maximum amount of time to wait before canceling
+	def __iter__(self):
+		'''
+		Yields every message recieved until the connection is closed
+		'''
+		while True:
+			yield self.recvMsg()
 
-	Returns:
-		The received message
-	"""
+	def nextMsg(self):
+		'''
+		Splits one complete message out of the buffer
+
+		Returns:
+			The decoded message, or None if the buffer does not have a full message yet
+		'''
+		if len(self.buffer) < FRAME_HEADER.size:
+			return None
+
+		header = FRAME_HEADER.unpack_from(self.buffer)
+		msgEnd = FRAME_HEADER.size+header[0]
+		if len(self.buffer) < msgEnd:
+			return None
+
+		payload = bytes(self.buffer[FRAME_HEADER.size:msgEnd])
+		del self.buffer[:msgEnd]
+		return decodeFrame(header, payload)
+
+	def recvMsg(self, timeout=2):
+		'''
+		Recieves a single message
+
+		Waiting for a new message to start will block forever, but once the first byte of a message has arrived,
+		the rest of it (including the length) must arrive within the timeout
 
-	# TODO: Add the time out to the whole function
-	# Right now it could theoretically wait for ever for the LENGTH_MARKER to be recieved
-
-	# The implementation of message reading is not the cleanest
-	# First, we peek into the socket until we see an end character
-	# While doing this, we keep track of how many characters dep we are
-	numChars = 2
-
-	now = time.time()
-	lastChar = conn.recv(numChars, socket.MSG_PEEK)[-1:]
-	while(lastChar != LENGTH_MARKER):
-		numChars += 1
-		lastChar = conn.recv(numChars, socket.MSG_PEEK)[-1:]
-
-	# After we find an end character, we find the total length of the message
-	# That is equal to: the number of characters in the message itself + 1 (for the separator) + the lenght of the number of the number of characters in the message
-	bMsgLength = conn.recv(numChars, socket.MSG_PEEK)
-	iMsgLength = int(bMsgLength[:-1])
-	iTotalLength = iMsgLength+len(bMsgLength)
-
-	# We wait until either that many characters are available to be read, or time runs out
-	while(len(conn.recv(iTotalLength, socket.MSG_PEEK))<iTotalLength):
-		time.sleep(0.001)
-		if (time.time()-now) > timeout:
-			raise Exception("recvMsg Timeout of {} was reached".format(timeout))
-
-	# Once enough characters are ready, we read and return the message
-	conn.recv(numChars)
-	recv = conn.recv(iMsgLength)
-	return json.loads(str(recv.decode()))
+		Arguments:
+			timeout: (optional) the maximum amount of time to wait for the rest of a message once it has started
+
+		Returns:
+			The received message
+		'''
+		deadline = time.time()+timeout if self.buffer else None
+
+		msg = self.nextMsg()
+		while msg is None:
+			if deadline is not None:
+				# Only wait for as long as the message has left
+				remaining = deadline-time.time()
+				readable = select.select([self.conn], [], [], remaining)[0] if remaining > 0 else []
+				if not readable:
+					raise MessageTimeoutError("recvMsg Timeout of {} was reached".format(timeout))
+
+			chunk = self.conn.recv(self.chunkSize)
+			if not chunk:
+				raise ConnectionResetError("The connection was closed by the other side")
+
+			if deadline is None:
+				deadline = time.time()+timeout
+			self.buffer += chunk
+			msg = self.nextMsg()
+		return msg
 
 def encodeImage(image):
     """ 
@@ -146,20 +606,106 @@ def encodeImage(image):
     retval, bffr = cv2.imencode('.jpg', image)
     return bffr.tobytes()
 
-def decodeImage(uri):
+# OpenCV flags for each decodeImage mode and scale
+#  * The reduced flags make the JPEG decoder skip detail, so a frame decoded at 1/2 scale takes about 1/4 of the work
+DECODE_FLAGS = {
+	("color", 1): cv2.IMREAD_COLOR,
+	("color", 2): cv2.IMREAD_REDUCED_COLOR_2,
+	("color", 4): cv2.IMREAD_REDUCED_COLOR_4,
+	("color", 8): cv2.IMREAD_REDUCED_COLOR_8,
+	("gray", 1): cv2.IMREAD_GRAYSCALE,
+	("gray", 2): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+	("gray", 4): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+	("gray", 8): cv2.IMREAD_REDUCED_GRAYSCALE_8
+}
+
+def decodeImage(uri, mode="color", scale=1):
 	'''
 	Decodes an image from a base64 string
 
 	Arguments:
 		uri: the string to decode
+		mode: (optional) "color" for a BGR image or "gray" for a grayscale image
+		scale: (optional) how much smaller than the original to decode the image (1, 2, 4, or 8)
 	
 	Returns:
 		The decoded image
 	'''
-	nparr = np.fromstring(uri, np.uint8)
-	img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+	if (mode, scale) not in DECODE_FLAGS:
+		raise ValueError("Images can not be decoded in {} mode at 1/{} scale".format(mode, scale))
+
+	nparr = np.frombuffer(uri, np.uint8)
+	img = cv2.imdecode(nparr, DECODE_FLAGS[(mode, scale)])
 	return img
 
+class FrameCache():
+	'''
+	Keeps the most recently decoded frames, keyed by the timestamp of the frame (and how it was decoded)
+	'''
+	def __init__(self, maxFrames=4):
+		'''
+		Arguments:
+			maxFrames: (optional) The number of decoded frames to keep
+		'''
+		self.maxFrames = maxFrames
+		self.frames = OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, key):
+		'''
+		Returns the decoded frame for a key, or None if it is not cached
+		'''
+		with self.lock:
+			if key not in self.frames:
+				return None
+			self.frames.move_to_end(key)
+			return self.frames[key]
+
+	def put(self, key, img):
+		with self.lock:
+			self.frames[key] = img
+			self.frames.move_to_end(key)
+			# Throw out the least recently used frames
+			while len(self.frames) > self.maxFrames:
+				self.frames.popitem(last=False)
+
+# Frames decoded by every LazyFrame that does not have its own cache
+decodedFrames = FrameCache()
+
+class LazyFrame():
+	'''
+	An encoded camera frame that is only decoded when its pixels are needed
+	Each frame is decoded at most once for each mode and scale, the result is stored in a FrameCache
+	'''
+	def __init__(self, jpg, timestamp, cache=decodedFrames):
+		'''
+		Arguments:
+			jpg: The encoded frame
+			timestamp: The time the frame was taken, this is what the decoded frame is cached by
+			cache: (optional) The cache to store the decoded frame in
+		'''
+		self.jpg = jpg
+		self.timestamp = timestamp
+		self.cache = cache
+
+	def __bool__(self):
+		return len(self.jpg) > 0
+
+	def decode(self, mode="color", scale=1):
+		'''
+		Returns the decoded frame, decoding it if it has not been decoded yet
+
+		Arguments:
+			mode: (optional) "color" or "gray" (see decodeImage)
+			scale: (optional) how much smaller than the original to decode the frame (see decodeImage)
+		'''
+		key = (self.timestamp, mode, scale)
+		img = self.cache.get(key)
+		if img is None:
+			img = decodeImage(self.jpg, mode, scale)
+			self.cache.put(key, img)
+		return img
+
 def clearQueue(qToClear, debug=False):
 	'''
 	Clears all the data out of a queue
@@ -179,3 +725,325 @@ def clearQueue(qToClear, debug=False):
 			print(qToClear.get())
 		else:
 			qToClear.get()
+
+
+### MESSAGE BUS ###
+
+class Subscription():
+	'''
+	A bounded queue of packets from one or more message bus topics
+	It can be read like a normal Queue
+	'''
+	def __init__(self, bus, topics, maxsize, policy, blockTimeout):
+		if policy not in (LATEST_ONLY, DROP_OLDEST, BLOCK):
+			raise ValueError("Unknown drop policy {}".format(policy))
+
+		self.bus = bus
+		self.topics = list(topics)
+		self.policy = policy
+		self.blockTimeout = blockTimeout
+		self.queue = Queue(1 if policy == LATEST_ONLY else maxsize)
+		self.delivered = 0
+		self.dropped = 0
+
+	def put(self, pckt):
+		'''
+		Adds a packet to the queue following the drop policy
+
+		Returns:
+			Whether the new packet was added
+		'''
+		if self.policy == BLOCK:
+			try:
+				self.queue.put(pckt, timeout=self.blockTimeout)
+			except Full:
+				self.dropped += 1
+				return False
+		else:
+			while True:
+				try:
+					self.queue.put_nowait(pckt)
+					break
+				except Full:
+					# Throw out the oldest packet to make room
+					try:
+						self.queue.get_nowait()
+						self.dropped += 1
+					except Empty:
+						pass
+		self.delivered += 1
+		return True
+
+	def get(self, block=True, timeout=None):
+		return self.queue.get(block, timeout)
+
+	def get_nowait(self):
+		return self.queue.get_nowait()
+
+	def empty(self):
+		return self.queue.empty()
+
+	def qsize(self):
+		return self.queue.qsize()
+
+	def unsubscribe(self):
+		self.bus.unsubscribe(self)
+
+class CallbackSubscription(Subscription):
+	'''
+	A subscription that passes each packet to a function instead of queueing it
+	'''
+	def __init__(self, bus, topics, callback):
+		self.bus = bus
+		self.topics = list(topics)
+		self.callback = callback
+		self.delivered = 0
+		self.dropped = 0
+
+	def put(self, pckt):
+		self.callback(pckt)
+		self.delivered += 1
+		return True
+
+	def get(self, block=True, timeout=None):
+		raise TypeError("Callback subscriptions can not be read")
+
+	def get_nowait(self):
+		raise TypeError("Callback subscriptions can not be read")
+
+	def empty(self):
+		return True
+
+	def qsize(self):
+		return 0
+
+class MessageBus():
+	'''
+	Sends packets to every thread that has subscribed to their topic
+
+	The topic of a packet is its tag. Packets are also sent to the [tag]/[metadata] topic,
+	so threads can subscribe to a single stream, like cam/mainCam
+	'''
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.topics = {}
+		self.subscribers = {}
+		self.unknown = 0
+
+	def addTopic(self, name, dataType=object):
+		'''
+		Adds a topic to the bus
+
+		Arguments:
+			name: The name of the topic (the tag of its packets)
+			dataType: (optional) The type(s) the data of each packet must be, other packets are rejected
+		'''
+		with self.lock:
+			self.topics[name] = {
+				"dataType": dataType,
+				"published": 0,
+				"delivered": 0,
+				"dropped": 0,
+				"rejected": 0
+			}
+
+	def subscribe(self, topics, maxsize=1, policy=LATEST_ONLY, blockTimeout=None, subscriptionType=None):
+		'''
+		Creates a new subscription to one or more topics
+
+		Arguments:
+			topics: The topics to subscribe to
+			maxsize: (optional) The maximum number of packets that can wait in the queue
+			policy: (optional) What to do when the queue is full (LATEST_ONLY, DROP_OLDEST, BLOCK)
+			blockTimeout: (optional) How long a publisher waits when the policy is BLOCK, forever if None
+			subscriptionType: (optional) The class of the subscription (see AsyncUtils.AsyncSubscription)
+
+		Returns:
+			The subscription
+		'''
+		return self.addSubscription((subscriptionType or Subscription)(self, topics, maxsize, policy, blockTimeout))
+
+	def subscribeCallback(self, topics, callback):
+		'''
+		Calls a function with every packet published to one or more topics
+		The function is run on the publisher's thread, so it should return quickly
+
+		Arguments:
+			topics: The topics to subscribe to
+			callback: The function to call with each packet
+
+		Returns:
+			The subscription
+		'''
+		return self.addSubscription(CallbackSubscription(self, topics, callback))
+
+	def addSubscription(self, subscription):
+		with self.lock:
+			for topic in subscription.topics:
+				if topic.split("/")[0] not in self.topics:
+					raise KeyError("There is no topic {}".format(topic))
+			for topic in subscription.topics:
+				# The lists are replaced instead of changed, so publish never needs to lock them
+				self.subscribers[topic] = self.subscribers.get(topic, ()) + (subscription,)
+		return subscription
+
+	def unsubscribe(self, subscription):
+		'''
+		Stops sending packets to a subscription
+		'''
+		with self.lock:
+			for topic in subscription.topics:
+				self.subscribers[topic] = tuple(s for s in self.subscribers.get(topic, ()) if s is not subscription)
+
+	def publish(self, pckt):
+		'''
+		Sends a packet to all of the subscribers of its topic
+
+		Returns:
+			The number of subscribers the packet was delivered to
+		'''
+		stats = self.topics.get(pckt["tag"])
+		if stats is None:
+			self.unknown += 1
+			return 0
+		if not isinstance(pckt["data"], stats["dataType"]):
+			with self.lock:
+				stats["rejected"] += 1
+			return 0
+
+		subscribers = self.subscribers.get(pckt["tag"], ())
+		if isinstance(pckt["metadata"], str) and pckt["metadata"]:
+			subscribers = subscribers + self.subscribers.get(pckt["tag"]+"/"+pckt["metadata"], ())
+
+		delivered = 0
+		dropped = 0
+		for subscription in subscribers:
+			droppedBefore = subscription.dropped
+			if subscription.put(pckt):
+				delivered += 1
+			dropped += subscription.dropped - droppedBefore
+
+		with self.lock:
+			stats["published"] += 1
+			stats["delivered"] += delivered
+			stats["dropped"] += dropped
+		return delivered
+
+	def topicStats(self):
+		'''
+		Returns the packet counters for every topic
+		'''
+		stats = {name: {key: value for key, value in topic.items() if key != "dataType"} for name, topic in self.topics.items()}
+		stats["unknown"] = self.unknown
+		return stats
+
+### VIDEO STREAMING ###
+
+# Each frame of an MJPEG stream is a part of a multipart HTTP response
+MJPEG_BOUNDARY = b"frame"
+MJPEG_TRAILER = b"\r\n"
+
+class FrameBroadcaster():
+	'''
+	Keeps the newest JPEG of each camera and streams it to any number of clients
+
+	Every client has its own cursor (the last frame it was sent), so clients never take frames from each other.
+	A slow client just skips to the newest frame instead of falling behind.
+	The JPEG bytes are never copied or re-encoded, every client is sent the same bytes object.
+	'''
+	def __init__(self, statsWindow=1.0):
+		'''
+		Arguments:
+			statsWindow: (optional) How many seconds the client fps and bytes/s are averaged over
+		'''
+		self.condition = threading.Condition()
+		self.frames = {}
+		self.clients = {}
+		self.nextClientId = 0
+		self.statsWindow = statsWindow
+
+	def publish(self, camName, jpg):
+		'''
+		Replaces the newest frame of a camera and wakes up its clients
+
+		Arguments:
+			camName: The name of the camera
+			jpg: The JPEG encoded frame
+		'''
+		# Some sources (like zmq frames) only support the buffer protocol, they are converted once here instead of for each client
+		if not isinstance(jpg, bytes):
+			jpg = bytes(jpg)
+
+		with self.condition:
+			sequence = self.frames[camName][0]+1 if camName in self.frames else 1
+			self.frames[camName] = (sequence, jpg)
+			self.condition.notify_all()
+
+	def stream(self, camName, timeout=1.0):
+		'''
+		Yields the parts of an MJPEG stream of a camera, for a Flask Response with the multipart/x-mixed-replace mimetype
+
+		Arguments:
+			camName: The name of the camera to stream
+			timeout: (optional) How long to wait for a new frame before checking again
+		'''
+		with self.condition:
+			clientId = self.nextClientId
+			self.nextClientId += 1
+			stats = {
+				"camName": camName,
+				"frames": 0,
+				"bytes": 0,
+				"skipped": 0,
+				"fps": 0.0,
+				"bytesPerSecond": 0.0,
+				"windowStart": time.time(),
+				"windowFrames": 0,
+				"windowBytes": 0
+			}
+			self.clients[clientId] = stats
+
+		cursor = 0
+		try:
+			while True:
+				with self.condition:
+					if not self.condition.wait_for(lambda: self.frames.get(camName, (0,))[0] > cursor, timeout):
+						continue
+					sequence, jpg = self.frames[camName]
+
+				# Any frames between the cursor and the newest one were skipped
+				if cursor:
+					stats["skipped"] += sequence-cursor-1
+				cursor = sequence
+
+				# The parts are yielded separately, so the JPEG is never copied into a larger message
+				yield b"--"+MJPEG_BOUNDARY+b"\r\nContent-Type: image/jpeg\r\nContent-Length: "+str(len(jpg)).encode()+b"\r\n\r\n"
+				yield jpg
+				yield MJPEG_TRAILER
+
+				self.updateStats(stats, len(jpg))
+		finally:
+			with self.condition:
+				del self.clients[clientId]
+
+	def updateStats(self, stats, numBytes):
+		stats["frames"] += 1
+		stats["bytes"] += numBytes
+		stats["windowFrames"] += 1
+		stats["windowBytes"] += numBytes
+
+		elapsed = time.time()-stats["windowStart"]
+		if elapsed >= self.statsWindow:
+			stats["fps"] = stats["windowFrames"]/elapsed
+			stats["bytesPerSecond"] = stats["windowBytes"]/elapsed
+			stats["windowStart"] = time.time()
+			stats["windowFrames"] = 0
+			stats["windowBytes"] = 0
+
+	def clientStats(self):
+		'''
+		Returns the stats of every connected client (camera, fps, bytes/s, and totals)
+		'''
+		with self.condition:
+			return {clientId: {key: value for key, value in stats.items() if not key.startswith("window")}
+					for clientId, stats in self.clients.items()}
@@ -3,18 +3,51 @@ This file has computer vision tools for line following and coral reef health
 All of the code is taken from their respective files in Testing/
 '''
 
+import io
+import os
+import time
+import hashlib
+import logging
+import itertools
+import threading
+import multiprocessing
+from queue import Queue, Full
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+# Shared memory needs Python 3.8, without it frames are copied to the CV workers
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
 import cv2
 import numpy as np
 
+logger = logging.getLogger(__name__)
+
 ### LINE FOLLOWING CODE ###
 
 # Line Following Settings
 lf_lower_blue = np.array([70,119,87])
 lf_upper_blue = np.array([109,255,225])
 lf_kernel = np.ones((3,3), np.uint8)
+# How many times lf_kernel is used to clean up the mask (erode, then dilate, then erode)
+lf_morphology_iterations = (1, 15, 9)
 lf_min_countour_area = 7000.0
 lf_percent_of_image_blue_lines_should_fill = 0.75 # Equal to (total_width - blue_to_red_dist) / total_width
 lf_target_angle = 90.0
+# The color and alpha the mask is drawn over the image with in the "Overlay" debug level
+lf_overlay_color = (0, 255, 0)
+lf_overlay_alpha = 0.4
+
+# How much smaller than the camera frame the image used for line following is decoded (1, 2, 4, or 8)
+#  * Decoding at 1/2 scale takes about a quarter of the time, and the lines are large enough to still be found
+lf_decode_scale = 2
+
+# How far past the lines from the last frame the line tracker searches, in camera frame pixels
+#  * It has to be more than the lines move between frames, and more than the size of the filtering kernels
+lf_track_margin = 80
 
 def point_slope_line(pt,sl,num,given_axis):
     '''
@@ -38,29 +71,93 @@ def point_slope_line(pt,sl,num,given_axis):
     elif given_axis == "y":
         return (int((num-pt[1])/sl + pt[0]), num)
 
-def detectLines(img, cvOutLevel=None):
+# Kernels for each scale, see lineFollowingKernels
+lf_kernels = {}
+
+def lineFollowingKernels(scale=1):
     '''
-    Detects two parallel lines in an image, and gets the distance between them and average angle
+    Gets the kernels used to clean up the line following mask
+
+    Running a 3x3 rectangle n times is the same as running a (2n+1)x(2n+1) rectangle once,
+    so each step is done in one pass (OpenCV filters rectangles by rows and then columns)
 
     Arguments:
-        img: The image to detect lines in
-        cvOutLevel: What level of debugging to output ("Base", "Mask", "Contours")
+        scale: (optional) How much smaller than the camera frame the mask is, the number of iterations is scaled to match
+
+    Returns:
+        The erode, dilate, and erode kernels
+    '''
+    if scale not in lf_kernels:
+        kernels = []
+        for iterations in lf_morphology_iterations:
+            if iterations > 1:
+                iterations = max(1, int(round(iterations/scale)))
+            size = iterations*(lf_kernel.shape[0]-1) + 1
+            kernels.append(cv2.getStructuringElement(cv2.MORPH_RECT, (size, size)))
+        lf_kernels[scale] = kernels
+    return lf_kernels[scale]
+
+def maskLines(img, scale=1):
+    '''
+    Finds the blue of the lines in an image and cleans up the mask
+
+    Arguments:
+        img: The image to find the lines in
+        scale: (optional) How much smaller img is than the camera frame (see lf_decode_scale)
+
+    Returns:
+        The filtered mask
     '''
     hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
     mask = cv2.inRange(hsv, lf_lower_blue, lf_upper_blue)
 
-    filtered = cv2.erode(mask, lf_kernel, iterations=1)
-    filtered = cv2.dilate(filtered, lf_kernel, iterations=15)
-    filtered = cv2.erode(filtered, lf_kernel, iterations=9)
+    erodeKernel, dilateKernel, closeKernel = lineFollowingKernels(scale)
+    filtered = cv2.erode(mask, erodeKernel)
+    filtered = cv2.dilate(filtered, dilateKernel)
+    filtered = cv2.erode(filtered, closeKernel)
+    return filtered
+
+def detectLines(img, cvOutLevel=None, scale=1):
+    '''
+    Detects two parallel lines in an image, and gets the distance between them and average angle
+
+    Arguments:
+        img: The image to detect lines in
+        cvOutLevel: What level of debugging to output ("Base", "Mask", "Contours", "Overlay")
+        scale: (optional) How much smaller img is than the camera frame (see lf_decode_scale)
+            The filtering and contour sizes are scaled to match, and the distance is returned in camera frame pixels
+    '''
+    filtered = maskLines(img, scale)
+    # Only the outside of each line is used, so there is no need to build the full hierarchy
+    contours, _ = cv2.findContours(filtered, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return measureLines(img, filtered, contours, cvOutLevel, scale)
+
+def measureLines(img, filtered, contours, cvOutLevel=None, scale=1):
+    '''
+    Fits lines to the contours of a line following mask, and gets the distance between them and average angle
+
+    Arguments:
+        img: The image the lines were detected in
+        filtered: The mask the contours were found in (the same size as img)
+        contours: The contours of the lines
+        cvOutLevel: What level of debugging to output ("Base", "Mask", "Contours", "Overlay")
+        scale: (optional) How much smaller img is than the camera frame (see lf_decode_scale)
+    '''
+    # The debug drawing is done on a copy, img can be a cached frame that is used again (see LazyFrame.decode)
+    if cvOutLevel in ("Base", "Overlay", "Contours"):
+        img = img.copy()
 
-    contours, hierarchy = cv2.findContours(filtered, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    if cvOutLevel == "Overlay":
+        # Tint the parts of the image that are in the mask, the lines are drawn on top of it
+        overlay_image_alpha(img, np.full_like(img, lf_overlay_color), (0, 0),
+                            cv2.convertScaleAbs(filtered, alpha=lf_overlay_alpha), out=img)
 
     # This will contain points on each line in the format: start, end, middle, and slope
     lines = []
 
     if len(contours) >= 2:
         for contour in contours:
-            if cv2.contourArea(contour) > lf_min_countour_area:
+            if cv2.contourArea(contour) > lf_min_countour_area/(scale*scale):
                 # Fit a line to the contour
                 vx,vy,x,y = cv2.fitLine(contour, cv2.DIST_L2,0,0.01,0.01)
                 vx,vy,x,y = vx[0],vy[0],x[0],y[0]
@@ -71,18 +168,18 @@ def detectLines(img, cvOutLevel=None):
                 line_top = point_slope_line((x,y),slope,0,"y")
                 line_bottom = point_slope_line((x,y), slope, height, "y")
 
-                if cvOutLevel == "Base":
+                if cvOutLevel in ("Base", "Overlay"):
                     # Draw the line on the image
                     cv2.line(img, line_top, line_bottom, (0,0,0) ,5)
                     # Draw the center on the image
-                    cv2.line(img,(x,y),(x,y),(0,255,0),10)
+                    cv2.line(img,(int(x),int(y)),(int(x),int(y)),(0,255,0),10)
 
                 # Append the start, end, middle, and slope of each line to the array
                 lines.append([np.array(line_top), np.array(line_bottom), np.array([x,y]), slope])
         
         if len(lines) >= 2:
-            # Find the distance between the centers of both lines
-            line_dist = np.linalg.norm(lines[0][2]-lines[1][2])
+            # Find the distance between the centers of both lines (in camera frame pixels)
+            line_dist = np.linalg.norm(lines[0][2]-lines[1][2])*scale
 
             # Calculate the angle of each line based on it's slope
             line_a_angle = np.degrees(np.arctan(lines[0][3]))
@@ -99,7 +196,7 @@ def detectLines(img, cvOutLevel=None):
 
             # This function will be called on a streaming video, so each run only one debug image needs to be returned
             if cvOutLevel:
-                if cvOutLevel == "Base":
+                if cvOutLevel in ("Base", "Overlay"):
                     return line_dist, avg_angle-lf_target_angle, img
                 elif cvOutLevel == "Mask":
                     return line_dist, avg_angle-lf_target_angle, filtered
@@ -109,6 +206,263 @@ def detectLines(img, cvOutLevel=None):
                 return line_dist, avg_angle-lf_target_angle
     return None
 
+class LineTracker():
+    '''
+    Follows the lines from frame to frame, so most frames only a band around them has to be processed
+
+    The first frame (and any frame after the lines are lost) is searched in full, like detectLines
+    After that, only the area where the lines are expected to be (where they were last frame, moved as much as
+    they moved last frame, plus lf_track_margin) is converted to HSV, filtered, and searched
+    '''
+    def __init__(self, scale=1, margin=lf_track_margin):
+        '''
+        Arguments:
+            scale: (optional) How much smaller the images are than the camera frame (see lf_decode_scale)
+            margin: (optional) How far past the expected lines to search, in camera frame pixels
+        '''
+        self.scale = scale
+        self.margin = margin
+        self.stats = {
+            "frames": 0,
+            "fullSearches": 0,
+            "lost": 0,
+            "lastTime": 0,
+            "avgTime": 0,
+            "maxTime": 0,
+            "searchedFraction": 1
+        }
+        self.reset()
+
+    def reset(self):
+        '''
+        Forgets where the lines were, so the next frame is searched in full
+        '''
+        self.region = None
+        self.lastRegion = None
+
+    def track(self, img, cvOutLevel=None):
+        '''
+        Detects the lines in the next frame
+
+        Arguments:
+            img: The image to detect lines in
+            cvOutLevel: What level of debugging to output ("Base", "Mask", "Contours", "Overlay")
+
+        Returns:
+            The same as detectLines
+        '''
+        start = time.perf_counter()
+
+        result = None
+        searched = 1
+        if self.region is not None:
+            result, searched = self.search(img, self.predictRegion(img.shape), cvOutLevel)
+            if result is None:
+                # The lines left the band, look everywhere for them
+                self.stats["lost"] += 1
+                self.reset()
+        if result is None:
+            self.stats["fullSearches"] += 1
+            result, searched = self.search(img, None, cvOutLevel)
+
+        # Keep track of how long each frame takes
+        frameTime = time.perf_counter() - start
+        self.stats["frames"] += 1
+        self.stats["lastTime"] = frameTime
+        self.stats["avgTime"] += (frameTime - self.stats["avgTime"]) / self.stats["frames"]
+        self.stats["maxTime"] = max(self.stats["maxTime"], frameTime)
+        self.stats["searchedFraction"] = searched
+        return result
+
+    def predictRegion(self, shape):
+        '''
+        Gets the area the lines should be in this frame, as (x1, y1, x2, y2) clipped to the image
+        '''
+        x1, y1, x2, y2 = self.region
+        if self.lastRegion is not None:
+            # Assume the lines keep moving the way they moved last frame
+            dx = (x1 + x2 - self.lastRegion[0] - self.lastRegion[2]) // 2
+            dy = (y1 + y2 - self.lastRegion[1] - self.lastRegion[3]) // 2
+            x1, x2, y1, y2 = x1 + dx, x2 + dx, y1 + dy, y2 + dy
+
+        margin = int(self.margin / self.scale)
+        return (max(0, x1 - margin), max(0, y1 - margin),
+                min(shape[1], x2 + margin), min(shape[0], y2 + margin))
+
+    def search(self, img, region, cvOutLevel):
+        '''
+        Detects the lines in part of an image (or all of it if region is None)
+
+        Returns:
+            The result of measureLines
+            The fraction of the image that was searched
+        '''
+        if region is None:
+            region = (0, 0, img.shape[1], img.shape[0])
+        x1, y1, x2, y2 = region
+        if x2 - x1 < 3 or y2 - y1 < 3:
+            return None, 0
+
+        filtered = maskLines(img[y1:y2, x1:x2], self.scale)
+        # The contours are moved back into the coordinates of the full image
+        contours, _ = cv2.findContours(filtered, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(x1, y1))
+
+        if cvOutLevel in ("Mask", "Overlay") and filtered.shape != img.shape[:2]:
+            # The debug mask is always the size of the full image
+            fullMask = np.zeros(img.shape[:2], np.uint8)
+            fullMask[y1:y2, x1:x2] = filtered
+            filtered = fullMask
+
+        result = measureLines(img, filtered, contours, cvOutLevel, self.scale)
+
+        if result is not None:
+            # Search around the lines that were used next frame
+            lines = [contour for contour in contours if cv2.contourArea(contour) > lf_min_countour_area/(self.scale*self.scale)]
+            x, y, w, h = cv2.boundingRect(np.concatenate(lines))
+            self.lastRegion = self.region
+            self.region = (x, y, x + w, y + h)
+
+        return result, (x2 - x1)*(y2 - y1) / (img.shape[0]*img.shape[1])
+
+### DEBUG IMAGES ###
+
+# The file extension and mimetype of each debug image format
+#  * "npy" is the raw array (np.save), it takes no time to encode but is the largest
+debug_image_formats = {
+    "png": (".png", "image/png"),
+    "jpg": (".jpg", "image/jpeg"),
+    "npy": (".npy", "application/octet-stream")
+}
+
+# The default compression of each format, PNG compression is 0-9 (1 is fast), JPEG quality is 0-100
+debug_image_compression = {
+    "png": 1,
+    "jpg": 90
+}
+
+class DebugImageSink():
+    '''
+    Collects the debug images of a computer vision task without making the task wait for them to be compressed
+
+    save() only puts the image in a queue, a background thread encodes it (and writes it to disk, if there is a path)
+    The encoded images are kept in memory, so they can be served without touching the disk:
+        sink = DebugImageSink(format="jpg", level=1)
+        sink.save("final", img, level=0)
+        images = sink.close()
+    '''
+    def __init__(self, path=None, format="png", compression=None, level=2, maxsize=8):
+        '''
+        Arguments:
+            path: (optional) A folder to also write the images to, if it is None they are only kept in memory
+            format: (optional) How to encode the images, a key of debug_image_formats
+            compression: (optional) The PNG compression or JPEG quality, see debug_image_compression for the defaults
+            level: (optional) The highest level of image to keep (0 is the most important), None keeps nothing
+            maxsize: (optional) The maximum number of images that can wait to be encoded, save() waits after that
+        '''
+        if format not in debug_image_formats:
+            raise ValueError("Unknown debug image format {}".format(format))
+
+        self.path = path
+        self.format = format
+        self.compression = compression if compression is not None else debug_image_compression.get(format)
+        self.level = level
+        self.images = {}
+        # Images that could not be encoded or written are skipped, the rest are still kept
+        self.stats = {"written": 0, "errors": 0, "dropped": 0, "lastError": None}
+
+        self.queue = Queue(maxsize)
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    def wants(self, level):
+        '''
+        Checks if images of a level are kept, so images that are not can be skipped before they are made
+        '''
+        return self.level is not None and level <= self.level
+
+    def save(self, name, img, level=0):
+        '''
+        Adds an image, it should not be changed after this until the sink is closed
+
+        Arguments:
+            name: The name of the image
+            img: The image
+            level: (optional) How important the image is (0 is the most important)
+        '''
+        if self.wants(level):
+            # If the writer has stopped, the image is dropped instead of waiting on a queue that never empties
+            while self.thread and self.thread.is_alive():
+                try:
+                    self.queue.put((name, img), timeout=1)
+                    return
+                except Full:
+                    pass
+            self.stats["dropped"] += 1
+
+    def close(self):
+        '''
+        Waits for every image to be encoded
+
+        Returns:
+            A dict of the images by name, each one is a dict with:
+                mimetype: The mimetype of data
+                data: The encoded image
+                path: Where the image was written, or None
+        '''
+        if self.thread:
+            while self.thread.is_alive():
+                try:
+                    self.queue.put(None, timeout=1)
+                    break
+                except Full:
+                    pass
+            self.thread.join()
+            self.thread = None
+        return self.images
+
+    def encode(self, img):
+        if self.format == "npy":
+            buffer = io.BytesIO()
+            np.save(buffer, img)
+            return buffer.getvalue()
+
+        params = []
+        if self.format == "png":
+            params = [cv2.IMWRITE_PNG_COMPRESSION, self.compression]
+        elif self.format == "jpg":
+            params = [cv2.IMWRITE_JPEG_QUALITY, self.compression]
+        success, data = cv2.imencode(debug_image_formats[self.format][0], img, params)
+        if not success:
+            raise ValueError("Could not encode the image as {}".format(self.format))
+        return data.tobytes()
+
+    def write(self):
+        extension, mimetype = debug_image_formats[self.format]
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            name, img = item
+
+            try:
+                data = self.encode(img)
+                path = None
+                if self.path:
+                    path = os.path.join(self.path, name+extension)
+                    with open(path, "wb") as imageFile:
+                        imageFile.write(data)
+            except Exception as err:
+                self.stats["errors"] += 1
+                self.stats["lastError"] = repr(err)
+                logger.warning("Could not save the debug image %s: %r", name, err)
+                continue
+            self.images[name] = {
+                "mimetype": mimetype,
+                "data": data,
+                "path": path
+            }
+            self.stats["written"] += 1
+
 ### CORAL HEALTH CODE ###
 
 # Coral Health Settings
@@ -155,6 +509,9 @@ changes =  {
     }
 }
 
+# Each kind of change gets its own bit in the label map made by classifyChanges
+change_labels = {key: 1 << i for i, key in enumerate(changes)}
+
 background_mask = {
     "bleached": {
         "lower": (73, 0, 133),
@@ -169,6 +526,18 @@ background_mask = {
 # Image alignment settings
 max_features = 10000
 good_match_percent = 0.15
+# How much smaller than the full images features are detected at (1 is full resolution)
+align_scale = 1
+# Spreads the features out by keeping the strongest ones in each cell of a (columns, rows) grid, None keeps the strongest overall
+feature_grid = None
+# How features are matched (see matchFeatures)
+#  * "bf": Brute force, the best good_match_percent of the matches are kept (the same result every run)
+#  * "bf-knn": Brute force 2 nearest neighbors, with a ratio test
+#  * "flann-lsh": Approximate 2 nearest neighbors with a FLANN LSH index, with a ratio test
+#    It is the fastest by far with many features, but its hash tables are random, so the boxes can change slightly between runs
+align_matcher = "bf"
+# The ratio test keeps a match if it is closer than match_ratio times the second best match
+match_ratio = 0.75
 
 # Image size settings
 width = 1920
@@ -177,32 +546,56 @@ height = 1080
 # Image subtraction/blur settings
 blurKSize = (5,5)
 blurAmmount = 10
+# Added to the difference so negative differences can be seen, the change filters are tuned for 64
+subtraction_offset = 64
 
 # Image countouring settings
 min_countour_area = 2000.0
 
+# Where the work done on reference images is saved, so it only has to be done once per image
+reference_cache_path = "cache/coralReference/"
+
 # Mask smoothing kernel
 kernel = np.ones((9,9))
 
 # Box expansion amount
 expand_amount = 10
 
+# How important each debug image of the coral health analysis is (0 is the most important, see DebugImageSink)
+coral_debug_levels = {
+    "final": 0,
+    "alignment": 1,
+    "subtraction": 1,
+    "input": 2,
+    "background_mask": 2,
+    "features": 2
+}
+
 # Coral Health Helper functions
 
-def overlay_image_alpha(img, img_overlay, pos, alpha_mask):
+def overlay_image_alpha(img, img_overlay, pos, alpha_mask, out=None):
     '''
     Overlay one image ontop of another given an imput transparency mask
 
+    All of the channels are blended at once by OpenCV
+
     Arguments:
         img: The base image
-        img_overlay: The image to overlay (should be smaller than img)
+        img_overlay: The image to overlay (should be smaller than img, with the same number of channels)
         pos: the location of to overlay img_overlay
-        alpha_mask: the alpha of the overlay images
+        alpha_mask: the alpha of the overlay image, either:
+            A number from 0 to 1 for the whole overlay
+            An array the size of img_overlay, with floats from 0 to 1 or uint8s from 0 to 255
+        out: (optional) The image to write the result to, the same size and type as img (it can be img itself)
+            If it is not given, a copy of img is made
 
     Returns:
-        The new image with the overlay appled
+        The new image with the overlay appled (out, if it was given)
     '''
-    img = img.copy()
+    if out is None:
+        out = img.copy()
+    elif out is not img:
+        np.copyto(out, img)
 
     x, y = pos
 
@@ -214,21 +607,106 @@ def overlay_image_alpha(img, img_overlay, pos, alpha_mask):
     y1o, y2o = max(0, -y), min(img_overlay.shape[0], img.shape[0] - y)
     x1o, x2o = max(0, -x), min(img_overlay.shape[1], img.shape[1] - x)
 
-    # Exit if nothing to do
+    # Nothing to do if the overlay is completely off of the image
     if y1 >= y2 or x1 >= x2 or y1o >= y2o or x1o >= x2o:
-        return
+        return out
+
+    region = out[y1:y2, x1:x2]
+    overlay = img_overlay[y1o:y2o, x1o:x2o]
+
+    if np.isscalar(alpha_mask):
+        # The same alpha everywhere is a single weighted sum
+        cv2.addWeighted(overlay, alpha_mask, region, 1.0 - alpha_mask, 0, dst=region)
+    else:
+        alpha = alpha_mask[y1o:y2o, x1o:x2o]
+        if alpha.dtype == np.uint8:
+            alpha = alpha.astype(np.float32) / 255
+        else:
+            alpha = alpha.astype(np.float32, copy=False)
+        region[:] = cv2.blendLinear(overlay, region, alpha, 1.0 - alpha)
+    return out
+
+def detectFeatures(img, mask=None, scale=align_scale):
+    '''
+    Detects ORB features in an image
 
-    channels = img.shape[2]
+    Arguments:
+        img: The image to detect features in
+        mask: (optional) A mask to specifiy what parts of img features can be in
+        scale: (optional) How much smaller than the full image to detect features at
+            The keypoints are for the shrunk image
+
+    Returns:
+        The shrunk image (or img, if the scale is 1)
+        The keypoints
+        The descriptors
+    '''
+    if scale != 1:
+        img = cv2.resize(img, None, fx=1.0/scale, fy=1.0/scale, interpolation=cv2.INTER_AREA)
+        if mask is not None:
+            mask = cv2.resize(mask, (img.shape[1], img.shape[0]), interpolation=cv2.INTER_NEAREST)
 
-    alpha = alpha_mask #This allows alpha_mask to be a full image [y1o:y2o, x1o:x2o]
-    alpha_inv = 1.0 - alpha
+    # Detect ORB features and compute descriptors.
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if feature_grid is None:
+        detector = cv2.ORB_create(max_features)
+        keypoints, descriptors = detector.detectAndCompute(gray, mask=mask)
+        return img, keypoints, descriptors
+
+    # Detect extra keypoints, then only keep the strongest in each cell of the grid
+    #  * Descriptors are only computed for the keypoints that are kept
+    columns, rows = feature_grid
+    detector = cv2.ORB_create(max_features*2)
+    keypoints = detector.detect(gray, mask=mask)
+    if keypoints:
+        points = cv2.KeyPoint_convert(keypoints)
+        cells = (np.minimum(points[:, 1]*rows//gray.shape[0], rows-1)*columns +
+                 np.minimum(points[:, 0]*columns//gray.shape[1], columns-1)).astype(np.int32)
+        responses = np.array([keypoint.response for keypoint in keypoints])
+        # Sort by cell, then by strength (strongest first), and keep the first few of each cell
+        order = np.lexsort((-responses, cells))
+        rank = np.arange(len(order)) - np.searchsorted(cells[order], cells[order])
+        keep = order[rank < max(1, max_features//(columns*rows))]
+        keypoints = [keypoints[i] for i in np.sort(keep)]
+    keypoints, descriptors = detector.compute(gray, keypoints)
+    return img, keypoints, descriptors
+
+def matchFeatures(descriptors1, descriptors2, matcher=align_matcher):
+    '''
+    Matches ORB descriptors, and throws out the matches that are likely wrong
 
-    for c in range(channels):
-        img[y1:y2, x1:x2, c] = (alpha * img_overlay[y1o:y2o, x1o:x2o, c] +
-                                alpha_inv * img[y1:y2, x1:x2, c])
-    return img
+    Arguments:
+        descriptors1: The descriptors to find matches for
+        descriptors2: The descriptors to match them to
+        matcher: (optional) How to match them (see align_matcher)
 
-def alignImages(reference, toAlign, toAlignMask):
+    Returns:
+        A list of the good matches (cv2.DMatch)
+    '''
+    if descriptors1 is None or descriptors2 is None:
+        return []
+
+    if matcher == "bf":
+        matches = cv2.BFMatcher(cv2.NORM_HAMMING).match(descriptors1, descriptors2)
+        # Keep the best matches
+        matches = sorted(matches, key=lambda x: x.distance)
+        return matches[:int(len(matches) * good_match_percent)]
+
+    if matcher == "bf-knn":
+        knnMatches = cv2.BFMatcher(cv2.NORM_HAMMING).knnMatch(descriptors1, descriptors2, k=2)
+    elif matcher == "flann-lsh":
+        # 6 is FLANN_INDEX_LSH, which works with binary descriptors like ORB
+        flann = cv2.FlannBasedMatcher(dict(algorithm=6, table_number=6, key_size=12, multi_probe_level=1), dict(checks=50))
+        knnMatches = flann.knnMatch(descriptors1, descriptors2, k=2)
+    else:
+        raise ValueError("Unknown matcher {}".format(matcher))
+
+    # A match is only good if it is clearly better than the next best one (Lowe's ratio test)
+    #  * LSH can find fewer than 2 neighbors, those matches are kept only if they found one
+    return [pair[0] for pair in knnMatches
+            if len(pair) == 1 or (len(pair) == 2 and pair[0].distance < match_ratio*pair[1].distance)]
+
+def alignImages(reference, toAlign, toAlignMask, scale=align_scale, referenceFeatures=None, matcher=align_matcher, drawMatches=True, timings=None):
     '''
     Aligns two images using ORB features
 
@@ -236,46 +714,56 @@ def alignImages(reference, toAlign, toAlignMask):
         reference: The reference image to align to
         toAlign: The image that is being aligned
         toAlignMask: A mask for toAlign to specifiy what parts of it should be used in alignment calculations
+        scale: (optional) How much smaller than the full images to detect features at
+            The homography is always for the full images
+        referenceFeatures: (optional) The result of detectFeatures(reference, scale=scale), if it is already known
+        matcher: (optional) How to match the features (see align_matcher)
+        drawMatches: (optional) Whether to draw the matches, if not the image is None
+        timings: (optional) A dict the number of seconds each stage takes is added to ("detect", "match", "homography", and "draw")
 
     Returns:
         An image with the matched features marked
         A homography matrix that can be used to align the images
     '''
-    # Convert images to grayscale
-    im1Gray = cv2.cvtColor(toAlign, cv2.COLOR_BGR2GRAY)
-    im2Gray = cv2.cvtColor(reference, cv2.COLOR_BGR2GRAY)
+    if timings is None:
+        timings = {}
+    start = time.perf_counter()
 
-    # Detect ORB features and compute descriptors.
-    detector = cv2.ORB_create(max_features)
-    keypoints1, descriptors1 = detector.detectAndCompute(im1Gray, mask=toAlignMask)
-    keypoints2, descriptors2 = detector.detectAndCompute(im2Gray, mask=None)
+    # Everything after this works on the shrunk images
+    toAlign, keypoints1, descriptors1 = detectFeatures(toAlign, toAlignMask, scale)
+    if referenceFeatures is None:
+        referenceFeatures = detectFeatures(reference, scale=scale)
+    reference, keypoints2, descriptors2 = referenceFeatures
+    timings["detect"] = time.perf_counter() - start
 
     # Match features.
-    matcher = cv2.DescriptorMatcher_create(cv2.DESCRIPTOR_MATCHER_BRUTEFORCE_HAMMING)
-    matches = matcher.match(descriptors1, descriptors2, None)
+    start = time.perf_counter()
+    matches = matchFeatures(descriptors1, descriptors2, matcher)
+    timings["match"] = time.perf_counter() - start
 
-    # Sort matches by score
-    matches.sort(key=lambda x: x.distance, reverse=False)
+    # A homography needs at least 4 points
+    if len(matches) < 4:
+        raise ValueError("Only {} features matched, at least 4 are needed to align the images".format(len(matches)))
 
-    # Remove not so good matches
-    numGoodMatches = int(len(matches) * good_match_percent)
-    matches = matches[:numGoodMatches]
+    # Extract location of good matches
+    start = time.perf_counter()
+    queryIdx = np.fromiter((match.queryIdx for match in matches), np.int32, len(matches))
+    trainIdx = np.fromiter((match.trainIdx for match in matches), np.int32, len(matches))
+    points1 = cv2.KeyPoint_convert(keypoints1)[queryIdx]
+    points2 = cv2.KeyPoint_convert(keypoints2)[trainIdx]
+
+    # Find homography (with the points scaled back up to the full images)
+    h, mask = cv2.findHomography(points1*scale, points2*scale, cv2.RANSAC)
+    timings["homography"] = time.perf_counter() - start
 
     # Draw top matches
-    imMatches = cv2.drawMatches(toAlign, keypoints1, reference, keypoints2, matches, None)
+    imMatches = None
+    if drawMatches:
+        start = time.perf_counter()
+        imMatches = cv2.drawMatches(toAlign, keypoints1, reference, keypoints2, matches, None)
+        timings["draw"] = time.perf_counter() - start
 
-    # Extract location of good matches
-    points1 = np.zeros((len(matches), 2), dtype=np.float32)
-    points2 = np.zeros((len(matches), 2), dtype=np.float32)
- 
-    for i, match in enumerate(matches):
-        points1[i, :] = keypoints1[match.queryIdx].pt
-        points2[i, :] = keypoints2[match.trainIdx].pt
-   
-    # Find homography
-    h, mask = cv2.findHomography(points1, points2, cv2.RANSAC)
-    
-    return imMatches, h 
+    return imMatches, h
 
 def HSVThreshold(img, lower, upper):
     '''
@@ -293,6 +781,94 @@ def HSVThreshold(img, lower, upper):
     mask = cv2.inRange(hsv, lower, upper)
     return mask
 
+def changeLUTs():
+    '''
+    Builds the lookup tables used by classifyChanges from the color filters in changes
+
+    Each color filter gets a bit, a pixel matches the filter if the bit is set in the table of all 3 of its channels
+
+    Returns:
+        A list of 3 tables (H, S, and V) that give the filter bits each value is in range of
+        A table that turns filter bits into change_labels bits
+    '''
+    filters = [(key, colorFilter) for key in changes for colorFilter in changes[key]["filters"]]
+    if len(filters) > 8:
+        raise ValueError("classifyChanges supports at most 8 color filters, there are {}".format(len(filters)))
+
+    values = np.arange(256)
+    channelTables = [np.zeros(256, np.uint8) for c in range(3)]
+    labelTable = np.zeros(256, np.uint8)
+    for bit, (key, colorFilter) in enumerate(filters):
+        for c in range(3):
+            inRange = (values >= colorFilter["lower"][c]) & (values <= colorFilter["upper"][c])
+            channelTables[c][inRange] |= 1 << bit
+        labelTable[(values & (1 << bit)) > 0] |= change_labels[key]
+    return channelTables, labelTable
+
+def classifyChanges(img):
+    '''
+    Labels every kind of change in an image at once
+
+    The image is only converted to HSV once, then every color filter is checked in a single lookup (see changeLUTs)
+
+    Arguments:
+        img: The BGR image to classify (the subtracted image)
+
+    Returns:
+        The label map, a uint8 image of change_labels bits (a pixel can be more than one kind of change)
+    '''
+    channelTables, labelTable = changeLUTs()
+    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+
+    # A filter matches where its bit is set for the hue, saturation, and value
+    channels = cv2.split(hsv)
+    matched = cv2.LUT(channels[0], channelTables[0])
+    for channel, table in zip(channels[1:], channelTables[1:]):
+        cv2.bitwise_and(matched, cv2.LUT(channel, table), dst=matched)
+    return cv2.LUT(matched, labelTable)
+
+def labelMask(labels, key):
+    '''
+    Gets the mask of one kind of change from a label map made by classifyChanges
+
+    Arguments:
+        labels: The label map
+        key: The kind of change (a key of changes)
+
+    Returns:
+        A mask that is 255 where the change is
+    '''
+    return cv2.compare(cv2.bitwise_and(labels, change_labels[key]), 0, cv2.CMP_GT)
+
+# Buffers reused by subtractImages, one set for each thread and image shape
+subtraction_buffers = threading.local()
+
+def subtractImages(reference_blurred, img):
+    '''
+    Blurs an image and subtracts it from a blurred reference image, so the differences can be color filtered
+
+    Each pixel is |reference - img + subtraction_offset| clipped to 0-255
+    The difference is done in int16, so it is exactly the same as doing it in floats, but much faster
+
+    Arguments:
+        reference_blurred: The reference image, already blurred with blurKSize and blurAmmount
+        img: The image to subtract, the same size as the reference
+
+    Returns:
+        The subtracted image, it is overwritten by the next call on the same thread
+    '''
+    if not hasattr(subtraction_buffers, "shapes"):
+        subtraction_buffers.shapes = {}
+    if img.shape not in subtraction_buffers.shapes:
+        subtraction_buffers.shapes[img.shape] = (np.empty(img.shape, np.uint8), np.empty(img.shape, np.int16), np.empty(img.shape, np.uint8))
+    blurred, difference, subtracted = subtraction_buffers.shapes[img.shape]
+
+    cv2.GaussianBlur(img, blurKSize, blurAmmount, dst=blurred)
+    cv2.subtract(reference_blurred, blurred, dst=difference, dtype=cv2.CV_16S)
+    # convertScaleAbs adds the offset, takes the absolute value, and saturates to uint8 in one pass
+    cv2.convertScaleAbs(difference, dst=subtracted, alpha=1, beta=subtraction_offset)
+    return subtracted
+
 def smoothImage(img, dilate, erode):
     '''
     Smoothes a mask using dilation and erosion (dilation is applied before erosion)
@@ -309,29 +885,197 @@ def smoothImage(img, dilate, erode):
     smoothed = cv2.erode(smoothed, kernel, erode)
     return smoothed
 
+class ReferenceImage():
+    '''
+    A reference image, with all of the work on it that does not depend on the image it is compared to
+    '''
+    def __init__(self, image, blurred, features):
+        self.image = image
+        self.blurred = blurred
+        # The result of detectFeatures
+        self.features = features
+
+class ReferenceCache():
+    '''
+    Keeps the work done on reference images, so repeat analyses with the same reference skip it
+
+    Images are looked up by their path, and they are reloaded if the file changes
+    The features are also saved to disk, so they survive restarts (the image itself is read from its path again)
+    '''
+    def __init__(self, cachePath=reference_cache_path, maxImages=2, maxSaved=8):
+        '''
+        Arguments:
+            cachePath: (optional) The folder to save the work to, None to only keep it in memory
+            maxImages: (optional) The maximum number of reference images to keep in memory
+            maxSaved: (optional) The maximum number of reference images to keep on disk, the oldest are deleted
+        '''
+        self.cachePath = cachePath
+        self.maxImages = maxImages
+        self.maxSaved = maxSaved
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, path):
+        # Any change to the file or the settings used to process it makes a new key
+        #  * The key starts with a hash of just the path, so the keys of older versions of the file can be found
+        stat = os.stat(path)
+        settings = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, max_features, align_scale, feature_grid, blurKSize, blurAmmount)
+        return "{}-{}".format(hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:12], hashlib.sha1(repr(settings).encode()).hexdigest())
+
+    def get(self, path):
+        '''
+        Gets a reference image, loading and processing it if it is not cached
+
+        Arguments:
+            path: The path of the image
+
+        Returns:
+            A ReferenceImage
+        '''
+        key = self.key(path)
+        with self.lock:
+            if key in self.images:
+                self.images.move_to_end(key)
+                return self.images[key]
+
+            reference = self.loadSaved(key, path)
+            if reference is None:
+                reference = self.process(path)
+                self.save(key, reference)
+
+            self.images[key] = reference
+            while len(self.images) > self.maxImages:
+                self.images.popitem(last=False)
+            return reference
+
+    def read(self, path):
+        image = cv2.imread(path)
+        if image is None:
+            raise FileNotFoundError("Could not read the reference image {}".format(path))
+        return image
+
+    def process(self, path):
+        image = self.read(path)
+        blurred = cv2.GaussianBlur(image, blurKSize, blurAmmount)
+        return ReferenceImage(image, blurred, detectFeatures(image, scale=align_scale))
+
+    def savedPath(self, key):
+        return os.path.join(self.cachePath, key+".npz")
+
+    def save(self, key, reference):
+        if not self.cachePath:
+            return
+        os.makedirs(self.cachePath, exist_ok=True)
+
+        # Only the features are saved, the images are quick to make again and would take up most of the space
+        # Keypoints can not be saved directly, so their values are stored in an array
+        _, keypoints, descriptors = reference.features
+        keypointValues = np.array([(kp.pt[0], kp.pt[1], kp.size, kp.angle, kp.response, kp.octave, kp.class_id) for kp in keypoints], dtype=np.float64).reshape(-1, 7)
+        if descriptors is None:
+            descriptors = np.zeros((0, 32), dtype=np.uint8)
+
+        # Write to a temporary file first, so a half written file is never loaded
+        # The pid keeps workers that save the same reference at the same time from writing to the same file
+        tmpPath = "{}.{}.tmp.npz".format(self.savedPath(key), os.getpid())
+        np.savez_compressed(tmpPath, keypoints=keypointValues, descriptors=descriptors)
+        os.replace(tmpPath, self.savedPath(key))
+        self.removeOld(key)
+
+    def removeOld(self, key):
+        # Older versions of the same file are never used again, and only the newest maxSaved files are kept
+        saved = [os.path.join(self.cachePath, name) for name in os.listdir(self.cachePath)
+                 if name.endswith(".npz") and not name.endswith(".tmp.npz")]
+        samePath = [path for path in saved if os.path.basename(path).startswith(key.split("-")[0]+"-") and path != self.savedPath(key)]
+        others = sorted(set(saved) - set(samePath), key=os.path.getmtime, reverse=True)
+        for path in samePath + others[self.maxSaved:]:
+            try:
+                os.remove(path)
+            except OSError:
+                # Another worker already removed it, or is still writing it
+                pass
+
+    def loadSaved(self, key, path):
+        if not self.cachePath or not os.path.exists(self.savedPath(key)):
+            return None
+
+        try:
+            with np.load(self.savedPath(key)) as saved:
+                keypoints = [cv2.KeyPoint(x, y, size, angle, response, int(octave), int(class_id))
+                             for x, y, size, angle, response, octave, class_id in saved["keypoints"]]
+                descriptors = saved["descriptors"] if len(saved["descriptors"]) else None
+        except (OSError, ValueError, KeyError):
+            # The saved file is broken, so the image is processed again
+            return None
+
+        # The images are made the same way as in process, only the feature detection is skipped
+        image = self.read(path)
+        blurred = cv2.GaussianBlur(image, blurKSize, blurAmmount)
+        shrunk = image
+        if align_scale != 1:
+            shrunk = cv2.resize(image, None, fx=1.0/align_scale, fy=1.0/align_scale, interpolation=cv2.INTER_AREA)
+        return ReferenceImage(image, blurred, (shrunk, keypoints, descriptors))
+
+# Coral reef reference images are shared by every analysis
+referenceCache = ReferenceCache()
+
 # Coral Health Main Function
 
-def findCoralHealth(coral_to_align, cvOutPath, coral_reference_path, done=None):
+def findCoralHealth(coral_to_align, cvOutPath, coral_reference_path, done=None, progress=None, sink=None):
     '''
     Finds the change health of a coral reef by comparing two images of it
 
     Arguments:
         coral_to_align: The target image to compare against the reference (This will likely come from our camera)
-        cvOutPath: Folder all of the output images are saved to. 
+        cvOutPath: Folder all of the output images are saved to (only used if there is no sink)
         coral_reference: The reference image of the coral reef (This will be provided by MATE)
-        done: Keeps track of when the thread is done running.
+        done: (optional) An event (like threading.Event) that is set when the analysis is done
+        progress: (optional) Function that is called with the name of each stage and how much of the analysis is done (0 to 1)
+            If it raises an exception, the analysis stops
+        sink: (optional) The DebugImageSink the output images are saved to, it is closed when the analysis ends
+            By default every image is saved to cvOutPath as a PNG
     
     Returns:
-        Nothing
-
+        A dict with:
+            boxes: The boxes (x, y, w, h) drawn for each kind of change
+            counts: The number of boxes for each kind of change
+            images: The output images (see DebugImageSink.close)
+            imageStats: How many debug images were written, failed, or dropped (see DebugImageSink.stats)
+            timings: The number of seconds each stage took (the alignment stages start with "align-")
     '''
-    coral_reference = cv2.imread(coral_reference_path)
-    cv2.imwrite(cvOutPath+"input.png", coral_to_align)
+    if sink is None:
+        sink = DebugImageSink(cvOutPath)
+    try:
+        return analyzeCoralHealth(coral_to_align, coral_reference_path, sink, done, progress)
+    finally:
+        # The images are encoded while the analysis runs, this only waits for the ones that are left
+        sink.close()
+
+def analyzeCoralHealth(coral_to_align, coral_reference_path, sink, done, progress):
+    # Each stage is timed from when it is reported until the next stage is
+    timings = {}
+    lastStage = [None, time.perf_counter()]
+    def report(stage, fraction):
+        now = time.perf_counter()
+        if lastStage[0]:
+            timings[lastStage[0]] = now - lastStage[1]
+        lastStage[:] = [stage, now]
+        if progress:
+            progress(stage, fraction)
+    def save(name, img):
+        sink.save(name, img, coral_debug_levels[name])
+
+    # The reference image and the work done on it are cached
+    report("reference", 0.0)
+    reference = referenceCache.get(coral_reference_path)
+    coral_reference = reference.image
+    save("input", coral_to_align)
 
     # Generate a background mask for the coral to be aligned
     #  * The coral reef has two colors, pink (healthy) and white (bleached), so two separate masks are combined for greater accuracy
-    coral_to_align_mask = (HSVThreshold(coral_to_align, background_mask["bleached"]["lower"], background_mask["bleached"]["upper"]) +
-                           HSVThreshold(coral_to_align, background_mask["healthy"]["lower"], background_mask["healthy"]["upper"]))
+    report("mask", 0.1)
+    coral_to_align_hsv = cv2.cvtColor(coral_to_align, cv2.COLOR_BGR2HSV)
+    coral_to_align_mask = cv2.bitwise_or(cv2.inRange(coral_to_align_hsv, background_mask["bleached"]["lower"], background_mask["bleached"]["upper"]),
+                                         cv2.inRange(coral_to_align_hsv, background_mask["healthy"]["lower"], background_mask["healthy"]["upper"]))
 
     # Smooth the mask
     coral_to_align_mask = cv2.erode(coral_to_align_mask, kernel, 1)
@@ -340,12 +1084,17 @@ def findCoralHealth(coral_to_align, cvOutPath, coral_reference_path, done=None):
 
     # Apply the mask
     coral_to_align_masked = cv2.bitwise_and(coral_to_align, coral_to_align, mask=coral_to_align_mask)
-    cv2.imwrite(cvOutPath+"background_mask.png", coral_to_align_masked)
+    save("background_mask", coral_to_align_masked)
 
     # Calculate homography for the reference and target images
     #  * Homography is calculated using the unmasked image, but a mask is passed in to limit feature locations
-    coral_matches, h = alignImages(coral_reference, coral_to_align, coral_to_align_mask)
-    cv2.imwrite(cvOutPath+"features.png", coral_matches)
+    report("align", 0.2)
+    alignTimings = {}
+    coral_matches, h = alignImages(coral_reference, coral_to_align, coral_to_align_mask, referenceFeatures=reference.features,
+                                   drawMatches=sink.wants(coral_debug_levels["features"]), timings=alignTimings)
+    timings.update({"align-"+stage: seconds for stage, seconds in alignTimings.items()})
+    if coral_matches is not None:
+        save("features", coral_matches)
 
     # Apply homography
     #  * The homography is applied to both the image with and without the mask
@@ -355,33 +1104,29 @@ def findCoralHealth(coral_to_align, cvOutPath, coral_reference_path, done=None):
     coral_aligned = cv2.warpPerspective(coral_to_align, h, (width, height))
 
     # Overlay the aligned and masked image on the reference image to check alignment
-    cv2.imwrite(cvOutPath+"alignment.png", overlay_image_alpha(coral_reference, coral_aligned_mask[:, :, 0:3], (0, 0), 0.5))
+    if sink.wants(coral_debug_levels["alignment"]):
+        save("alignment", overlay_image_alpha(coral_reference, coral_aligned_mask[:, :, 0:3], (0, 0), 0.5))
 
     # Subtract the two images to find differences in the coral
-    #  * The images are converted to float16 from uint8 so they can represent negative numbers
-    #    They need to be converted back before they can be used in opencv
-    coral_subtracted = cv2.GaussianBlur(coral_reference, blurKSize, blurAmmount).astype("float16") - cv2.GaussianBlur(coral_aligned_mask, blurKSize, blurAmmount).astype("float16")
-
-    # In order to be able to work with negative numbers, a constant, 64, is added to everything
+    #  * In order to be able to work with negative numbers, a constant, 64, is added to everything (see subtractImages)
     #  * This affects the color filtering, so if the constant is adjusted, the filters will need be re-tuned
-    #  * Finally the image is clipped within range and converted back to uint8
-    coral_subtracted = np.clip(np.abs(coral_subtracted+64), 0, 255).astype("uint8")
-    cv2.imwrite(cvOutPath+"subtraction.png", coral_subtracted)
+    report("subtract", 0.5)
+    coral_subtracted = subtractImages(reference.blurred, coral_aligned_mask)
+    save("subtraction", coral_subtracted)
 
 
     # Mark Changes on the reef
-    #  * This is done by looping through each of the 4 kinds of change
-    #    Applying the corresponding color filter, and looking for large contours
-    for key in changes:
-        # Each type of change will have at least one color filter
-        mask = HSVThreshold(coral_subtracted, changes[key]["filters"][0]["lower"], changes[key]["filters"][0]["upper"])
-
-        # Because red's hue is ~0 and ~180, some types of change will have more than one filter
-        #  * This loops through any additional filters and adds them
-        if len(changes[key]["filters"]) > 1:
-            for colorFilter in changes[key]["filters"]:
-                mask += HSVThreshold(coral_subtracted, colorFilter["lower"], colorFilter["upper"])
-        
+    #  * Every pixel is labeled with the kinds of change its color matches in one pass
+    #  * Then each of the 4 kinds of change is looked at on its own, looking for large contours
+    report("classify", 0.6)
+    labels = classifyChanges(coral_subtracted)
+
+    boxes = {}
+    for i, key in enumerate(changes):
+        report("mark "+key, 0.65 + 0.25*i/len(changes))
+        boxes[key] = []
+        mask = labelMask(labels, key)
+
         # Smooth the mask
         mask_smooth = cv2.erode(mask, kernel, 1)
         mask_smooth = cv2.dilate(mask_smooth, kernel, 1)
@@ -400,9 +1145,203 @@ def findCoralHealth(coral_to_align, cvOutPath, coral_reference_path, done=None):
                 w += expand_amount*2
                 h += expand_amount*2
                 cv2.rectangle(coral_aligned, (x,y), (x+w,y+h), changes[key]["color"], 2)
+                boxes[key].append([x, y, w, h])
     
-    cv2.imwrite(cvOutPath+"final.png", coral_aligned)
+    report("save", 0.9)
+    save("final", coral_aligned)
+    images = sink.close()
+    report("done", 1.0)
+
+    # If this is run in a thread, the caller can wait on done instead of the result
+    if done is not None:
+        done.set()
+
+    return {
+        "boxes": boxes,
+        "counts": {key: len(boxes[key]) for key in boxes},
+        "images": images,
+        "imageStats": sink.stats,
+        "timings": timings
+    }
+
+### CV JOBS ###
 
-    # If this is run in a thread, the user can specify a place
-    # to store the out put without returning it
-    done = True
+class JobCancelled(Exception):
+    '''
+    Raised inside of a job when it is cancelled while it is running
+    '''
+    pass
+
+# Set in each worker process by initWorker
+workerProgress = None
+workerCancelled = None
+
+def initWorker(progressQueue, cancelled):
+    global workerProgress, workerCancelled
+    workerProgress = progressQueue
+    workerCancelled = cancelled
+
+def reportProgress(jobId, stage, fraction):
+    # Jobs check if they were cancelled every time they report progress
+    if workerCancelled.value == jobId:
+        raise JobCancelled("Job {} was cancelled".format(jobId))
+    workerProgress.put((jobId, stage, fraction))
+
+def attachFrame(frame):
+    # Frames in shared memory are sent as (name, shape, dtype), they are copied out so the shared memory can be closed right away
+    if shared_memory is None or not isinstance(frame, tuple):
+        return frame
+    name, shape, dtype = frame
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+
+def runCoralHealthJob(jobId, frame, cvOutPath, coral_reference_path, debugImages):
+    # The debug images are encoded in the worker, and sent back in the result
+    return findCoralHealth(attachFrame(frame), cvOutPath, coral_reference_path,
+                           progress=lambda stage, fraction: reportProgress(jobId, stage, fraction),
+                           sink=DebugImageSink(cvOutPath, **debugImages))
+
+def prefetchCoralReference(coral_reference_path):
+    # Only the worker's cache is warmed, the features stay in the worker instead of being sent back
+    referenceCache.get(coral_reference_path)
+
+class CVJob():
+    '''
+    A computer vision job that is running in a CVExecutor
+    '''
+    def __init__(self, jobId, future, executor):
+        self.id = jobId
+        self.future = future
+        self.executor = executor
+        self.stage = "queued"
+        self.progress = 0.0
+
+    def cancel(self):
+        '''
+        Cancels the job, if it is already running it stops at its next stage
+
+        Returns:
+            False if the job is already done
+        '''
+        if self.future.cancel():
+            return True
+        if self.future.done():
+            return False
+        self.executor.cancelled.value = self.id
+        return True
+
+    def cancelled(self):
+        return self.future.cancelled() or (self.future.done() and isinstance(self.future.exception(), JobCancelled))
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        '''
+        Waits for the job to finish and returns its result (this raises the exception of the job, if it failed)
+        '''
+        return self.future.result(timeout)
+
+    def exception(self, timeout=None):
+        return self.future.exception(timeout)
+
+    def add_done_callback(self, fn):
+        '''
+        Calls fn with the job when it is done, it is run on a background thread
+        '''
+        self.future.add_done_callback(lambda future: fn(self))
+
+class CVExecutor():
+    '''
+    Runs computer vision jobs in separate processes, so they do not hold up the control loop
+
+    Frames are sent to the workers through shared memory (when it is available, it needs Python 3.8)
+    The executor must be created from inside `if __name__ == "__main__":`, because the workers import the main module
+    '''
+    def __init__(self, workers=1, onProgress=None):
+        '''
+        Arguments:
+            workers: (optional) The number of worker processes
+            onProgress: (optional) Function that is called with a job every time its progress changes
+        '''
+        # Workers are started fresh instead of forked, forking a program with threads is not safe
+        context = multiprocessing.get_context("spawn")
+        self.progressQueue = context.Queue()
+        self.cancelled = context.Value("i", 0)
+        self.pool = ProcessPoolExecutor(workers, context, initializer=initWorker, initargs=(self.progressQueue, self.cancelled))
+        self.onProgress = onProgress
+        self.jobs = {}
+        self.jobIds = itertools.count(1)
+
+        self.progressThread = threading.Thread(target=self.readProgress, daemon=True)
+        self.progressThread.start()
+
+    def submitCoralHealth(self, frame, cvOutPath, coral_reference_path, debugImages={}):
+        '''
+        Starts a coral reef analysis (see findCoralHealth)
+
+        Arguments:
+            frame: The image to analyze
+            cvOutPath: The folder to write the debug images to, None only keeps them in memory
+            coral_reference_path: The reference image of the coral reef
+            debugImages: (optional) The format, compression, and level of the debug images (see DebugImageSink)
+
+        Returns:
+            A CVJob, its result is the result of findCoralHealth (with the encoded debug images)
+        '''
+        jobId = next(self.jobIds)
+        shm = None
+        if shared_memory is not None:
+            shm = shared_memory.SharedMemory(create=True, size=frame.nbytes)
+            np.ndarray(frame.shape, dtype=frame.dtype, buffer=shm.buf)[:] = frame
+            frame = (shm.name, frame.shape, frame.dtype.str)
+
+        job = CVJob(jobId, self.pool.submit(runCoralHealthJob, jobId, frame, cvOutPath, coral_reference_path, debugImages), self)
+        self.jobs[jobId] = job
+        job.add_done_callback(lambda job: self.finish(job, shm))
+        return job
+
+    def prefetchCoralReference(self, coral_reference_path):
+        '''
+        Prepares a coral reef reference in a worker, so the next analysis of it loads the saved work instead of redoing it
+
+        Arguments:
+            coral_reference_path: The reference image of the coral reef
+
+        Returns:
+            A Future that is done when the reference is ready
+        '''
+        return self.pool.submit(prefetchCoralReference, coral_reference_path)
+
+    def finish(self, job, shm):
+        self.jobs.pop(job.id, None)
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+    def readProgress(self):
+        while True:
+            update = self.progressQueue.get()
+            if update is None:
+                break
+            jobId, stage, fraction = update
+            job = self.jobs.get(jobId)
+            if job:
+                job.stage = stage
+                job.progress = fraction
+                if self.onProgress:
+                    self.onProgress(job)
+
+    def shutdown(self, wait=True):
+        '''
+        Cancels every job that has not started and stops the workers
+        '''
+        for job in list(self.jobs.values()):
+            job.cancel()
+        self.pool.shutdown(wait)
+        # Wait for the progress thread to stop, so it is not reading the queue while the program exits
+        self.progressQueue.put(None)
+        self.progressThread.join()
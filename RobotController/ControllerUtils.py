@@ -3,30 +3,56 @@ This fine contains tools for reading and processing controller data
 '''
 
 # Import necessary libraries
+import time
+import numpy as np
+
 simpleMode = False
 try:
     import evdev
 except:
     simpleMode = True
 
+# How much each degree of freedom (x, y, z movement and x, y, z rotation) drives each thruster
+# I have not been able to find a good source of documentation on exactly what the math is, so at this point, it is mostly trial and error
+holonomic_geometry = {
+    "frontLeft":          [-1, -1,  0,  0,  0,  1],
+    "frontRight":         [-1,  1,  0,  0,  0,  1],
+    "backLeft":           [ 1, -1,  0,  0,  0,  1],
+    "backRight":          [ 1,  1,  0,  0,  0,  1],
+    "verticalFrontLeft":  [ 0,  0,  1,  1,  1,  0],
+    "verticalFrontRight": [ 0,  0,  1, -1,  1,  0],
+    "verticalBackLeft":   [ 0,  0,  1,  1, -1,  0],
+    "verticalBackRight":  [ 0,  0,  1, -1, -1,  0]
+}
+
 class DriveController():
-    def __init__(self, order=[0,1,2,3,4,5,6,7], flip=[0,0,0,0,0,0,0,0]):
+    def __init__(self, order=[0,1,2,3,4,5,6,7], flip=[0,0,0,0,0,0,0,0], geometry=holonomic_geometry, saturation="clip"):
+        '''
+        Arguments:
+            order: (optional) The output index of each thruster, in the order of geometry
+            flip: (optional) Whether each output should be reversed
+            geometry: (optional) How much each degree of freedom drives each thruster (see holonomic_geometry)
+            saturation: (optional) What to do when a thruster would go past full speed
+                "clip": Each thruster is clipped to [-1, 1] on its own
+                "normalize": All of the thrusters are scaled down together, so the direction of thrust is kept
+        '''
+        if saturation not in ("clip", "normalize"):
+            raise ValueError("Unknown saturation mode {}".format(saturation))
+
         self.settings = {
-            "motor_order": {
-                "frontLeft": order[0],
-                "frontRight": order[1],
-                "backLeft": order[2],
-                "backRight": order[3],
-                "verticalFrontLeft": order[4],
-                "verticalFrontRight": order[5],
-                "verticalBackLeft": order[6],
-                "verticalBackRight": order[7]
-            },
+            "motor_order": {name: order[i] for i, name in enumerate(geometry)},
             "style": "holonomic",
-            "motor_flip": flip
+            "motor_flip": flip,
+            "saturation": saturation
         }
         self.mtrSpeeds = [0]*len(order)
 
+        # Build the mixing matrix, each row is one output, with the order and flip already applied
+        self.mixer = np.zeros((len(order), 6))
+        for name, output in self.settings["motor_order"].items():
+            self.mixer[output] = geometry[name]
+        self.mixer[np.array(flip, dtype=bool)] *= -1
+
     def calcMotorValues(self, xm, ym, zm, xr, yr, zr):
         """ 
         Calculates the speed for each motor 6 inputs, each representing a degree of freedom
@@ -34,24 +60,28 @@ class DriveController():
         Returns:
             An array of calculated motors speed values
         """
-
-        if self.settings["style"] == "holonomic":
-            # Calculate motor speeds based on holonomic math
-            # I have not been able to find a good source of documentation on exactly what the math is, so at this point, it is mostly trial and error
-            self.mtrSpeeds[self.settings["motor_order"]["frontLeft"]] = self.clamp((-xm-ym+zr), -1, 1)
-            self.mtrSpeeds[self.settings["motor_order"]["frontRight"]] = self.clamp((-xm+ym+zr), -1, 1)
-            self.mtrSpeeds[self.settings["motor_order"]["backLeft"]] = self.clamp((xm-ym+zr), -1, 1)
-            self.mtrSpeeds[self.settings["motor_order"]["backRight"]] = self.clamp((xm+ym+zr), -1, 1)
-            self.mtrSpeeds[self.settings["motor_order"]["verticalFrontLeft"]] = self.clamp((zm+xr+yr), -1, 1)
-            self.mtrSpeeds[self.settings["motor_order"]["verticalFrontRight"]] = self.clamp((zm-xr+yr), -1, 1)
-            self.mtrSpeeds[self.settings["motor_order"]["verticalBackLeft"]] = self.clamp((zm+xr-yr), -1, 1)
-            self.mtrSpeeds[self.settings["motor_order"]["verticalBackRight"]] = self.clamp((zm-xr-yr), -1, 1)
-        
-        # Flip any motors that need to be reversed
-        for i in range(len(self.mtrSpeeds)):
-            if self.settings['motor_flip'][i]:
-                self.mtrSpeeds[i] = -1 * self.mtrSpeeds[i]
+        self.mtrSpeeds = self.calcMotorValuesBatch([[xm, ym, zm, xr, yr, zr]])[0].tolist()
         return self.mtrSpeeds
+
+    def calcMotorValuesBatch(self, dofs):
+        """
+        Calculates the speed for each motor for many sets of inputs at once
+
+        Arguments:
+            dofs: An (N, 6) array, each row has the 6 degrees of freedom (xm, ym, zm, xr, yr, zr)
+
+        Returns:
+            An (N, number of motors) array of motor speeds
+        """
+        speeds = np.asarray(dofs, dtype=float) @ self.mixer.T
+
+        if self.settings["saturation"] == "normalize":
+            # Scale down every row that has a thruster past full speed
+            peak = np.maximum(np.abs(speeds).max(axis=1, keepdims=True), 1.0)
+            speeds /= peak
+        else:
+            np.clip(speeds, -1, 1, out=speeds)
+        return speeds
     
     def clamp(self, n, minn, maxn):
         """ 
@@ -73,6 +103,67 @@ class DriveController():
         """
         return [0]*len(self.mtrSpeeds)
 
+class LoopTimer():
+    '''
+    Keeps a control loop running at a fixed rate and keeps track of how well it keeps up
+
+    It works the same way in a thread or on an event loop, only the sleep is different:
+        while running:
+            timer.start()
+            step()
+            time.sleep(timer.finish())  # or await asyncio.sleep(timer.finish())
+    '''
+    def __init__(self, rate):
+        '''
+        Arguments:
+            rate: How many times per second the loop should run
+        '''
+        self.period = 1/rate
+        self.nextTick = None
+        self.tickStart = 0
+        self.stats = {
+            "ticks": 0,
+            "overruns": 0,
+            "avgWorkTime": 0,
+            "maxWorkTime": 0,
+            "avgJitter": 0,
+            "maxJitter": 0
+        }
+
+    def start(self):
+        '''
+        Marks the start of a tick
+        '''
+        self.tickStart = time.perf_counter()
+        if self.nextTick is None:
+            self.nextTick = self.tickStart
+
+        # How late the tick started compared to when it was scheduled
+        jitter = self.tickStart - self.nextTick
+        self.stats["ticks"] += 1
+        self.stats["avgJitter"] += (jitter - self.stats["avgJitter"]) / self.stats["ticks"]
+        self.stats["maxJitter"] = max(self.stats["maxJitter"], jitter)
+
+    def finish(self):
+        '''
+        Marks the end of a tick
+
+        Returns:
+            How long to sleep until the next tick, if the tick ran over its period, the missed ticks are skipped
+        '''
+        now = time.perf_counter()
+        workTime = now - self.tickStart
+        self.stats["avgWorkTime"] += (workTime - self.stats["avgWorkTime"]) / self.stats["ticks"]
+        self.stats["maxWorkTime"] = max(self.stats["maxWorkTime"], workTime)
+
+        self.nextTick += self.period
+        delay = self.nextTick - now
+        if delay < 0:
+            self.stats["overruns"] += 1
+            self.nextTick = now
+            delay = 0
+        return delay
+
 def updateGamepadState(gamepadOut, device, stop):
     """
     Updates the state of a gamepad object to based on evdev events
@@ -14,19 +14,29 @@ parser = argparse.ArgumentParser()
 parser.add_argument("-s", "--simple", help="""Run the program in simple mode (fake data and no special libraries).
                     Useful for running on any device other than the robot""",
                     action="store_true")
+parser.add_argument("-a", "--asyncio", help="Run the socket communication with the asyncio runtime instead of threads",
+                    action="store_true")
+parser.add_argument("-r", "--record", help="Record every packet that goes through the node to the recordings folder",
+                    action="store_true")
+parser.add_argument("--replay", help="Play back a recorded dive (a folder in the recordings folder) instead of connecting to the Water Node",
+                    metavar="PATH")
+parser.add_argument("--replaySpeed", help="How fast to play back the recording, 1 is real time and 0 is as fast as possible",
+                    type=float, default=1.0)
+parser.add_argument("-d", "--debug", help="Log debugging messages too",
+                    action="store_true")
 args = parser.parse_args()
 
 simpleMode = args.simple
 
-# TODO: Bring back the logging system
 # Imports for Logging
 import logging
-#from pythonjsonlogger import jsonlogger
+import nodeLogger
 
 # Imports for Threading
 import threading
-from queue import Queue, LifoQueue
-from copy import copy
+import asyncio
+from queue import Empty
+import AsyncUtils
 
 # Imports for Video Streaming
 sys.path.insert(0, 'imagezmq/imagezmq')
@@ -37,6 +47,7 @@ import numpy as np
 # Imports for Communication
 import socket
 import CommunicationUtils
+import RecordingUtils
 import simplejson as json
 import time
 # TODO: Migrate this to the Jetson for V2
@@ -47,7 +58,7 @@ import ControllerUtils
 from simple_pid import PID
 
 # Imports for AirNode
-from flask import Flask, render_template, Response
+from flask import Flask, render_template, Response, jsonify
 from flask_socketio import SocketIO
 
 EARTH_IP_WLAN = '0.0.0.0'
@@ -63,7 +74,34 @@ settings = {
     "numMotors": 8,
     "minMotorSpeed": 0,
     "maxMotorSpeed": 180,
-    "camStreamSleep": 1.0/30.0
+    "camStreamSleep": 1.0/30.0,
+    "sendDataTimeout": 0.1,
+    # How many times a second the air node pushes updates to the website
+    "airPushRate": 30,
+    # The maximum number of updates a second for each stream (tag) sent to the website
+    #  * Each tag and metadata pair is its own stream, only the newest value of a stream is sent
+    #  * A single stream can have its own rate ("tag/metadata"), otherwise its tag's rate is used
+    #  * Tags that are not listed use the default rate, None means every update is sent
+    "airStreamRates": {
+        "default": 10,
+        "sensor": 20,
+        "motorData": 10,
+        "gripData": 5,
+        "log": 2,
+        "log/node-log": None,
+        "stateChange": None
+    },
+    # How the coral reef analysis debug images are made (see ComputerVisionUtils.DebugImageSink)
+    #  * They are kept in memory and served at /cvImage/<name>
+    #  * "path" also writes them to a folder (like "static/assets/coralHealth/"), None keeps them off of the disk
+    "coralReefImages": {
+        "path": None,
+        "format": "jpg",
+        "compression": None,
+        "level": 2
+    },
+    "recordingPath": "recordings",
+    "logPath": "debug/earth-node.log"
 }
 
 # Dict to stop threads
@@ -74,37 +112,43 @@ execute = {
     "mainThread": True
 }
 
-# Queues to send data to specific Threads
-airQueue = Queue(0)
-airCamQueues = {
-    "mainCam": LifoQueue(0),
-    "bkpCam1": LifoQueue(0),
-    "bkpCam2": LifoQueue(0),
-    "cvCam": LifoQueue(0)
-}
+# Message bus that sends packets to the threads that subscribe to their tags
+bus = CommunicationUtils.MessageBus()
+bus.addTopic("sensor", (CommunicationUtils.SensorFrame, dict))
+# Camera frames are not type checked, because imagezmq can hand over zmq frames instead of bytes
+bus.addTopic("cam")
+bus.addTopic("motorData", list)
+bus.addTopic("gripData", (int, float))
+bus.addTopic("log")
+bus.addTopic("stateChange")
+bus.addTopic("settingChange")
 
-recvDataQueue = Queue(0)
-sendDataQueue = Queue(0)
-recvImageQueue = Queue(0)
-mainQueue = Queue(0)
-
-# TODO: Move this to a more central location
-# Maybe make a communication manager that handles sending and recieving messages through queues and sockets
-
-# Dict that stores message tags and the threads the go to
-tags = {
-    "sensor": [airQueue, mainQueue],
-    "cam": {
-        "mainCam": [airCamQueues["mainCam"],mainQueue],
-        "bkpCam1": [airCamQueues["bkpCam1"]],
-        "bkpCam2": [airCamQueues["bkpCam2"]],
-        },
-    "motorData": [sendDataQueue, airQueue],
-    "gripData": [sendDataQueue, airQueue], # TODO: Explain this to Jenna
-    "log": [airQueue],
-    "stateChange": [airQueue, recvDataQueue, sendDataQueue, recvImageQueue, mainQueue],
-    "settingChange": [mainQueue, sendDataQueue]
-}
+# Subscriptions for each thread
+#  * Camera streams only ever need the newest frame
+#  * Everything else keeps a bounded backlog, and throws out the oldest packets if a thread falls behind
+airQueue = bus.subscribe(["sensor", "motorData", "gripData", "log", "stateChange"], maxsize=256, policy=CommunicationUtils.DROP_OLDEST)
+
+# Every camera stream is sent to the websites through one broadcaster
+videoBroadcaster = CommunicationUtils.FrameBroadcaster()
+bus.subscribeCallback(["cam"], lambda pckt: videoBroadcaster.publish(pckt['metadata'], pckt['data']))
+
+sendDataQueue = bus.subscribe(["motorData", "gripData", "stateChange", "settingChange"], maxsize=256, policy=CommunicationUtils.DROP_OLDEST)
+mainQueue = bus.subscribe(["sensor", "stateChange", "settingChange"], maxsize=256, policy=CommunicationUtils.DROP_OLDEST)
+mainCamQueue = bus.subscribe(["cam/mainCam"], policy=CommunicationUtils.LATEST_ONLY)
+
+# The asyncio runtime, if the program is running with it
+runtime = None
+
+# The flight recorder, if the program is recording
+recorder = None
+
+# Runs computer vision jobs in other processes (it is created when the program starts)
+cvExecutor = None
+
+# The newest debug image of each name from the computer vision jobs, served to the website from memory
+cvImages = {}
+
+logger = logging.getLogger("EarthNode")
 
 def stopAllThreads(callback=0):
     """ Stops all currently running threads
@@ -117,6 +161,8 @@ def stopAllThreads(callback=0):
     execute['receiveData'] = False
     execute['sendData'] = False
     execute['mainThread'] = False
+    if runtime:
+        runtime.stop()
 
     if callable(callback):
         callback()
@@ -128,15 +174,39 @@ def handlePacket(qData, debug=False):
             debug: (optional) log debugging data
     """
 
-    # Figure out where a packet should be sent based on its tag, and put it in the correct queue(s)
-    if qData['tag'] in tags:
-        if qData['tag'] ==  "cam":
-            for threadQueue in tags[qData['tag']][qData['metadata']]:
-                CommunicationUtils.clearQueue(threadQueue)
-                threadQueue.put(qData)
-        else:
-            for threadQueue in tags[qData['tag']]:
-                threadQueue.put(qData)
+    # Send the packet to every thread subscribed to its tag
+    bus.publish(qData)
+
+def coralReefProgress(job):
+    """ Posts the progress of a coral reef analysis on the bus
+    """
+    handlePacket(CommunicationUtils.packet(tag="log", data={"stage": job.stage, "progress": job.progress}, metadata="coral-reef-progress"))
+
+def coralReefFinished(job):
+    """ Posts the result of a coral reef analysis on the bus
+        The results (boxes, counts, and image paths) are sent as a log, and the state change tells everyone it is done
+    """
+    # TODO: Add this to the website
+    if job.cancelled():
+        state = "cancelled"
+    elif job.exception():
+        logger.error("Coral reef analysis failed: %s", job.exception())
+        state = "failed"
+    else:
+        # The encoded images stay here, the result only says where to get them
+        result = dict(job.result())
+        for name, image in result["images"].items():
+            cvImages[name] = image
+        result["images"] = {name: "/cvImage/"+name for name in result["images"]}
+        handlePacket(CommunicationUtils.packet(tag="log", data=result, metadata="coral-reef-result"))
+        state = "done"
+    handlePacket(CommunicationUtils.packet(tag="stateChange", data=state, metadata="analyze-coral-reef"))
+
+def coralReferenceFinished(future):
+    """ Logs a coral reef reference that could not be prepared, the analysis will try it again
+    """
+    if not future.cancelled() and future.exception():
+        logger.warning("Preparing the coral reef reference failed: %s", future.exception())
 
 def mainThread(debug=False):
     """ Controls the robot including joystick input, computer vision, line following, etc.
@@ -156,7 +226,7 @@ def mainThread(debug=False):
         try:
             dev = ControllerUtils.identifyController()
         except Exception as e:
-            print(e)
+            logger.warning(e)
     # Initialize a gamepad object
     gamepad = ControllerUtils.Gamepad()
     # Create and start a thread to update the gamepad object based on the state of the controller
@@ -164,28 +234,9 @@ def mainThread(debug=False):
     updateGamepadStateThreads.start()
 
     # Create empty objects to store sensor and image data
-    newestImage = np.array([])
-    newestSensorState = {
-        'imu': {
-            'calibration': {
-                'sys': 0, 
-                'gyro': 0, 
-                'accel': 0, 
-                'mag': 0
-            }, 
-            'gyro': {
-                'x': 0, 
-                'y': 0, 
-                'z': 0
-            },
-            'vel': {
-                'x': 0,
-                'y': 0,
-                'z': 0
-            }
-        },
-        'temp': 25
-    }
+    # Camera frames are only decoded when the computer vision needs them
+    newestImage = None
+    newestSensorState = CommunicationUtils.SensorFrame(temp=25)
 
     # Initalize PID Rotation controllers
     rot = {
@@ -234,10 +285,11 @@ def mainThread(debug=False):
 
     # Stores the currently running CV debug level
     lineFollowingDebugLevel = "Mask"
+    # Follows the lines from frame to frame, so only a band around them has to be searched
+    lineTracker = ComputerVisionUtils.LineTracker(scale=ComputerVisionUtils.lf_decode_scale)
 
     # Store the result of coral reef analysis
-    coralReefOutPath = "static/assets/coralHealth/"
-    coralReefDone = False
+    coralReefJob = None
     coralReefReference = 'static/assets/coralHealth/coral_old.png'
 
     # Create an empty array to store computer vision data
@@ -249,16 +301,19 @@ def mainThread(debug=False):
 
     # This is the main control loop
     while execute['mainThread']:
+        # Update the camera array with the newest frame (if there is one)
+        if not mainCamQueue.empty():
+            camPacket = mainCamQueue.get()
+            newestImage = CommunicationUtils.LazyFrame(camPacket['data'], camPacket['timestamp'])
+
         # Read all the messages in our queue
         while not mainQueue.empty():
             recvMsg = mainQueue.get()
 
-            if recvMsg['tag'] == 'cam':
-                # Update the camera array
-                newestImage = CommunicationUtils.decodeImage(recvMsg['data'])
-            elif recvMsg['tag'] == 'sensor':
-                # Update the sensor dict
-                newestSensorState = recvMsg['data']
+            if recvMsg['tag'] == 'sensor':
+                # Update the sensor state (packets that do not have every sensor field are ignored)
+                if isinstance(recvMsg['data'], CommunicationUtils.SensorFrame):
+                    newestSensorState = recvMsg['data']
             elif recvMsg['tag'] == 'stateChange':
                 if recvMsg['metadata'] == "stop-motors":
                     # Send a stop motor signal
@@ -272,17 +327,24 @@ def mainThread(debug=False):
                         pass
                 elif recvMsg['metadata']== "coral-recieve-image":
                      coralReefReference = recvMsg['data']
+                     # Process the new reference image in a worker now, the analysis then uses that work instead of redoing it
+                     cvExecutor.prefetchCoralReference(coralReefReference).add_done_callback(coralReferenceFinished)
 
                 elif recvMsg['metadata'] == "analyze-coral-reef":
                     if recvMsg['data'] == "run":
                         # If there is camera data, run coral reef analysis
-                        print(recvMsg)
-                        if newestImage.size > 0:
-                            analyzeCoralReefThread = threading.Thread(target=ComputerVisionUtils.findCoralHealth, args=(copy(newestImage), coralReefOutPath, coralReefReference, coralReefDone,), daemon=True)
-                            analyzeCoralReefThread.start()
+                        logger.info(recvMsg)
+                        if newestImage:
+                            # The analysis runs in a worker process, and its result is posted on the bus when it is done
+                            debugImages = dict(settings["coralReefImages"])
+                            coralReefJob = cvExecutor.submitCoralHealth(newestImage.decode(), debugImages.pop("path"), coralReefReference, debugImages)
+                            coralReefJob.add_done_callback(coralReefFinished)
                         else:
                             # TODO: handle the [noCamera] command in the correct places
                             handlePacket(CommunicationUtils.packet(tag="stateChange", data="noCamera", metadata="analyze-coral-reef"))
+                    elif recvMsg['data'] == "cancel":
+                        if coralReefJob:
+                            coralReefJob.cancel()
                 
                 elif recvMsg['metadata'] == "stabilize":
                     # Set the correct rotation target
@@ -367,14 +429,14 @@ def mainThread(debug=False):
                 # Run stabilize mode
 
                 # Get rotation values from the PID controllers
-                xTgt = xRotPID(newestSensorState["imu"]["gyro"]["x"])
-                yTgt = yRotPID(newestSensorState["imu"]["gyro"]["y"])
-                zTgt = zRotPID(newestSensorState["imu"]["gyro"]["z"])
+                xTgt = xRotPID(newestSensorState.gyroX)
+                yTgt = yRotPID(newestSensorState.gyroY)
+                zTgt = zRotPID(newestSensorState.gyroZ)
 
                 
             elif (mode == "follow-line-init"): 
                 # Initialize line following mode
-                if newestImage.size > 0:
+                if newestImage:
                     # Reset PID rotation controllers
                     xRotPID.reset()
                     yRotPID.reset()
@@ -391,7 +453,10 @@ def mainThread(debug=False):
                     # Reset PID rotation controllers
                     xPosPID.reset()
                     xPosPID.tunings = (pos["Kp"], pos["Kd"], pos["Ki"])
-                    xPosPID.setpoint = newestImage.shape[0]*ComputerVisionUtils.lf_percent_of_image_blue_lines_should_fill
+                    frameHeight = newestImage.decode(scale=ComputerVisionUtils.lf_decode_scale).shape[0]*ComputerVisionUtils.lf_decode_scale
+                    xPosPID.setpoint = frameHeight*ComputerVisionUtils.lf_percent_of_image_blue_lines_should_fill
+                    # The lines could be anywhere in the first frame
+                    lineTracker.reset()
                     # Enable follow line mode
                     mode = "follow-line"
                 else:
@@ -402,17 +467,22 @@ def mainThread(debug=False):
                 # Run line following mode
                 
                 # We only want to run the computer vision if we have a valid image
-                if newestImage.size > 0:
-                    cvOut = ComputerVisionUtils.detectLines(newestImage, cvOutLevel=lineFollowingDebugLevel)
+                if newestImage:
+                    # Line following only needs a smaller image, which is much faster to decode
+                    cvOut = lineTracker.track(newestImage.decode(scale=ComputerVisionUtils.lf_decode_scale),
+                                              cvOutLevel=lineFollowingDebugLevel)
+                    logger.debug("Line tracking took %.1f ms (%.0f%% of the frame searched, %d full searches)",
+                                 lineTracker.stats["lastTime"]*1000, lineTracker.stats["searchedFraction"]*100,
+                                 lineTracker.stats["fullSearches"])
                     if cvOut:
-                        dist, angle, cvImage = cvOut
+                        dist, angle = cvOut[:2]
                         
                         # Rotation around the x axis aligns to the line
                         xRotTgt = xRotPID(angle)
 
                         # Rotation around the Y and Z axes keep the robot upright
-                        yRotTgt = yRotPID(newestSensorState["imu"]["gyro"]["y"])
-                        zRotTgt = zRotPID(newestSensorState["imu"]["gyro"]["z"])
+                        yRotTgt = yRotPID(newestSensorState.gyroY)
+                        zRotTgt = zRotPID(newestSensorState.gyroZ)
 
                         # Movement on the x axis keeps a specific distance from the line
                         xPosTgt = xPosPID(dist)
@@ -423,9 +493,10 @@ def mainThread(debug=False):
                         # Calculate motor speeds
                         handlePacket(CommunicationUtils.packet("motorData", speeds, metadata="drivetrain"))
 
-                        # Send the CV Debug image
-                        imgPacket = CommunicationUtils.packet(tag="cam", data=CommunicationUtils.encodeImage(cvImage), metadata="cvCam")
-                        handlePacket(imgPacket)
+                        # Send the CV Debug image (there is only one if a debug level is set)
+                        if len(cvOut) > 2:
+                            imgPacket = CommunicationUtils.packet(tag="cam", data=CommunicationUtils.encodeImage(cvOut[2]), metadata="cvCam")
+                            handlePacket(imgPacket)
                     else:
                         # If the line following failed, send a message
                         handlePacket(CommunicationUtils.packet(tag="stateChange", data="failed", metadata="follow-line"))
@@ -445,10 +516,10 @@ def mainThread(debug=False):
                 mode = "hold-angle"
             elif (mode == "hold-angle"): # Run hold angle mode
                 # Update the PID controllers
-                xTgt = xRotPID(newestSensorState["imu"]["gyro"]["x"])
-                yTgt = yRotPID(newestSensorState["imu"]["gyro"]["y"])
-                print("x", xTgt, "y", yTgt)
-                #zTgt = zRotPID(newestSensorState["imu"]["gyro"]["z"])
+                xTgt = xRotPID(newestSensorState.gyroX)
+                yTgt = yRotPID(newestSensorState.gyroY)
+                logger.debug("hold-angle x %s y %s", xTgt, yTgt)
+                #zTgt = zRotPID(newestSensorState.gyroZ)
 
                 # Calculate new motor values
                 speeds = DC.calcMotorValues(gamepadMapping["x-mov"],
@@ -488,12 +559,6 @@ def mainThread(debug=False):
         handlePacket(CommunicationUtils.packet("gripData", armMovement, metadata="arm-angle"))
         #print(armMovement)
         
-        # Handle coral reef algorthim
-        if coralReefDone:
-            # TODO: Add this to the website
-            # Send a message when the coral reef algorithm is done
-            handlePacket(CommunicationUtils.packet(tag="stateChange", data="done", metadata="analyze-coral-reef"))
-
         # Update the mode and override state that the AirNode displays
         # * Stabilization is a special case because one mode in code is used to represent two robot modes
         # * If the target angle is anything other than, the robot is in "rotate-to-angle" mode
@@ -552,6 +617,32 @@ def receiveVideoStreams(debug=False):
         imgPacket = CommunicationUtils.packet(tag="cam", data=image_b64, timestamp=timestamp, metadata=deviceName, copy_data=False)
         handlePacket(imgPacket)
 
+def fromWaterNode(pckt):
+    """ Checks if a recorded packet came from the Water Node
+        The Earth Node makes its own packets (motor data, state changes, logs, etc.) again when a dive is replayed,
+        so only the Water Node's packets are played back
+    """
+    if pckt['tag'] == "sensor":
+        return True
+    if pckt['tag'] == "cam":
+        # The computer vision debug stream is made by the Earth Node
+        return pckt['metadata'] != "cvCam"
+    if pckt['tag'] == "log" and pckt['metadata'] == "node-log":
+        return isinstance(pckt['data'], dict) and pckt['data'].get("node") == "WaterNode"
+    return False
+
+def replayRecording(path, speed=1.0, debug=False):
+    """ Plays back a recorded dive through handlePacket, in place of the Water Node
+
+        Arguments:
+            path: The folder of the recording
+            speed: (optional) How fast to play the recording, 1 is real time and 0 is as fast as possible
+            debug: (optional) log debugging data
+    """
+    replayer = RecordingUtils.FlightReplayer(path)
+    played = replayer.play(handlePacket, speed, keepRunning=lambda: execute['receiveData'], select=fromWaterNode)
+    logger.info("replayRecording played %s packets", played)
+
 def receiveData(debug=False):
     """ Recieves and processes JSON data from the Water Node
 
@@ -578,10 +669,14 @@ def receiveData(debug=False):
     # Listen and accept connections
     snsr.listen()
     conn, addr = snsr.accept()
+    framer = CommunicationUtils.MessageFramer(conn)
+
+    # Tell the Water Node which codecs we can decode
+    CommunicationUtils.sendCodecs(conn)
 
     while execute['receiveData']:
         # Recieve and handle messages
-        recvPacket = CommunicationUtils.recvMsg(conn)
+        recvPacket = framer.recvMsg()
         #print(time.time() - recvPacket['timestamp'], recvPacket['tag'])
         
         # Add EarthNode sensor data to the WaterNode sensor data
@@ -617,13 +712,28 @@ def sendData(debug=False):
     cntlr.listen()
     conn, addr = cntlr.accept()
 
-    CommunicationUtils.sendMsg(conn, CommunicationUtils.packet("config", os.popen('date --rfc-3339=ns').readlines()[0].strip(), metadata="sync-time"))
+    # Find out which codecs the Water Node can decode
+    useCodecs = CommunicationUtils.negotiateCodecs(CommunicationUtils.MessageFramer(conn))
+
+    CommunicationUtils.sendMsg(conn, CommunicationUtils.packet("config", os.popen('date --rfc-3339=ns').readlines()[0].strip(), metadata="sync-time"), useCodecs)
 
     while execute['sendData']:
-        while not sendDataQueue.empty():
-            # Get and send all of our queued messages
-            sendPacket = sendDataQueue.get()
-            CommunicationUtils.sendMsg(conn, sendPacket)
+        # Wait for a packet to send, the timeout lets the thread notice when it should stop
+        try:
+            sendPackets = [sendDataQueue.get(timeout=settings["sendDataTimeout"])]
+        except Empty:
+            continue
+
+        # Grab every other packet that is already queued
+        while True:
+            try:
+                sendPackets.append(sendDataQueue.get_nowait())
+            except Empty:
+                break
+
+        # Only the newest motor and gripper values matter, so older ones are not sent
+        sendPackets = CommunicationUtils.coalescePackets(sendPackets, ("motorData", "gripData"))
+        CommunicationUtils.sendMsgs(conn, sendPackets, useCodecs)
     
     # Close the connection
     conn.close()
@@ -651,49 +761,86 @@ def startAirNode(debug=False):
 
     @app.route('/cv')
     def right():
-        return render_template('cv.html')
+        # The coral health images above the debug level are never made, so their dropdown items are disabled
+        return render_template('cv.html', coralLevel=settings["coralReefImages"]["level"],
+                               coralDebugLevels=ComputerVisionUtils.coral_debug_levels)
 
     def messageReceived(methods=['GET', 'POST']):
-        print('message was received!!!')
-
-    @socketio.on('getAirNodeUpdates')
-    def getAir(recv, methods=["GET","POST"]):
-        # Send queued messages to the airNode on its request
-        while not airQueue.empty():
-            tosend = airQueue.get()
-
-            # TODO: Add this check globally
-            # and take into account whether a message is high priority or not
-
-            # We only send messages that are newer than 0.1 seconds
-            # This only works assuming that ALL of the data being sent is in streams
-            # Such as sensor or camera data
-            if (tosend['timestamp'] - time.time() < 0.1):
-                socketio.emit("updateAirNode", tosend)
+        logger.debug('message was received!!!')
+
+    def streamRate(stream):
+        # The rate of a single stream, then its tag, then the default
+        rates = settings["airStreamRates"]
+        return rates.get(stream[0]+"/"+stream[1], rates.get(stream[0], rates["default"]))
+
+    def pushAirUpdates():
+        # Push bundles of updates to every connected website
+        #  * Each bundle has at most one packet (the newest) for each tag and metadata
+        #  * Streams are rate limited based on settings["airStreamRates"]
+        #  * Streams without a rate limit send every packet, in order
+        pushPeriod = 1.0/settings["airPushRate"]
+        newestPackets = {}
+        lastSent = {}
+
+        while True:
+            bundle = []
+
+            # Keep the newest packet of each stream
+            while True:
+                try:
+                    tosend = airQueue.get_nowait()
+                except Empty:
+                    break
+                # The websites expect sensor data as a nested dict
+                if isinstance(tosend['data'], CommunicationUtils.SensorFrame):
+                    tosend = dict(tosend, data=tosend['data'].toDict())
+
+                stream = (tosend['tag'], str(tosend['metadata']))
+                if streamRate(stream) is None:
+                    bundle.append(tosend)
+                else:
+                    newestPackets[stream] = tosend
+
+            # Bundle every stream that is allowed to send again
+            now = time.time()
+            for stream in list(newestPackets):
+                if now - lastSent.get(stream, 0) >= 1.0/streamRate(stream):
+                    bundle.append(newestPackets.pop(stream))
+                    lastSent[stream] = now
+
+            if bundle:
+                socketio.emit("updateAirNode", bundle)
+            socketio.sleep(pushPeriod)
+
+    socketio.start_background_task(pushAirUpdates)
     
+    @app.route('/cvImage/<name>')
+    def cvImage(name):
+        # Serve the newest computer vision debug image straight from memory
+        image = cvImages.get(name)
+        if image is None:
+            return "There is no {} image yet".format(name), 404
+        return Response(image["data"], mimetype=image["mimetype"])
+
+    @app.route('/busStats')
+    def busStats():
+        # Report how many packets have gone through each topic of the message bus
+        return jsonify(bus.topicStats())
+
     @socketio.on('sendUpdate')
     def getUpdate(recv, methods=["GET","POST"]):
         # Handle messages from the airNode
         handlePacket(recv)
         
-    # Handle streaming all of the different cameras
-    def camGen(camName):
-        camQueue = airCamQueues[camName]
-        while True:
-            # test = camQueue.get()
-            # print(time.time() - test['timestamp'])
-            # tosend = (b'--frame\r\n'+b'Content-Type: image/jpeg\r\n\r\n' + test['data'] + b'\r\n\r\n')
-            
-            tosend = (b'--frame\r\n'+b'Content-Type: image/jpeg\r\n\r\n' + camQueue.get()['data'] + b'\r\n\r\n')
-            '''
-            if debug:
-                logger.debug("Sending new image to Air Node")
-            '''
-            yield tosend
-
     @app.route('/videoFeed/<camName>')
     def videoFeed(camName):
-        return Response(camGen(camName), mimetype='multipart/x-mixed-replace; boundary=frame')
+        # Each client gets its own stream of the newest frames
+        return Response(videoBroadcaster.stream(camName), mimetype='multipart/x-mixed-replace; boundary='+CommunicationUtils.MJPEG_BOUNDARY.decode())
+
+    @app.route('/videoStats')
+    def videoStats():
+        # Report the fps and bytes/s of each client streaming video
+        return jsonify(videoBroadcaster.clientStats())
 
     # TODO: Improve mode system with a development, deployment, simple mode, etc.
     
@@ -705,36 +852,138 @@ def startAirNode(debug=False):
 
 
 
+### ASYNCIO RUNTIME ###
+
+async def receiveDataAsync():
+    """ Recieves and processes data from the Water Node using asyncio streams
+    """
+    # Get the IP address and port of the earth node
+    HOST = CommunicationUtils.SIMPLE_EARTH_IP if simpleMode else CommunicationUtils.EARTH_IP
+    PORT = CommunicationUtils.SNSR_PORT
+
+    async def handleConnection(reader, writer):
+        try:
+            # Tell the Water Node which codecs we can decode
+            await AsyncUtils.sendCodecs(writer)
+            while True:
+                recvPacket = await AsyncUtils.recvMsg(reader)
+
+                # Add EarthNode sensor data to the WaterNode sensor data (the Arduino is not connected yet, see receiveData)
+                if recvPacket['tag'] == "sensor":
+                    recvPacket["amps"] = 0
+                    recvPacket["volts"] = 0
+
+                handlePacket(recvPacket)
+        except OSError:
+            logger.warning("receiveData connection lost")
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handleConnection, HOST, PORT, reuse_address=True)
+    async with server:
+        await server.serve_forever()
+
+async def sendDataAsync():
+    """ Sends data to the Water Node using asyncio streams
+    """
+    # Get the IP address and port of the earth node
+    HOST = CommunicationUtils.SIMPLE_EARTH_IP if simpleMode else CommunicationUtils.EARTH_IP
+    PORT = CommunicationUtils.CNTLR_PORT
+
+    # Replace the threaded subscription with one that can be awaited
+    sendDataQueue.unsubscribe()
+    subscription = bus.subscribe(sendDataQueue.topics, maxsize=256, policy=CommunicationUtils.DROP_OLDEST,
+                                 subscriptionType=AsyncUtils.AsyncSubscription)
+
+    async def handleConnection(reader, writer):
+        try:
+            # Find out which codecs the Water Node can decode
+            useCodecs = await AsyncUtils.negotiateCodecs(reader)
+
+            sendPackets = [CommunicationUtils.packet("config", os.popen('date --rfc-3339=ns').readlines()[0].strip(), metadata="sync-time")]
+            while True:
+                # Grab every packet that is already queued
+                while True:
+                    try:
+                        sendPackets.append(subscription.get_nowait())
+                    except Empty:
+                        break
+
+                # Only the newest motor and gripper values matter, so older ones are not sent
+                sendPackets = CommunicationUtils.coalescePackets(sendPackets, ("motorData", "gripData"))
+                await AsyncUtils.sendMsgs(writer, sendPackets, useCodecs)
+
+                # Wait for the next packet to send
+                sendPackets = [await subscription.get()]
+        except OSError:
+            logger.warning("sendData connection lost")
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handleConnection, HOST, PORT, reuse_address=True)
+    async with server:
+        await server.serve_forever()
+
 if( __name__ == "__main__"):
     # Setup Logging preferences
     verbose = [False,True]
+    logListener = nodeLogger.setupLogging(logging.DEBUG if args.debug else logging.INFO, logPath=settings["logPath"],
+                                         publish=handlePacket, node="EarthNode")
+    cvExecutor = ComputerVisionUtils.CVExecutor(onProgress=coralReefProgress)
 
 	# Start all of the threads for communication
     mainThread = threading.Thread(target=mainThread, args=(verbose[0],))
-    vidStreamThread = threading.Thread(target=receiveVideoStreams, args=(verbose[0],))
-    recvDataThread = threading.Thread(target=receiveData, args=(verbose[0],))
-    sendDataThread = threading.Thread(target=sendData, args=(verbose[0],))
     airNodeThread = threading.Thread(target=startAirNode, args=(verbose[0],))
+    commThreads = []
+
+    if args.record:
+        # Record every packet that is published to the bus
+        recorder = RecordingUtils.FlightRecorder(settings["recordingPath"])
+        logger.info("Recording to %s", recorder.start())
+        bus.subscribeCallback(list(bus.topics), recorder.record)
+
+    if args.replay:
+        # A recorded dive stands in for the Water Node (including its video)
+        commThreads.append(threading.Thread(target=replayRecording, args=(args.replay, args.replaySpeed, verbose[0])))
+    else:
+        commThreads.append(threading.Thread(target=receiveVideoStreams, args=(verbose[0],)))
+        if args.asyncio:
+            # Socket communication runs on one event loop instead of two threads
+            runtime = AsyncUtils.NodeRuntime()
+            runtime.addTask(receiveDataAsync)
+            runtime.addTask(sendDataAsync)
+        else:
+            commThreads.append(threading.Thread(target=receiveData, args=(verbose[0],)))
+            commThreads.append(threading.Thread(target=sendData, args=(verbose[0],)))
 
-    sendDataThread.start()
+    for thread in commThreads:
+        thread.start()
     mainThread.start()
-    vidStreamThread.start()
-    recvDataThread.start()
     airNodeThread.start()
 
-	# We don't want the program to end uptil all of the threads are stopped
-    while execute['streamVideo'] or execute['receiveData'] or execute['sendData'] or execute['mainThread']:
-        time.sleep(0.1)
+    if runtime:
+        # This returns once the runtime is stopped
+        runtime.run()
+        stopAllThreads()
+    else:
+        # We don't want the program to end uptil all of the threads are stopped
+        while execute['streamVideo'] or execute['receiveData'] or execute['sendData'] or execute['mainThread']:
+            time.sleep(0.1)
+    for thread in commThreads:
+        thread.join()
     mainThread.join()
-    recvDataThread.join()
-    sendDataThread.join()
-    vidStreamThread.join()
     airNodeThread.join()
-    '''
+    cvExecutor.shutdown()
+
+    if recorder:
+        recorder.stop()
+        logger.info("Recorder stats %s", recorder.stats)
     logger.debug("Stopped all Threads")
     logger.info("Shutting Down Ground Node")
-    '''
 
     # TODO: Actually make this clear ALL of the queues, not just the air node
     # Clear all queues
-    CommunicationUtils.clearQueue(airQueue)
\ No newline at end of file
+    CommunicationUtils.clearQueue(airQueue)
+
+    # Write out any log records that are still waiting
+    logListener.stop()
\ No newline at end of file
@@ -19,7 +19,18 @@ except:
     simpleMode = True
     from noise import pnoise1
     from random import randint
-    import time
+
+import time
+import logging
+import threading
+
+import CommunicationUtils
+
+logger = logging.getLogger(__name__)
+
+# The IMU and the servo driver share one I2C bus, and the IMU is read on its own thread (see IMUFusion.start_sampling)
+# Every access to either of them holds this lock, so their transactions never interleave on the bus
+i2cLock = threading.RLock()
 
 # TODO: find some way to globalize settings.
 # In this specific case, it would make more sense to define the motor type when it is initialized
@@ -52,6 +63,9 @@ settings = {
 if not simpleMode:
     i2c = busio.I2C(SCL, SDA)
 
+# The address of the first PCA9685 LED register, each channel has 4 (ON_L, ON_H, OFF_L, OFF_H)
+LED0_ON_L = 0x06
+
 # TODO: Upate this to something much more like what FRC has where motors are individually initialized
 class ServoDriver():
     def __init__(self, servo_locs, frequency=50):
@@ -73,6 +87,22 @@ class ServoDriver():
                                         s_type)
                     #self.servos[loc][0].angle = 3
 
+            # The 16 bit duty cycle range of each servo
+            #  * The PCA9685 can not run at exactly the requested frequency (it runs at 25MHz/4096/prescale),
+            #    so the range is taken from the servo objects, which work it out from the real frequency
+            #  * This way set_servos writes exactly the same duty cycles as the servo objects (the ESCs are armed with them)
+            self.dutyRanges = [None]*16
+            for loc, s_type in servo_locs:
+                self.dutyRanges[loc] = (self.servos[loc][0]._min_duty, self.servos[loc][0]._duty_range)
+
+            # The last LED register values written to each channel (None means unknown)
+            self.lastRegs = [None]*16
+            self.writeStats = {
+                "blockWrites": 0,
+                "channelsWritten": 0,
+                "channelsSkipped": 0
+            }
+
     def set_servo(self, loc, target):
         '''
         Sets the target of a single servo
@@ -82,15 +112,89 @@ class ServoDriver():
             target: The servo target
         '''
 
+        self.set_servos([(loc, target)])
+
+    def set_servos(self, targets):
+        '''
+        Sets the targets of many servos at once
+
+        Channels that already have the same pulse width are skipped, and channels that are next to each other
+        are written in one I2C transaction (the PCA9685 auto-increments the register address)
+
+        Arguments:
+            targets: (loc, target) pairs or a dict of loc: target
+        '''
         if not simpleMode:
-            if self.servos[loc]:
-                if settings["servo_settings"][self.servos[loc][1]]["type"] == "continuous-servo":
-                    self.servos[loc][0].throttle = target
-                if settings["servo_settings"][self.servos[loc][1]]["type"] == "servo":
-                    self.servos[loc][0].angle = target
-            else:
-                raise Exception("There is no servo at {}".format(loc))
-    
+            if isinstance(targets, dict):
+                targets = targets.items()
+
+            # Work out the LED register values for each channel that changed
+            changed = {}
+            for loc, target in targets:
+                regs = self.calc_registers(loc, target)
+                if regs == self.lastRegs[loc]:
+                    self.writeStats["channelsSkipped"] += 1
+                else:
+                    changed[loc] = regs
+
+            # Write each run of contiguous channels in a single block
+            locs = sorted(changed)
+            start = 0
+            for i in range(1, len(locs)+1):
+                if i == len(locs) or locs[i] != locs[i-1]+1:
+                    self.write_registers(locs[start], [changed[loc] for loc in locs[start:i]])
+                    start = i
+
+    def calc_registers(self, loc, target):
+        '''
+        Calculates the LED register values (ON_L, ON_H, OFF_L, OFF_H) of a servo target
+
+        Arguments:
+            loc: The servo location
+            target: The servo target (throttle for continuous servos, angle for servos)
+
+        Returns:
+            The 4 register bytes
+        '''
+        if not self.servos[loc]:
+            raise Exception("There is no servo at {}".format(loc))
+
+        s_settings = settings["servo_settings"][self.servos[loc][1]]
+        if s_settings["type"] == "continuous-servo":
+            if not -1 <= target <= 1:
+                raise ValueError("Throttle must be between -1.0 and 1.0")
+            fraction = (target + 1) / 2
+        else:
+            if not 0 <= target <= s_settings["actuation_range"]:
+                raise ValueError("Angle out of range")
+            fraction = target / s_settings["actuation_range"]
+
+        minDuty, dutyRange = self.dutyRanges[loc]
+        duty = minDuty + int(fraction * dutyRange)
+
+        # Convert the 16 bit duty cycle to the 12 bit off count, just like the PCA9685 library does
+        if duty == 0xffff:
+            on, off = 0x1000, 0
+        else:
+            on, off = 0, (duty + 1) >> 4
+        return bytes((on & 0xff, on >> 8, off & 0xff, off >> 8))
+
+    def write_registers(self, start, regs):
+        '''
+        Writes the LED registers of contiguous channels in one I2C transaction
+
+        Arguments:
+            start: The first channel
+            regs: The register bytes of each channel, starting at start
+        '''
+        with i2cLock, self.pca.i2c_device as i2c:
+            i2c.write(bytes([LED0_ON_L + 4*start]) + b"".join(regs))
+
+        for i, r in enumerate(regs):
+            self.lastRegs[start+i] = r
+        self.writeStats["blockWrites"] += 1
+        self.writeStats["channelsWritten"] += len(regs)
+
     def move_servo(self, loc, amount, max_val, min_val):
         '''
         !!! Documentation is not up to date !!!
@@ -103,11 +207,13 @@ class ServoDriver():
 
         if not simpleMode:
             if self.servos[loc]:
-                if settings["servo_settings"][self.servos[loc][1]]["type"] == "continuous-servo":
-                    self.servos[loc][0].throttle = max(min(self.servos[loc][0].throttle + amount, max_val), min_val)
-                if settings["servo_settings"][self.servos[loc][1]]["type"] == "servo":
-                    self.servos[loc][0].angle = max(min(self.servos[loc][0].angle + amount, max_val), min_val)
-                    print(self.servos[loc][0].angle)
+                with i2cLock:
+                    if settings["servo_settings"][self.servos[loc][1]]["type"] == "continuous-servo":
+                        self.servos[loc][0].throttle = max(min(self.servos[loc][0].throttle + amount, max_val), min_val)
+                    if settings["servo_settings"][self.servos[loc][1]]["type"] == "servo":
+                        self.servos[loc][0].angle = max(min(self.servos[loc][0].angle + amount, max_val), min_val)
+                        logger.debug("Servo %s moved to %s", loc, self.servos[loc][0].angle)
+                self.lastRegs[loc] = None
             else:
                 raise Exception("There is no servo at {}".format(loc))
 
@@ -121,11 +227,13 @@ class ServoDriver():
             only_type (optional): Only set set the speed of a specified type of servo
         '''
         if not simpleMode:
-            for s in self.servos:
-                if s:
-                    servo, s_type = s
-                    if servo and (only_type == False or s_type == only_type):
-                        servo.throttle = speed
+            with i2cLock:
+                for s in self.servos:
+                    if s:
+                        servo, s_type = s
+                        if servo and (only_type == False or s_type == only_type):
+                            servo.throttle = speed
+            self.lastRegs = [None]*16
     
     def shutdown(self):
         '''
@@ -133,32 +241,39 @@ class ServoDriver():
         '''
         if not simpleMode:
             self.set_all_servos(0)
-            self.pca.deinit()
+            with i2cLock:
+                self.pca.deinit()
+
+# The BNO055 fields that are read by the IMU, split by how often they change
+# Orientation and acceleration are needed by the control loop, temperature and calibration change slowly
+IMU_FAST_FIELDS = ["euler", "linear_acceleration"]
+IMU_SLOW_FIELDS = ["temperature", "calibration_status"]
 
 class IMUFusion():
     def __init__(self):
-        if not simpleMode:
-            self.imu = BNO055(i2c)
-            self.calibration = {
-                "gyro-offset": {
+        self.calibration = {
+            "gyro-offset": {
+                "x": 0,
+                "y": 0,
+                "z": 0
+            },
+            "last": {
+                "gyro": {
                     "x": 0,
                     "y": 0,
                     "z": 0
                 },
-                "last": {
-                    "gyro": {
-                        "x": 0,
-                        "y": 0,
-                        "z": 0
-                    },
-                    "vel": {
-                        "x": 0,
-                        "y": 0,
-                        "z": 0
-                    },
-                    "temp": 0
-                }
+                "vel": {
+                    "x": 0,
+                    "y": 0,
+                    "z": 0
+                },
+                "temp": 0
             }
+        }
+
+        if not simpleMode:
+            self.imu = BNO055(i2c)
         else:
             self.offsets = {
                 "imu": {
@@ -183,6 +298,17 @@ class IMUFusion():
             }
             self.start = time.time()
             self.octaves = 2
+
+        # How long each field takes to read
+        self.fieldStats = {field: {"reads": 0, "lastRead": 0, "avgReadTime": 0, "maxReadTime": 0} for field in IMU_FAST_FIELDS+IMU_SLOW_FIELDS}
+        self.samplerStats = {"samples": 0, "overruns": 0, "errors": 0, "lastError": None}
+        self.sampling = False
+        self.samplerThread = None
+
+        # The newest raw value of each field and the newest full state
+        # The state is a SensorFrame, which can not be changed, so readers can use it without a lock
+        self.raw = {field: self.read_field(field) for field in IMU_FAST_FIELDS+IMU_SLOW_FIELDS}
+        self.latest = (time.time(), self.build_state(self.raw))
     
     def set_offset(self, offset=False):
         '''
@@ -197,98 +323,168 @@ class IMUFusion():
                 self.calibration["gyro-offset"]["x"] += self.calibration["last"]["gyro"]["x"]
                 self.calibration["gyro-offset"]["y"] += self.calibration["last"]["gyro"]["y"]
                 self.calibration["gyro-offset"]["z"] += self.calibration["last"]["gyro"]["z"]
-    
-    def get_full_state(self):
-        '''
-        Returns the full state of the IMU
+
+    def read_field(self, field):
         '''
-        state = {
-            "imu": {
-                "calibration": {
-                    "sys": 0,
-                    "gyro": 0,
-                    "accel": 0,
-                    "mag": 0
-                },
-                "gyro": {
-                    "x": 0,
-                    "y": 0,
-                    "z": 0,
-                },
-                "vel": {
-                    "x": 0,
-                    "y": 0,
-                    "z": 0,
-                }
-            },
-            "temp": 0
-        }
+        Reads a single field from the IMU and keeps track of how long it took
 
-        if not simpleMode:
-            # Read data from the sensor
-            gyro = self.imu.euler
-            lin_accel = self.imu.linear_acceleration
-            temp = self.imu.temperature
-            calib = self.imu.calibration_status
-
-            # Store calibration data
-            state["imu"]["calibration"]["sys"] = calib[0]
-            state["imu"]["calibration"]["gyro"] = calib[1]
-            state["imu"]["calibration"]["accel"] = calib[2]
-            state["imu"]["calibration"]["mag"] = calib[3]
-
-            # Store gyro data (if the current snapsnot does not have the data, we use data from last time)
-            if gyro[0] is not None:
-                # Subtract the offests to normalize the orientation
-                state["imu"]["gyro"]["x"] = gyro[2] - self.calibration["gyro-offset"]["x"]
-                state["imu"]["gyro"]["y"] = gyro[1] - self.calibration["gyro-offset"]["y"]
-                state["imu"]["gyro"]["z"] = gyro[0] - self.calibration["gyro-offset"]["z"]
-                self.calibration["last"]["gyro"]["x"] = state["imu"]["gyro"]["x"]
-                self.calibration["last"]["gyro"]["y"] = state["imu"]["gyro"]["y"]
-                self.calibration["last"]["gyro"]["z"] = state["imu"]["gyro"]["z"]
-            else:
-                state["imu"]["gyro"]["x"] = self.calibration["last"]["gyro"]["x"]
-                state["imu"]["gyro"]["y"] = self.calibration["last"]["gyro"]["y"]
-                state["imu"]["gyro"]["z"] = self.calibration["last"]["gyro"]["z"]
-            
-            # Store velocity data (if the current snapsnot does not have the data, we use data from last time)
-            if lin_accel[0] is not None:
-                # The IMU returns acceleration, so we need to integrate to get velocity
-                state["imu"]["vel"]["x"] += lin_accel[0]
-                state["imu"]["vel"]["y"] += lin_accel[1]
-                state["imu"]["vel"]["z"] += lin_accel[2]
-                self.calibration["last"]["vel"]["x"] = state["imu"]["vel"]["x"]
-                self.calibration["last"]["vel"]["y"] = state["imu"]["vel"]["y"]
-                self.calibration["last"]["vel"]["z"] = state["imu"]["vel"]["z"]
-            else:
-                state["imu"]["vel"]["x"] = self.calibration["last"]["vel"]["x"]
-                state["imu"]["vel"]["y"] = self.calibration["last"]["vel"]["y"]
-                state["imu"]["vel"]["z"] = self.calibration["last"]["vel"]["z"]
-            
-            # Store temperature data (if the current snapsnot does not have the data, we use data from last time)
-            if temp > 0:
-                state["temp"] = temp
-                self.calibration["last"]["temp"] = state["temp"]
-            else:
-                state["temp"] = self.calibration["last"]["temp"]
+        Arguments:
+            field: The name of the field (see IMU_FAST_FIELDS and IMU_SLOW_FIELDS)
 
+        Returns:
+            The value in the same format as the BNO055 library
+        '''
+        readStart = time.perf_counter()
+        if not simpleMode:
+            with i2cLock:
+                value = getattr(self.imu, field)
         else:
             # TODO: As part of revamping the mode system, make a proper noise generation class
             x = float(-(time.time()-self.start))/150.0
+            if field == "euler":
+                # The BNO055 returns (heading, roll, pitch), which is (z, y, x)
+                value = tuple(pnoise1(x+self.offsets["imu"]["gyro"][axis], self.octaves)*180 for axis in "zyx")
+            elif field == "linear_acceleration":
+                value = tuple(pnoise1(x+self.offsets["imu"]["vel"][axis], self.octaves)*60 for axis in "xyz")
+            elif field == "temperature":
+                value = pnoise1(x+self.offsets["temp"], self.octaves)*5+21
+            else:
+                value = tuple((pnoise1(x+self.offsets["imu"]["calibration"][part], self.octaves))*2+2 for part in ("sys", "gyro", "accel", "mag"))
+        readTime = time.perf_counter() - readStart
+
+        stats = self.fieldStats[field]
+        stats["reads"] += 1
+        stats["lastRead"] = time.time()
+        stats["avgReadTime"] += (readTime - stats["avgReadTime"]) / stats["reads"]
+        stats["maxReadTime"] = max(stats["maxReadTime"], readTime)
+        return value
+
+    def build_state(self, raw):
+        '''
+        Builds the full state of the IMU from the raw value of each field
+
+        Arguments:
+            raw: A dict of the newest value of each field
+
+        Returns:
+            A new CommunicationUtils.SensorFrame
+        '''
+        gyro = raw["euler"]
+        lin_accel = raw["linear_acceleration"]
+        temp = raw["temperature"]
+        calib = raw["calibration_status"]
+        last = self.calibration["last"]
+
+        # Store gyro data (if the current snapsnot does not have the data, we use data from last time)
+        if gyro[0] is not None:
+            # Subtract the offests to normalize the orientation
+            last["gyro"]["x"] = gyro[2] - self.calibration["gyro-offset"]["x"]
+            last["gyro"]["y"] = gyro[1] - self.calibration["gyro-offset"]["y"]
+            last["gyro"]["z"] = gyro[0] - self.calibration["gyro-offset"]["z"]
 
-            state["imu"]["calibration"]["sys"] = (pnoise1(x+self.offsets["imu"]["calibration"]["sys"], self.octaves))*2+2
-            state["imu"]["calibration"]["gyro"] = (pnoise1(x+self.offsets["imu"]["calibration"]["gyro"], self.octaves))*2+2
-            state["imu"]["calibration"]["accel"] = (pnoise1(x+self.offsets["imu"]["calibration"]["accel"], self.octaves))*2+2
-            state["imu"]["calibration"]["mag"] = (pnoise1(x+self.offsets["imu"]["calibration"]["mag"], self.octaves))*2+2
-            
-            state["imu"]["gyro"]["x"] = pnoise1(x+self.offsets["imu"]["gyro"]["x"], self.octaves)*180
-            state["imu"]["gyro"]["y"] = pnoise1(x+self.offsets["imu"]["gyro"]["y"], self.octaves)*180
-            state["imu"]["gyro"]["z"] = pnoise1(x+self.offsets["imu"]["gyro"]["z"], self.octaves)*180
-
-            state["imu"]["vel"]["x"] = pnoise1(x+self.offsets["imu"]["vel"]["x"], self.octaves)*60
-            state["imu"]["vel"]["y"] = pnoise1(x+self.offsets["imu"]["vel"]["y"], self.octaves)*60
-            state["imu"]["vel"]["z"] = pnoise1(x+self.offsets["imu"]["vel"]["z"], self.octaves)*60
-            
-            state["temp"] = pnoise1(x+self.offsets["temp"], self.octaves)*5+21
-        
-        return state
\ No newline at end of file
+        # Store velocity data (if the current snapsnot does not have the data, we use data from last time)
+        if lin_accel[0] is not None:
+            # The IMU returns acceleration, so we need to integrate to get velocity
+            last["vel"]["x"] = lin_accel[0]
+            last["vel"]["y"] = lin_accel[1]
+            last["vel"]["z"] = lin_accel[2]
+
+        # Store temperature data (if the current snapsnot does not have the data, we use data from last time)
+        if temp > 0:
+            last["temp"] = temp
+
+        return CommunicationUtils.SensorFrame(calib[0], calib[1], calib[2], calib[3],
+                                              last["gyro"]["x"], last["gyro"]["y"], last["gyro"]["z"],
+                                              last["vel"]["x"], last["vel"]["y"], last["vel"]["z"],
+                                              last["temp"])
+
+    def get_full_state(self):
+        '''
+        Reads every field from the IMU and returns the full state
+
+        If the sampler is running, use get_latest instead, it does not touch the I2C bus
+        '''
+        for field in IMU_FAST_FIELDS+IMU_SLOW_FIELDS:
+            self.raw[field] = self.read_field(field)
+        self.latest = (time.time(), self.build_state(self.raw))
+        return self.latest[1]
+
+    def get_latest(self):
+        '''
+        Returns the newest state of the IMU without reading from it
+
+        Returns:
+            (the time the state was sampled, the state)
+        '''
+        return self.latest
+
+    def sample_age(self):
+        '''
+        Returns how many seconds old the newest state is, it keeps growing if the IMU can not be read
+        '''
+        return time.time() - self.latest[0]
+
+    def start_sampling(self, fast_rate=100, slow_rate=1):
+        '''
+        Starts a thread that keeps the latest state up to date
+
+        The thread is not the hardware thread of the asyncio runtime, so every read holds i2cLock instead
+
+        Arguments:
+            fast_rate: (optional) How many times per second orientation and acceleration are read
+            slow_rate: (optional) How many times per second temperature and calibration are read
+        '''
+        if self.sampling:
+            return
+        self.sampling = True
+        self.samplerThread = threading.Thread(target=self.sample, args=(fast_rate, slow_rate), daemon=True)
+        self.samplerThread.start()
+
+    def stop_sampling(self):
+        '''
+        Stops the sampler thread
+        '''
+        self.sampling = False
+        if self.samplerThread:
+            self.samplerThread.join()
+            self.samplerThread = None
+
+    def sample(self, fast_rate, slow_rate):
+        fastPeriod = 1/fast_rate
+        slowPeriod = 1/slow_rate
+        nextFast = time.perf_counter()
+        nextSlow = nextFast
+        while self.sampling:
+            # Only this thread changes raw, readers only see the state built from it
+            try:
+                for field in IMU_FAST_FIELDS:
+                    self.raw[field] = self.read_field(field)
+                if time.perf_counter() >= nextSlow:
+                    for field in IMU_SLOW_FIELDS:
+                        self.raw[field] = self.read_field(field)
+                    nextSlow += slowPeriod
+                self.latest = (time.time(), self.build_state(self.raw))
+                self.samplerStats["samples"] += 1
+            except Exception as err:
+                # A bad I2C read should not stop the sampler, the state just gets older until a read works (see sample_age)
+                self.samplerStats["errors"] += 1
+                self.samplerStats["lastError"] = repr(err)
+                logger.warning("Reading the IMU failed: %r", err)
+
+            # Sleep until the next sample, if the reads took too long, skip ahead instead of catching up
+            nextFast += fastPeriod
+            delay = nextFast - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                self.samplerStats["overruns"] += 1
+                nextFast = time.perf_counter()
+                nextSlow = max(nextSlow, nextFast - slowPeriod)
+
+    def sample_stats(self):
+        '''
+        Returns how long each field takes to read, how often the sampler fell behind, and how many reads failed
+        '''
+        stats = {field: dict(fieldStats) for field, fieldStats in self.fieldStats.items()}
+        stats["sampler"] = dict(self.samplerStats)
+        return stats
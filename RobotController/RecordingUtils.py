@@ -0,0 +1,291 @@
+'''
+This file has tools for recording every packet that goes through a node, and replaying the recordings later
+'''
+
+# Import necessary libraries
+import os
+import time
+import struct
+import bisect
+import threading
+from queue import Queue, Empty, Full
+
+import CommunicationUtils
+
+# A recording (one dive) is a folder of segment files, each with an index file next to it
+#  * Every segment starts with: [magic][version][wall clock start time][monotonic start time]
+#  * Then each record is: [monotonic capture time][frame] (the frame is exactly what CommunicationUtils.encodeMsg makes)
+#  * The index has an entry every indexInterval seconds: [monotonic capture time][offset of the record in the segment]
+SEGMENT_MAGIC = b"ROVREC"
+SEGMENT_VERSION = 1
+SEGMENT_HEADER = struct.Struct("!6sBdd")
+RECORD_HEADER = struct.Struct("!d")
+INDEX_ENTRY = struct.Struct("!dQ")
+
+SEGMENT_NAME = "segment-{:05d}.rec"
+INDEX_NAME = "segment-{:05d}.idx"
+
+# The struct codec covers the packets that are recorded the most (sensor, motorData and cam)
+# JSON is always last, because it can encode everything else
+RECORD_CODECS = [codecId for codecId in CommunicationUtils.CODEC_PREFERENCE if codecId in CommunicationUtils.codecs]
+
+class FlightRecorder():
+    '''
+    Records packets to disk without slowing down the threads that publish them
+
+    record() only puts the packet in a queue, the packets are encoded and written by a background thread
+    It can be subscribed to a message bus directly:
+        bus.subscribeCallback(list(bus.topics), recorder.record)
+    '''
+    def __init__(self, path, segmentSize=64*1024*1024, segmentDuration=600, indexInterval=1.0, flushInterval=1.0, maxsize=1024):
+        '''
+        Arguments:
+            path: The folder to store recordings in, each recording gets its own folder inside of it
+            segmentSize: (optional) The size in bytes a segment can grow to before a new one is started
+            segmentDuration: (optional) The number of seconds a segment can cover before a new one is started
+            indexInterval: (optional) The number of seconds between index entries
+            flushInterval: (optional) The maximum number of seconds packets wait in memory before they are written
+            maxsize: (optional) The maximum number of packets that can wait to be written, new packets are dropped after that
+        '''
+        self.path = path
+        self.segmentSize = segmentSize
+        self.segmentDuration = segmentDuration
+        self.indexInterval = indexInterval
+        self.flushInterval = flushInterval
+
+        self.queue = Queue(maxsize)
+        self.thread = None
+        self.recordingPath = None
+        self.stats = {
+            "recorded": 0,
+            "dropped": 0,
+            "failed": 0,
+            "bytes": 0,
+            "segments": 0
+        }
+
+    def start(self):
+        '''
+        Creates a new recording folder and starts the writer thread
+
+        Returns:
+            The path of the recording folder
+        '''
+        self.recordingPath = os.path.join(self.path, time.strftime("dive-%Y%m%d-%H%M%S"))
+        os.makedirs(self.recordingPath, exist_ok=True)
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+        return self.recordingPath
+
+    def stop(self):
+        '''
+        Writes every packet that is still waiting and closes the recording
+        '''
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def record(self, pckt):
+        '''
+        Adds a packet to the recording, this can be called from any thread
+
+        Arguments:
+            pckt: The packet to record
+        '''
+        try:
+            self.queue.put_nowait((time.monotonic(), pckt))
+        except Full:
+            # Never hold up the publisher, the recording just misses the packet
+            self.stats["dropped"] += 1
+
+    def write(self):
+        segment = None
+        segmentNum = 0
+        lastFlush = time.monotonic()
+        try:
+            while True:
+                try:
+                    item = self.queue.get(timeout=self.flushInterval)
+                except Empty:
+                    item = False
+                if item is None:
+                    break
+
+                if item:
+                    captureTime, pckt = item
+                    try:
+                        frame = CommunicationUtils.encodeMsg(pckt, RECORD_CODECS)
+                    except (TypeError, ValueError, OverflowError):
+                        # The packet has data that can not be encoded
+                        self.stats["failed"] += 1
+                        continue
+
+                    # Start a new segment if the current one is full
+                    if segment is None or segment.size >= self.segmentSize or captureTime - segment.startTime >= self.segmentDuration:
+                        if segment:
+                            segment.close()
+                        segment = RecordingSegment(self.recordingPath, segmentNum, captureTime)
+                        segmentNum += 1
+                        self.stats["segments"] += 1
+
+                    segment.write(captureTime, frame, self.indexInterval)
+                    self.stats["recorded"] += 1
+                    self.stats["bytes"] += RECORD_HEADER.size + len(frame)
+
+                # Write everything that is buffered to disk every so often, so a crash loses at most flushInterval seconds
+                if segment and time.monotonic() - lastFlush >= self.flushInterval:
+                    segment.flush()
+                    lastFlush = time.monotonic()
+        finally:
+            if segment:
+                segment.close()
+
+class RecordingSegment():
+    '''
+    A single segment file of a recording and its index, only used by the FlightRecorder writer thread
+    '''
+    def __init__(self, recordingPath, num, startTime):
+        self.file = open(os.path.join(recordingPath, SEGMENT_NAME.format(num)), "wb", buffering=1024*1024)
+        self.indexFile = open(os.path.join(recordingPath, INDEX_NAME.format(num)), "wb")
+        self.startTime = startTime
+        self.lastIndexTime = None
+
+        # The monotonic clock only makes sense inside of one run, so the wall clock time is stored with it
+        self.file.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, time.time(), startTime))
+        self.size = SEGMENT_HEADER.size
+
+    def write(self, captureTime, frame, indexInterval):
+        if self.lastIndexTime is None or captureTime - self.lastIndexTime >= indexInterval:
+            self.indexFile.write(INDEX_ENTRY.pack(captureTime, self.size))
+            self.lastIndexTime = captureTime
+
+        self.file.write(RECORD_HEADER.pack(captureTime))
+        self.file.write(frame)
+        self.size += RECORD_HEADER.size + len(frame)
+
+    def flush(self):
+        self.file.flush()
+        self.indexFile.flush()
+
+    def close(self):
+        self.file.close()
+        self.indexFile.close()
+
+class FlightReplayer():
+    '''
+    Reads a recording made by FlightRecorder and plays it back
+    '''
+    def __init__(self, recordingPath):
+        '''
+        Arguments:
+            recordingPath: The folder of the recording (FlightRecorder.start returns it)
+        '''
+        self.recordingPath = recordingPath
+
+        # Load the index of every segment, so any point in the recording can be found without reading all of it
+        self.index = []
+        num = 0
+        while os.path.exists(os.path.join(recordingPath, SEGMENT_NAME.format(num))):
+            with open(os.path.join(recordingPath, INDEX_NAME.format(num)), "rb") as indexFile:
+                entries = indexFile.read()
+            # A crash can leave half of an entry at the end
+            entries = entries[:len(entries) - len(entries) % INDEX_ENTRY.size]
+            for captureTime, offset in INDEX_ENTRY.iter_unpack(entries):
+                self.index.append((captureTime, num, offset))
+            num += 1
+        self.numSegments = num
+
+        if not self.index:
+            raise FileNotFoundError("There is no recording at {}".format(recordingPath))
+        self.startTime = self.index[0][0]
+        self.indexTimes = [entry[0] for entry in self.index]
+
+    def packets(self, start=0, end=None, tags=None):
+        '''
+        Reads the recorded packets in order
+
+        Arguments:
+            start: (optional) Where to start reading, in seconds from the start of the recording
+            end: (optional) Where to stop reading, in seconds from the start of the recording
+            tags: (optional) Only read packets with these tags
+
+        Returns:
+            A generator of (seconds from the start of the recording, packet)
+        '''
+        # Jump to the last index entry before the start
+        entry = max(bisect.bisect_right(self.indexTimes, self.startTime + start) - 1, 0)
+        _, num, offset = self.index[entry]
+
+        while num < self.numSegments:
+            with open(os.path.join(self.recordingPath, SEGMENT_NAME.format(num)), "rb", buffering=1024*1024) as segment:
+                if offset == 0:
+                    self.readSegmentHeader(segment)
+                else:
+                    segment.seek(offset)
+
+                while True:
+                    head = segment.read(RECORD_HEADER.size + CommunicationUtils.FRAME_HEADER.size)
+                    if len(head) < RECORD_HEADER.size + CommunicationUtils.FRAME_HEADER.size:
+                        break
+                    captureTime = RECORD_HEADER.unpack_from(head)[0] - self.startTime
+                    header = CommunicationUtils.FRAME_HEADER.unpack_from(head, RECORD_HEADER.size)
+                    payload = segment.read(header[0])
+                    if len(payload) < header[0]:
+                        # The recording stopped in the middle of this record
+                        break
+
+                    if captureTime < start:
+                        continue
+                    if end is not None and captureTime > end:
+                        return
+
+                    pckt = CommunicationUtils.decodeFrame(header, payload)
+                    if tags is None or pckt["tag"] in tags:
+                        yield captureTime, pckt
+            num += 1
+            offset = 0
+
+    def readSegmentHeader(self, segment):
+        magic, version, wallStart, monotonicStart = SEGMENT_HEADER.unpack(segment.read(SEGMENT_HEADER.size))
+        if magic != SEGMENT_MAGIC:
+            raise CommunicationUtils.FrameError("{} is not a recording segment".format(segment.name))
+        if version != SEGMENT_VERSION:
+            raise CommunicationUtils.FrameError("Recording version {} is not supported (expected {})".format(version, SEGMENT_VERSION))
+        return wallStart, monotonicStart
+
+    def play(self, publish, speed=1.0, start=0, end=None, tags=None, keepRunning=None, select=None):
+        '''
+        Plays the recording back by publishing every packet at the time it was recorded
+
+        Arguments:
+            publish: The function to call with each packet (like EarthNode.handlePacket)
+            speed: (optional) How fast to play the recording, 1 is real time, 0 or None is as fast as possible
+            start: (optional) Where to start playing, in seconds from the start of the recording
+            end: (optional) Where to stop playing, in seconds from the start of the recording
+            tags: (optional) Only play packets with these tags
+            keepRunning: (optional) Function that returns False when playback should stop early
+            select: (optional) Function that returns False for packets that should not be played
+
+        Returns:
+            The number of packets that were played
+        '''
+        played = 0
+        playStart = time.monotonic()
+        for captureTime, pckt in self.packets(start, end, tags):
+            if keepRunning and not keepRunning():
+                break
+            if select and not select(pckt):
+                continue
+
+            if speed:
+                # Wait until it is time for this packet, checking if we should stop every so often
+                while True:
+                    delay = playStart + (captureTime - start)/speed - time.monotonic()
+                    if delay <= 0 or (keepRunning and not keepRunning()):
+                        break
+                    time.sleep(min(delay, 0.1))
+
+            publish(pckt)
+            played += 1
+        return played
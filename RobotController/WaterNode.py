@@ -13,19 +13,21 @@ simpleMode = False
 # Check if the program is in testing mode and enable it if so
 parser = argparse.ArgumentParser()
 parser.add_argument("-s", "--simple", help="run the program in simple mode (fake data and no special libraries). Useful for running on any device not in the robot", action="store_true")
+parser.add_argument("-a", "--asyncio", help="run the program with the asyncio runtime instead of one thread per job", action="store_true")
+parser.add_argument("-d", "--debug", help="log debugging messages too", action="store_true")
 args = parser.parse_args()
 
 simpleMode = args.simple
 
-'''
 # Imports for Logging
 import logging
-from pythonjsonlogger import jsonslogger
-'''
+import nodeLogger
 
 # Imports for Threading
 import threading
-from queue import Queue
+import asyncio
+from queue import Queue, Empty, Full
+import AsyncUtils
 
 # Imports for Video Streaming
 sys.path.insert(0, 'imagezmq/imagezmq')
@@ -62,21 +64,37 @@ settings = {
 		"x": 640,
 		"y": 480
 	},
-	"v4l2QueueNum": 1
+	"v4l2QueueNum": 1,
+	"sensorPeriod": 0.05,
+	"imuFastRate": 100,
+	"imuSlowRate": 1,
+	"controlRate": 100,
+	"commandTimeout": 0.5,
+	# The IMU state is not used to stabilize if it is older than this (in seconds)
+	"imuTimeout": 0.25,
+	"logPath": "debug/water-node.log"
 }
 
 # Dict to stop threads
 execute = {
 	"streamVideo": True,
 	"sendData": True,
-	"receiveData": True
+	"receiveData": True,
+	"controlLoop": True
 }
 
 
 # Queue, Logger, and Class for Multithreaded Logging Communication
 lock = threading.Lock()
+logger = logging.getLogger("WaterNode")
+
+# Log records that are waiting to be sent to the Earth Node (and from there, to the air node)
+logPackets = Queue(256)
 restartCamStream = False
 
+# The asyncio runtime, if the program is running with it
+runtime = None
+
 # IMU and PWM interface classes
 IMU = HardwareUtils.IMUFusion()
 SD = HardwareUtils.ServoDriver([(0, "WP120T"), (14, "T100"), (9, "T100"), (10, "T100"), (8, "T100"), (15, "T100"), (13, "T100"), (11, "T100"), (12, "T100")], frequency=330)
@@ -92,6 +110,15 @@ DC = ControllerUtils.DriveController(flip=[0,0,0,1,0,1,1,0])
 mode = "user-control"
 override = False
 
+# The newest drivetrain command from the Earth Node, and when it arrived
+operatorCommand = (0, [0]*6)
+
+# The control loop and the command handler both change the PID controllers
+controlLock = threading.Lock()
+controlTimer = ControllerUtils.LoopTimer(settings["controlRate"])
+# Control steps that failed (like an I2C write to the servo driver), the loop keeps running through them
+controlStats = {"errors": 0, "lastError": None}
+
 rot = {
 	"x": {
 		"Kp": 1/30,
@@ -113,8 +140,6 @@ xRotPID = PID(rot["x"]["Kp"], rot["x"]["Kd"], rot["x"]["Ki"], setpoint=0)
 yRotPID = PID(rot["y"]["Kp"], rot["y"]["Kd"], rot["y"]["Ki"], setpoint=0)
 zRotPID = PID(rot["z"]["Kp"], rot["z"]["Kd"], rot["z"]["Ki"], setpoint=0)
 
-imu_state = IMU.get_full_state()
-
 def stopAllThreads(callback=0):
 	""" Stops all currently running threads
 		
@@ -125,8 +150,34 @@ def stopAllThreads(callback=0):
 	execute['streamVideo'] = False
 	execute['receiveData'] = False
 	execute['sendData'] = False
+	execute['controlLoop'] = False
+	if runtime:
+		runtime.stop()
+	IMU.stop_sampling()
 	time.sleep(0.5)
 
+def queueLogPacket(pckt):
+	""" Queues a log packet to be sent to the Earth Node with the next sensor packet
+		It is called from the logging thread, so it must never wait
+
+		Arguments:
+			pckt: the log packet
+	"""
+	try:
+		logPackets.put_nowait(pckt)
+	except Full:
+		pass
+
+def takeLogPackets():
+	""" Takes all of the log packets that are waiting to be sent
+	"""
+	pckts = []
+	while True:
+		try:
+			pckts.append(logPackets.get_nowait())
+		except Empty:
+			return pckts
+
 def restartVideoStream():
 	lock.acquire()
 	try:
@@ -219,6 +270,157 @@ def sendVideoStreams(debug=False):
 				finally:
 					lock.release()
 
+def handleCommand(recv):
+	""" Handles a single message from the Earth Node
+		Each message is handled differently based on its tag and metatdata
+
+		Arguments:
+			recv: the recieved message
+	"""
+	global restartCamStream
+	global mode
+	global override
+	global operatorCommand
+
+	#print(time.time() - recv['timestamp'], recv['tag'])
+	if recv['tag'] == 'stateChange':
+		if recv['data'] == 'close':
+			stopAllThreads()
+		elif recv['data'] == 'restartCamStream':
+			restartCamStream = True
+		elif recv['metadata'] == 'hold-angle':
+			with controlLock:
+				# Reset PID rotation controllers
+				xRotPID.reset()
+				yRotPID.reset()
+				#zRotPID.reset()
+				xRotPID.tunings = (rot["x"]["Kp"], rot["x"]["Kd"], rot["x"]["Ki"])
+				yRotPID.tunings = (rot["y"]["Kp"], rot["y"]["Kd"], rot["y"]["Ki"])
+				#zRotPID.tunings = (rot["Kp"], rot["Kd"], rot["Ki"])
+
+				# Assuming the robot has been correctly calibrated, (0,0,0) should be upright
+				xRotPID.setpoint = recv['data']['x']
+				yRotPID.setpoint = recv['data']['y']
+				#zRotPID.setpoint = stabilizeRot["z"]
+				mode = "hold-angle"
+
+		elif recv['metadata'] == 'override':
+			override = recv['data']
+		elif recv['metadata'] == 'stop-motors':
+			mode = 'user-control'
+		
+		elif recv['metadata'] == 'stabilize':
+			with controlLock:
+				xRotPID.reset()
+				yRotPID.reset()
+
+				xRotPID.tunings = (rot["x"]["Kp"], rot["x"]["Kd"], rot["x"]["Ki"])
+				yRotPID.tunings = (rot["y"]["Kp"], rot["y"]["Kd"], rot["y"]["Ki"])
+
+				xRotPID.setpoint = recv['data']['x']
+				yRotPID.setpoint = recv['data']['y']
+				# zRotPID.setpoint = recv['data']['z']
+				mode = 'stabilize'
+		
+
+		logger.info("%s override=%s mode=%s", recv, override, mode)
+
+	if recv['tag'] == 'config':
+		if recv['metadata'] == 'sync-time':
+			# TODO: We should really be using subprocess here, because os.system is depricated, but I can't get subprocess working
+			pass#os.system(f'sudo date --set="{ recv["data"] }"')
+			#subprocess.run(f'sudo date --set="{ recv["data"] }"')
+	elif recv['tag'] == 'settingChange':
+		if recv['metadata'] == 'imuStraighten':
+			IMU.set_offset(recv["data"])
+	elif recv['tag'] == "motorData":
+		if recv['metadata'] == "drivetrain":
+			if time.time() - recv['timestamp'] < 0.1:
+				# The control loop picks up the newest command on its next step
+				operatorCommand = (time.time(), recv['data'])
+	elif recv['tag'] == "gripData":
+		if recv['metadata'] == "arm-angle":
+			if time.time() - recv['timestamp'] < 0.1:
+				SD.move_servo(gripper_servo, recv['data'], 180, 20)
+				#print(recv['data'])
+				#pass
+
+def controlStep():
+	""" Runs a single step of the drivetrain control loop
+		The rotation PIDs are stepped with the newest IMU state, and the newest operator command drives everything else
+	"""
+	commandTime, command = operatorCommand
+
+	# If the Earth Node stops sending commands, stop driving instead of repeating the last one
+	if time.time() - commandTime > settings["commandTimeout"]:
+		command = [0]*6
+
+	with controlLock:
+		speeds = [0]*6
+		if (mode == "user-control" or override):
+			speeds = DC.calcMotorValues(command[0],
+										command[1],
+										command[2],
+										command[3],
+										command[4],
+										command[5])
+		elif (mode == 'hold-angle' or mode == 'stabilize') and IMU.sample_age() > settings["imuTimeout"]:
+			# The IMU has stopped updating, so only the operator drives instead of the PIDs acting on an old attitude
+			logger.warning("The IMU state is %.2f seconds old, not stabilizing", IMU.sample_age())
+			speeds = DC.calcMotorValues(command[0],
+										command[1],
+										command[2],
+										command[3],
+										command[4],
+										command[5])
+		elif mode == 'hold-angle' or mode == 'stabilize':
+			_, imu_state = IMU.get_latest()
+			xTgt = xRotPID(imu_state.gyroX)
+			yTgt = yRotPID(imu_state.gyroY)
+
+			speeds = DC.calcMotorValues(command[0],
+										command[1],
+										command[2],
+										xTgt,
+										yTgt,
+										command[5])
+
+	# Thrusters that have not changed are not written again
+	SD.set_servos([(drivetrain_motor_mapping[loc], spd*0.5) for loc,spd in enumerate(speeds)])
+
+def safeControlStep():
+	""" Runs a single step of the drivetrain control loop, a failed step is logged and counted instead of stopping the loop
+	"""
+	try:
+		controlStep()
+	except Exception as err:
+		controlStats["errors"] += 1
+		controlStats["lastError"] = repr(err)
+		logger.warning("controlStep failed: %r", err)
+
+def stopThrusters():
+	""" Stops all of the thrusters, the servo driver would keep driving them at the last speed otherwise
+	"""
+	try:
+		SD.set_all_servos(0, only_type="T100")
+	except Exception as err:
+		logger.error("Stopping the thrusters failed: %r", err)
+
+def controlLoop(debug=False):
+	""" Runs the drivetrain control loop at a fixed rate, no matter when commands arrive
+
+		Arguments:
+			debug: (optional) log debugging data
+	"""
+	try:
+		while execute['controlLoop']:
+			controlTimer.start()
+			safeControlStep()
+			time.sleep(controlTimer.finish())
+	finally:
+		stopThrusters()
+		logger.info("controlLoop stats %s errors %s", controlTimer.stats, controlStats)
+
 def receiveData(debug=False):
 	""" Recieves and processes JSON data from the Water Node
 		
@@ -227,11 +429,6 @@ def receiveData(debug=False):
 		Arguments:
 			debug: (optional) log debugging data
 	"""
-	global restartCamStream
-	global SD
-	global mode
-	global override
-
 	# Get the IP address and port of the earth node
 	HOST = CommunicationUtils.SIMPLE_EARTH_IP if simpleMode else CommunicationUtils.EARTH_IP
 	PORT = CommunicationUtils.CNTLR_PORT
@@ -243,119 +440,36 @@ def receiveData(debug=False):
 	try:
 		# Try to connect
 		cntlr.connect((HOST, PORT))
-		print("receiveData inital connection check succeded")
+		# Tell the Earth Node which codecs we can decode
+		CommunicationUtils.sendCodecs(cntlr)
+		logger.info("receiveData inital connection check succeded")
 	except ConnectionRefusedError:
 		connected = False
-		print("receiveData inital connection check failed")
-	
+		logger.warning("receiveData inital connection check failed")
+	framer = CommunicationUtils.MessageFramer(cntlr)
+
 	while execute['receiveData']:
 		try:
 			# Recieve messages over the socket, each message is handled differently based on its tag and metatdata
-			recv = CommunicationUtils.recvMsg(cntlr)
-			#print(time.time() - recv['timestamp'], recv['tag'])
-			if recv['tag'] == 'stateChange':
-				if recv['data'] == 'close':
-					stopAllThreads()
-				elif recv['data'] == 'restartCamStream':
-					restartCamStream = True
-				elif recv['metadata'] == 'hold-angle':
-					# Reset PID rotation controllers
-					xRotPID.reset()
-					yRotPID.reset()
-					#zRotPID.reset()
-					xRotPID.tunings = (rot["x"]["Kp"], rot["x"]["Kd"], rot["x"]["Ki"])
-					yRotPID.tunings = (rot["y"]["Kp"], rot["y"]["Kd"], rot["y"]["Ki"])
-					#zRotPID.tunings = (rot["Kp"], rot["Kd"], rot["Ki"])
-
-					# Assuming the robot has been correctly calibrated, (0,0,0) should be upright
-					xRotPID.setpoint = recv['data']['x']
-					yRotPID.setpoint = recv['data']['y']
-					#zRotPID.setpoint = stabilizeRot["z"]
-					mode = "hold-angle"
-
-				elif recv['metadata'] == 'override':
-					override = recv['data']
-				elif recv['metadata'] == 'stop-motors':
-					mode = 'user-control'
-				
-				elif recv['metadata'] == 'stabilize':
-					xRotPID.reset()
-					yRotPID.reset()
-
-					xRotPID.tunings = (rot["x"]["Kp"], rot["x"]["Kd"], rot["x"]["Ki"])
-					yRotPID.tunings = (rot["y"]["Kp"], rot["y"]["Kd"], rot["y"]["Ki"])
+			recv = framer.recvMsg()
+			handleCommand(recv)
 
-					xRotPID.setpoint = recv['data']['x']
-					yRotPID.setpoint = recv['data']['y']
-                    # zRotPID.setpoint = recv['data']['z']
-					mode = 'stabilize'
-				
-
-				print(recv, override, mode)
-
-			if recv['tag'] == 'config':
-					if recv['metadata'] == 'sync-time':
-						# TODO: We should really be using subprocess here, because os.system is depricated, but I can't get subprocess working
-						pass#os.system(f'sudo date --set="{ recv["data"] }"')
-						#subprocess.run(f'sudo date --set="{ recv["data"] }"')
-			elif recv['tag'] == 'settingChange':
-				if recv['metadata'] == 'imuStraighten':
-					IMU.set_offset(recv["data"])
-			elif recv['tag'] == "motorData":
-				if recv['metadata'] == "drivetrain":
-					if time.time() - recv['timestamp'] < 0.1:
-						speeds = [0]*6
-						if (mode == "user-control" or override):
-							speeds = DC.calcMotorValues(recv['data'][0],
-														recv['data'][1],
-														recv['data'][2],
-														recv['data'][3],
-														recv['data'][4],
-														recv['data'][5])
-						elif mode == 'hold-angle':
-							xTgt = xRotPID(imu_state["imu"]["gyro"]["x"])
-							yTgt = yRotPID(imu_state["imu"]["gyro"]["y"])
-
-							speeds = DC.calcMotorValues(recv['data'][0],
-														recv['data'][1],
-														recv['data'][2],
-														xTgt,
-														yTgt,
-														recv['data'][5])
-						elif mode == 'stabilize':
-							xTgt = xRotPID(imu_state["imu"]["gyro"]["x"])
-							yTgt = yRotPID(imu_state["imu"]["gyro"]["y"])
-
-							speeds = DC.calcMotorValues(recv['data'][0],
-														recv['data'][1],
-														recv['data'][2],
-														xTgt,
-														yTgt,
-														recv['data'][5])
-
-
-						#print(recv['data'])
-						for loc,spd in enumerate(speeds):
-							SD.set_servo(drivetrain_motor_mapping[loc], spd*0.5)
-			elif recv['tag'] == "gripData":
-				if recv['metadata'] == "arm-angle":
-					if time.time() - recv['timestamp'] < 0.1:
-						SD.move_servo(gripper_servo, recv['data'], 180, 20)
-						#print(recv['data'])
-						#pass
-
-		# If we loose connection, try to reconnect
-		except (OSError):
-			print("receiveData connection lost")
+		# If we loose connection, or the stream can not be read any more, try to reconnect
+		except (OSError, CommunicationUtils.MessageTimeoutError, CommunicationUtils.FrameError) as err:
+			logger.warning("receiveData connection lost: %r", err)
 			connected = False
+			# A timed out or malformed frame leaves the stream out of sync, so the old socket is dropped
+			cntlr.close()
 			cntlr = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 			while (not connected) and execute['sendData']:
 				try:
 					cntlr.connect((HOST, PORT))
 					connected = True
-					print("receiveData successful reconnection")
+					framer = CommunicationUtils.MessageFramer(cntlr)
+					CommunicationUtils.sendCodecs(cntlr)
+					logger.info("receiveData successful reconnection")
 				except ConnectionRefusedError:
-					print("receiveData reconnect failed. trying in 2 seconds")
+					logger.warning("receiveData reconnect failed. trying in 2 seconds")
 					time.sleep(2)
 	# Close the socket connection
 	cntlr.close()
@@ -368,9 +482,6 @@ def sendData(debug=False):
 		Arguments:
 			debug: (optional) log debugging data
 	"""
-	global IMU
-	global imu_state
-
 	# Get the IP address and port of the earth node
 	HOST = CommunicationUtils.SIMPLE_EARTH_IP if simpleMode else CommunicationUtils.EARTH_IP
 	PORT = CommunicationUtils.SNSR_PORT
@@ -378,59 +489,167 @@ def sendData(debug=False):
 	# Create the socket connection
 	connected = True
 	snsr = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	useCodecs = [CommunicationUtils.CODEC_JSON]
 
 	try:
 		# Try to connect
 		snsr.connect((HOST, PORT))
-		print("sendData inital connection check succeded")
+		# Find out which codecs the Earth Node can decode
+		useCodecs = CommunicationUtils.negotiateCodecs(CommunicationUtils.MessageFramer(snsr))
+		logger.info("sendData inital connection check succeded")
 	except ConnectionRefusedError:
 		connected = False
-		print("sendData inital connection check failed")
+		logger.warning("sendData inital connection check failed")
 	
 	lastMsgTime = time.time()
 	
 	while execute['sendData']:
 		try:
-			# Get gyro, accel readings
-			sensors = IMU.get_full_state()
+			# Get the newest gyro, accel readings from the IMU sampler
+			_, sensors = IMU.get_latest()
 
-			imu_state = sensors
-			
 			# TODO: Update this with a proper sleep loop time managment system thing
-			CommunicationUtils.sendMsg(snsr, CommunicationUtils.packet(tag="sensor",data=sensors))
-			time.sleep(0.05)
+			# Any waiting log records are sent along with the sensor data
+			CommunicationUtils.sendMsgs(snsr, [CommunicationUtils.packet(tag="sensor",data=sensors)] + takeLogPackets(), useCodecs)
+			time.sleep(settings["sensorPeriod"])
 
 		# If we loose connection, try to reconnect
 		except (ConnectionResetError, BrokenPipeError):
-			print("sendData connection lost")
+			logger.warning("sendData connection lost")
 			connected = False
 			snsr = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 			while (not connected) and execute['sendData']:
 				try:
 					snsr.connect((HOST, PORT))
 					connected = True
-					print("sendData successful reconnection")
+					useCodecs = CommunicationUtils.negotiateCodecs(CommunicationUtils.MessageFramer(snsr))
+					logger.info("sendData successful reconnection")
 				except ConnectionRefusedError:
-					print("sendData reconnect failed. trying in 2 seconds")
+					logger.warning("sendData reconnect failed. trying in 2 seconds")
 					time.sleep(2)
 	# Close the socket connection
 	snsr.close()
 
+### ASYNCIO RUNTIME ###
+
+async def sendVideoStreamsAsync():
+	""" Runs sendVideoStreams in a thread, because reading cameras and ZMQ are blocking
+	"""
+	try:
+		await runtime.runBlocking(sendVideoStreams)
+	finally:
+		# Let the thread finish when the runtime is stopped
+		execute['streamVideo'] = False
+
+async def controlLoopAsync():
+	""" Runs the drivetrain control loop at a fixed rate on the hardware thread
+	"""
+	try:
+		while True:
+			controlTimer.start()
+			await runtime.runHardware(safeControlStep)
+			await asyncio.sleep(controlTimer.finish())
+	finally:
+		# This is queued on the hardware thread without waiting, the task may already be cancelled,
+		# and the runtime waits for the hardware thread to finish before it exits
+		runtime.hardwareExecutor.submit(stopThrusters)
+		logger.info("controlLoop stats %s errors %s", controlTimer.stats, controlStats)
+
+async def receiveDataAsync():
+	""" Recieves and processes data from the Earth Node using asyncio streams
+	"""
+	# Get the IP address and port of the earth node
+	HOST = CommunicationUtils.SIMPLE_EARTH_IP if simpleMode else CommunicationUtils.EARTH_IP
+	PORT = CommunicationUtils.CNTLR_PORT
+
+	while True:
+		try:
+			reader, writer = await asyncio.open_connection(HOST, PORT)
+		except OSError:
+			logger.warning("receiveData connection failed. trying in 2 seconds")
+			await asyncio.sleep(2)
+			continue
+
+		logger.info("receiveData connected")
+		try:
+			# Tell the Earth Node which codecs we can decode
+			await AsyncUtils.sendCodecs(writer)
+			while True:
+				recv = await AsyncUtils.recvMsg(reader)
+				# Commands can write to the servo driver, so they are run on the hardware thread
+				await runtime.runHardware(handleCommand, recv)
+		# A timed out or malformed frame leaves the stream out of sync, so reconnect like a lost connection
+		except (OSError, CommunicationUtils.MessageTimeoutError, CommunicationUtils.FrameError) as err:
+			logger.warning("receiveData connection lost: %r", err)
+		finally:
+			writer.close()
+
+async def sendSensorsAsync(writer, useCodecs):
+	""" Reads the sensors and sends their state to the Earth Node
+	"""
+	_, sensors = IMU.get_latest()
+	await AsyncUtils.sendMsgs(writer, [CommunicationUtils.packet(tag="sensor", data=sensors)] + takeLogPackets(), useCodecs)
+
+async def sendDataAsync():
+	""" Sends sensor data to the Earth Node at a fixed rate using asyncio streams
+	"""
+	# Get the IP address and port of the earth node
+	HOST = CommunicationUtils.SIMPLE_EARTH_IP if simpleMode else CommunicationUtils.EARTH_IP
+	PORT = CommunicationUtils.SNSR_PORT
+
+	while True:
+		try:
+			reader, writer = await asyncio.open_connection(HOST, PORT)
+		except OSError:
+			logger.warning("sendData connection failed. trying in 2 seconds")
+			await asyncio.sleep(2)
+			continue
+
+		logger.info("sendData connected")
+		try:
+			# Find out which codecs the Earth Node can decode
+			useCodecs = await AsyncUtils.negotiateCodecs(reader)
+			await AsyncUtils.runPeriodic(settings["sensorPeriod"], sendSensorsAsync, writer, useCodecs)
+		except OSError:
+			logger.warning("sendData connection lost")
+		finally:
+			writer.close()
+
 if( __name__ == "__main__"):
 	# Setup Logging preferences
 	verbose = [False,True]
+	logListener = nodeLogger.setupLogging(logging.DEBUG if args.debug else logging.INFO, logPath=settings["logPath"],
+										 publish=queueLogPacket, node="WaterNode")
+
+	# Keep the IMU state up to date in the background
+	IMU.start_sampling(settings["imuFastRate"], settings["imuSlowRate"])
 	
-	# Start all of the threads for communication
-	vidStreamThread = threading.Thread(target=sendVideoStreams, args=(verbose[0],))
-	recvDataThread = threading.Thread(target=receiveData, args=(verbose[0],))
-	sendDataThread = threading.Thread(target=sendData, args=(verbose[0],))
-	vidStreamThread.start()
-	recvDataThread.start()
-	sendDataThread.start()
-
-	# We don't want the program to end uptil all of the threads are stopped
-	while execute['streamVideo'] and execute['receiveData'] and execute['sendData']:
-		time.sleep(0.1)
-	recvDataThread.join()
-	sendDataThread.join()
-	vidStreamThread.join()
+	if args.asyncio:
+		# Run all of the jobs on one event loop, until the runtime is stopped
+		runtime = AsyncUtils.NodeRuntime()
+		runtime.addTask(sendVideoStreamsAsync)
+		runtime.addTask(receiveDataAsync)
+		runtime.addTask(sendDataAsync)
+		runtime.addTask(controlLoopAsync)
+		runtime.run()
+	else:
+		# Start all of the threads for communication
+		vidStreamThread = threading.Thread(target=sendVideoStreams, args=(verbose[0],))
+		recvDataThread = threading.Thread(target=receiveData, args=(verbose[0],))
+		sendDataThread = threading.Thread(target=sendData, args=(verbose[0],))
+		controlLoopThread = threading.Thread(target=controlLoop, args=(verbose[0],))
+		vidStreamThread.start()
+		recvDataThread.start()
+		sendDataThread.start()
+		controlLoopThread.start()
+
+		# We don't want the program to end uptil all of the threads are stopped
+		while execute['streamVideo'] and execute['receiveData'] and execute['sendData']:
+			time.sleep(0.1)
+		recvDataThread.join()
+		sendDataThread.join()
+		vidStreamThread.join()
+		controlLoopThread.join()
+
+	# Write out any log records that are still waiting
+	logListener.stop()
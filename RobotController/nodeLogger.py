@@ -1,35 +1,139 @@
 '''
-At one point, this file was used as a custom logger. It should be brought back with the logging system
+This file has the logging system that is shared by the nodes
+
+The thread that logs only puts the record in a queue, a background listener thread formats and writes it,
+so logging never holds up the control loop or the communication threads
 '''
+import sys
+import time
 import logging
+import logging.handlers
+from queue import Queue, Full
 from pythonjsonlogger import jsonlogger
-from queue import Queue
 
+import CommunicationUtils
+
+LOG_FORMAT = "%(asctime)s - %(threadName)s - %(levelname)s - %(message)s"
+JSON_FORMAT = "%(asctime)s %(name)s %(threadName)s %(levelname)s %(message)s"
+
+class RateLimitFilter(logging.Filter):
+	'''
+	Lets through at most a certain number of records per second from each line of code that logs
+	The records that are thrown out are counted, and the count is added to the next record from that line
+
+	A single call can change its limit with extra={"rate": records_per_second}, None means no limit
+	'''
+	def __init__(self, rate=5):
+		super().__init__()
+		self.rate = rate
+		self.lastEmit = {}
+		self.suppressed = {}
+
+	def filter(self, record):
+		rate = getattr(record, "rate", self.rate)
+		if rate is None:
+			return True
+
+		callSite = (record.pathname, record.lineno)
+		if record.created - self.lastEmit.get(callSite, 0) < 1.0/rate:
+			self.suppressed[callSite] = self.suppressed.get(callSite, 0) + 1
+			return False
+
+		self.lastEmit[callSite] = record.created
+		record.suppressed = self.suppressed.pop(callSite, 0)
+		return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+	'''
+	A queue handler that throws out records when the queue is full instead of waiting for room
 
-log_queue = Queue(0)
+	Records are queued as they are, the handlers of the listener format them on its thread
+	Anything passed as an argument to a log call should not be changed after it is logged, it is formatted later
+	'''
+	def __init__(self, queue):
+		super().__init__(queue)
+		self.dropped = 0
+
+	def prepare(self, record):
+		# QueueHandler formats the record here, which would happen on the thread that logged
+		return record
+
+	def enqueue(self, record):
+		try:
+			self.queue.put_nowait(record)
+		except Full:
+			self.dropped += 1
+
+class PacketHandler(logging.Handler):
+	'''
+	Turns log records into "log" packets (with the metadata "node-log"), so they can be shown on the air node
+
+	It runs on the listener thread, so publish can take its time without slowing down the thread that logged
+	'''
+	def __init__(self, publish, level=logging.INFO, node=None):
+		'''
+		Arguments:
+			publish: The function to call with each packet
+			level: (optional) The lowest level of record to publish
+			node: (optional) The name of the node that is logging, it is added to every packet
+		'''
+		super().__init__(level)
+		self.publish = publish
+		self.node = node
 
-class nodeHandler(logging.Handler):
 	def emit(self, record):
-		global log_queue
+		try:
+			self.publish(CommunicationUtils.packet(tag="log", data={
+				"node": self.node,
+				"time": record.created,
+				"name": record.name,
+				"thread": record.threadName,
+				"level": record.levelname,
+				"message": self.format(record),
+				"suppressed": getattr(record, "suppressed", 0)
+			}, metadata="node-log", copy_data=False))
+		except Exception:
+			self.handleError(record)
+
+def setupLogging(level=logging.INFO, logPath=None, publish=None, publishLevel=logging.INFO, rate=5, maxsize=1024, node=None):
+	'''
+	Sends every log record of the program through a queue to a background listener
+
+	Arguments:
+		level: (optional) The lowest level of record to log
+		logPath: (optional) A file to write every record to as a line of JSON
+		publish: (optional) A function that records are sent to as packets (see PacketHandler)
+		publishLevel: (optional) The lowest level of record to publish
+		rate: (optional) The maximum number of records per second from each line of code that logs
+		maxsize: (optional) The maximum number of records that can wait in the queue, new records are dropped after that
+		node: (optional) The name of the node, it is added to the published packets so it is clear where they came from
+
+	Returns:
+		The listener, it should be stopped when the program ends so every record is written
+	'''
+	handlers = []
 
-		logEntry = self.format(record)
-		print(type(logEntry))
-		log_queue.put(logEntry)
+	# Human readable output, this used to be done with prints
+	consoleHandler = logging.StreamHandler(sys.stdout)
+	consoleHandler.setFormatter(logging.Formatter(LOG_FORMAT))
+	handlers.append(consoleHandler)
 
-logger = logging.getLogger(__name__)
+	if logPath:
+		fileHandler = logging.FileHandler(logPath)
+		fileHandler.setFormatter(jsonlogger.JsonFormatter(JSON_FORMAT))
+		handlers.append(fileHandler)
 
-jsonLogHandler = nodeHandler()
-jsonFormatter = jsonlogger.JsonFormatter("%(asctime)s %(threadName)s %(levelname)s %(message)s")
-jsonLogHandler.setFormatter(jsonFormatter)
-logger.addHandler(jsonLogHandler)
+	if publish:
+		handlers.append(PacketHandler(publish, publishLevel, node))
 
-logHandler = logging.StreamHandler()
-logFormatter = logging.Formatter("%(asctime)s - %(threadName)s - %(levelname)s - %(message)s")
-logHandler.setFormatter(logFormatter)
-logger.addHandler(logHandler)
-logger.setLevel(logging.DEBUG)
+	logQueue = Queue(maxsize)
+	queueHandler = DroppingQueueHandler(logQueue)
+	queueHandler.addFilter(RateLimitFilter(rate))
 
-logger.debug("this doesn't work")
+	root = logging.getLogger()
+	root.setLevel(level)
+	root.addHandler(queueHandler)
 
-print(log_queue.get())
-log_queue.task_done()
\ No newline at end of file
+	listener = logging.handlers.QueueListener(logQueue, *handlers, respect_handler_level=True)
+	listener.start()
+	return listener
@@ -0,0 +1,43 @@
+'''
+Compares the feature matchers (and grid detection) that alignImages can use
+Each image is warped by a known homography and aligned back, so the error of each matcher is known exactly
+'''
+
+# Import necessary libraries
+import os
+import sys
+import cv2
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(here, "..", "..", "RobotController"))
+import ComputerVisionUtils as cvu
+
+size = (cvu.width, cvu.height)
+corners = np.array([[[0, 0]], [[size[0], 0]], [[size[0], size[1]]], [[0, size[1]]]], dtype=np.float32)
+
+# A small rotation, zoom, and shift, like the camera would see
+truth = cv2.getRotationMatrix2D((size[0]/2, size[1]/2), 4, 0.9)
+truth = np.vstack([truth, [0, 0, 1]])
+truth[:2, 2] += (40, -25)
+
+def align(reference, img, matcher, grid):
+    cvu.feature_grid = grid
+    referenceFeatures = cvu.detectFeatures(reference)
+    mask = np.full(img.shape[:2], 255, np.uint8)
+    timings = {}
+    _, h = cvu.alignImages(reference, img, mask, referenceFeatures=referenceFeatures, matcher=matcher, drawMatches=False, timings=timings)
+    return h, timings
+
+for name in ["coral_old.png", "coral_2.png", "coral_7.png"]:
+    reference = cv2.resize(cv2.imread(os.path.join(here, name)), size)
+    # img is the reference as seen through truth, aligning it back should give the inverse of truth
+    img = cv2.warpPerspective(reference, truth, size)
+    expected = cv2.perspectiveTransform(corners, np.linalg.inv(truth))
+
+    print(name)
+    for matcher, grid in [("bf", None), ("bf-knn", None), ("flann-lsh", None), ("bf-knn", (8, 6)), ("flann-lsh", (8, 6))]:
+        h, timings = align(reference, img, matcher, grid)
+        error = np.abs(cv2.perspectiveTransform(corners, h) - expected).max()
+        print("  {:9} grid {:6} | {} | corners off by {:.1f} px".format(matcher, str(grid),
+            " ".join("{} {:.0f} ms".format(stage, seconds*1000) for stage, seconds in timings.items()), error))
@@ -0,0 +1,42 @@
+'''
+Checks that the integer subtraction (subtractImages) gives exactly the same image as the old float16 subtraction
+and times both of them
+'''
+
+# Import necessary libraries
+import os
+import sys
+import time
+import cv2
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(here, "..", "..", "RobotController"))
+import ComputerVisionUtils as cvu
+
+runs = 20
+
+def floatSubtraction(reference_blurred, img):
+    # How findCoralHealth used to do it
+    subtracted = reference_blurred.astype("float16") - cv2.GaussianBlur(img, cvu.blurKSize, cvu.blurAmmount).astype("float16")
+    return np.clip(np.abs(subtracted+64), 0, 255).astype("uint8")
+
+def timeIt(function, *args):
+    start = time.perf_counter()
+    for _ in range(runs):
+        function(*args)
+    return (time.perf_counter() - start) / runs * 1000
+
+size = (cvu.width, cvu.height)
+reference = cv2.resize(cv2.imread(os.path.join(here, "coral_old.png")), size)
+reference_blurred = cv2.GaussianBlur(reference, cvu.blurKSize, cvu.blurAmmount)
+
+# A gradient with every value, and real coral images
+pairs = [("gradient", np.tile(np.arange(256, dtype=np.uint8), (size[1], size[0]//256 + 1))[:, :size[0], None].repeat(3, axis=2))]
+for name in ["coral_1.png", "coral_2.png", "coral_7-difficult.png"]:
+    pairs.append((name, cv2.resize(cv2.imread(os.path.join(here, name)), size)))
+
+for name, img in pairs:
+    same = np.array_equal(floatSubtraction(reference_blurred, img), cvu.subtractImages(reference_blurred, img))
+    print("{}: {} | float16 {:.2f} ms | int16 {:.2f} ms".format(name, "identical" if same else "DIFFERENT",
+        timeIt(floatSubtraction, reference_blurred, img), timeIt(cvu.subtractImages, reference_blurred, img)))
@@ -0,0 +1,47 @@
+'''
+Checks that the single pass kernels used by detectLines make exactly the same mask as the old iterated 3x3 kernel
+and times both of them on the test images
+'''
+
+# Import necessary libraries
+import os
+import sys
+import time
+import cv2
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(here, "..", "..", "RobotController"))
+import ComputerVisionUtils as cvu
+
+runs = 50
+
+def iterated(mask, scale):
+    filtered = cv2.erode(mask, cvu.lf_kernel, iterations=1)
+    filtered = cv2.dilate(filtered, cvu.lf_kernel, iterations=max(1, int(round(15/scale))))
+    return cv2.erode(filtered, cvu.lf_kernel, iterations=max(1, int(round(9/scale))))
+
+def singlePass(mask, scale):
+    erodeKernel, dilateKernel, closeKernel = cvu.lineFollowingKernels(scale)
+    filtered = cv2.erode(mask, erodeKernel)
+    filtered = cv2.dilate(filtered, dilateKernel)
+    return cv2.erode(filtered, closeKernel)
+
+def timeIt(function, mask, scale):
+    start = time.perf_counter()
+    for _ in range(runs):
+        function(mask, scale)
+    return (time.perf_counter() - start) / runs * 1000
+
+for name in sorted(os.listdir(here)):
+    if not name.endswith(".png"):
+        continue
+    img = cv2.imread(os.path.join(here, name))
+    for scale in (1, cvu.lf_decode_scale):
+        small = cv2.resize(img, None, fx=1/scale, fy=1/scale, interpolation=cv2.INTER_AREA) if scale != 1 else img
+        mask = cv2.inRange(cv2.cvtColor(small, cv2.COLOR_BGR2HSV), cvu.lf_lower_blue, cvu.lf_upper_blue)
+
+        same = np.array_equal(iterated(mask, scale), singlePass(mask, scale))
+        print("{} scale {} {}x{}: {} | iterated {:.3f} ms | single pass {:.3f} ms".format(
+            name, scale, mask.shape[1], mask.shape[0], "identical" if same else "DIFFERENT",
+            timeIt(iterated, mask, scale), timeIt(singlePass, mask, scale)))
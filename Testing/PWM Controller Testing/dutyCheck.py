@@ -0,0 +1,29 @@
+'''
+Checks that ServoDriver.set_servos writes the same registers as the adafruit servo objects
+If they are different, the thrusters will not be at neutral when they are set to 0
+
+Run it with nothing plugged into the servo driver, every servo is moved to the middle of its range
+'''
+import sys
+sys.path.insert(0, "../../RobotController")
+from HardwareUtils import ServoDriver
+
+# The same servos as the water node
+sd = ServoDriver([(0, "WP120T"), (14, "T100"), (9, "T100"), (10, "T100"), (8, "T100"), (15, "T100"), (13, "T100"), (11, "T100"), (12, "T100")], frequency=330)
+print("Requested 330 Hz, the PCA9685 runs at {:.2f} Hz".format(sd.pca.frequency))
+
+failed = False
+for loc, entry in enumerate(sd.servos):
+    if entry is None:
+        continue
+    s, s_type = entry
+    # fraction 0.5 is neutral for the thrusters (throttle 0) and the middle angle for the servos
+    s.fraction = 0.5
+    on, off = sd.pca.pwm_regs[loc]
+    target = 0 if s_type == "T100" else s.actuation_range/2
+    expected = sd.calc_registers(loc, target)
+    written = bytes((on & 0xff, on >> 8, off & 0xff, off >> 8))
+    print("{} {}: servo.fraction wrote {}, calc_registers gives {}".format(loc, s_type, written.hex(), expected.hex()))
+    failed = failed or written != expected
+
+print("FAILED" if failed else "All channels match")